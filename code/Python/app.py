@@ -1,11 +1,15 @@
-import gimbal as gb
+import discovery
+import queue
 import serial
 import serial.tools.list_ports as lp
+import supervisor
+import threading
 import tkinter as tk
 from tkinter import ttk, messagebox
 
 LARGE_FONT = ("Verdana", 12)
 FILL_HOZ = tk.W+tk.E+tk.N+tk.S
+POLL_MS = 50                #Period of checking for results of worker threads
 
 
 class gimbalApp(tk.Tk):
@@ -31,19 +35,24 @@ class gimbalApp(tk.Tk):
 
         #-----------------menubar setup------------------
         menubar = tk.Menu(container)
+        self.menubar = menubar
         
         self.connmenu = tk.Menu(menubar, tearoff=0)        
         self.connmenu.add_cascade(label="COM Port")
         self.connmenu.add_command(label="Connect", command=lambda:self._connect_gimbal())
         
         self.connmenu.add_separator()
-        self.connmenu.add_command(label="Scan", command=lambda:self._refresh_ports(menubar))
+        self.connmenu.add_command(label="Scan", command=self._scan)
         
         menubar.add_cascade(label="Connect", menu=self.connmenu)
 
         tk.Tk.config(self, menu=menubar)
         self.connmenu.entryconfig(1, state="disabled")
 
+        #Tk may only be used from this thread, workers post (kind, value) here
+        self.events = queue.Queue()
+        self.after(POLL_MS, self._poll_events)
+
         self._refresh_ports(menubar)
 
     def disconnect(self):
@@ -55,16 +64,52 @@ class gimbalApp(tk.Tk):
         self.frame.update()
         self.connmenu.entryconfig(0, state="normal")
         self.connmenu.entryconfig(1, state="disabled")
-        self.connmenu.entryconfig(3, label="Scan")
+        self.connmenu.entryconfig(3, label="Scan", command=self._scan, state="normal")
+
+    def _poll_events(self):
+        while True:
+            try:
+                kind, value = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if kind == "scan":
+                self._scan_done(value)
+            elif kind == "state":
+                self.frame.update_status(value)
+        self.after(POLL_MS, self._poll_events)
+
+    def _scan(self):
+        #Probing opens every port and waits for DEVN, so it runs on a worker
+        self.disconnect()
+        self.frame.update_status("scanning")
+        self.connmenu.entryconfig(3, state="disabled")
+        threading.Thread(target=self._scan_worker, name='app-scan', daemon=True).start()
+
+    def _scan_worker(self):
+        try:
+            found = discovery.discover_gimbals(cache=discovery.DeviceCache())
+        except Exception as e:
+            print(str(e))
+            found = []
+        self.events.put(("scan", found))
+
+    def _scan_done(self, found):
+        self.frame.update_status("disconnected")
+        self.connmenu.entryconfig(3, state="normal")
+        ports = [info.port for info in found]
+        labels = [info.port + " (v" + ".".join(info.version) + ")" for info in found]
+        self._set_ports(self.menubar, ports, labels)
 
     def _refresh_ports(self,root):
         self.disconnect()
-        comports = lp.comports()
-        self.ports = []
+        ports = [port.device for port in lp.comports()]
+        self._set_ports(root, ports, ports)
+
+    def _set_ports(self, root, ports, labels):
+        self.ports = ports
         portmenu = tk.Menu(root, tearoff=0)
-        for i in range(len(comports)):
-            self.ports.append(comports[i].device)
-            portmenu.add_command(label=self.ports[i],
+        for i in range(len(self.ports)):
+            portmenu.add_command(label=labels[i],
                                  command=lambda i=i:self._connect_command(index=i))
 
         self.connmenu.entryconfig(0, menu=portmenu)
@@ -80,7 +125,10 @@ class gimbalApp(tk.Tk):
             self.frame.update_status("connecting")
             self.frame.update()
             print('Trying to connect')
-            self.gimbal = gb.Gimbal(self.ports[self.select])
+            #Reconnects by itself if the cable is pulled, see supervisor.py
+            self.gimbal = supervisor.SupervisedGimbal(
+                self.ports[self.select], coalesce_rate=30,
+                on_state=lambda state: self.events.put(("state", state)))
         except Exception as e:
             print(str(e))
             tk.messagebox.showerror("Connection Error", "Could not connect to gimbal")
@@ -91,7 +139,7 @@ class gimbalApp(tk.Tk):
             
             self.connmenu.entryconfig(0, state="disabled")
             self.connmenu.entryconfig(1, state="disabled")
-            self.connmenu.entryconfig(3, label="Disconnect")
+            self.connmenu.entryconfig(3, label="Disconnect", command=self.disconnect)
             self.frame.update_status("connected")
 
     def gimbal_power(self, value):
@@ -226,11 +274,15 @@ class StartPage(tk.Frame):
         self._position_toggle(0)
         
     def update_status(self, status):
-        if status == "disconnected":
+        if status == "disconnected" or status == "closed":
             self.status_label.configure(text="Disconnected", foreground="red")
         elif status == "connecting":
             self.status_label.configure(text="Connecting", foreground="orange")
+        elif status == "scanning":
+            self.status_label.configure(text="Scanning", foreground="orange")
         elif status == "connected":
             self.status_label.configure(text="Connected", foreground="green")
+        elif status == "reconnecting":
+            self.status_label.configure(text="Reconnecting", foreground="orange")
 
 app = gimbalApp()
@@ -0,0 +1,971 @@
+#!/usr/bin/python3
+'''
+HOST STACK BENCHMARKS
+MEASURES THE GIMBAL HOST CODE AGAINST A SIMULATED GIMBAL
+
+The simulator runs in a child process so that only host-side CPU time is
+measured. Results are written as JSON and can be compared with a stored
+baseline to catch regressions.
+
+Usage:
+    python benchmark.py                              run and print results
+    python benchmark.py --save bench_baseline.json   store a new baseline
+    python benchmark.py --compare bench_baseline.json --threshold 0.15
+    python benchmark.py --only rtt connect
+    python benchmark.py --only framing --capture capture.bin
+
+Organization: Davis Drone Club
+'''
+
+import argparse
+import io
+import json
+import logging
+import math
+from logging.handlers import RotatingFileHandler
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+import tty
+from typing import Callable, Dict, List, Optional, Text, Tuple
+
+import numpy as np
+import serial
+
+import clocksync
+import daemon
+import framing
+import gimbal as gb
+import logs
+import manager
+import metrics
+import monitor
+import simulator
+import supervisor
+import telemetry
+
+#Simulator settings of the wire benchmarks: input taken like checkSerial()
+#and both directions limited to the Nano's baud rate
+WIRE = {'paced': True, 'baud': 115200}
+
+#Requests per wire benchmark; each takes about 40 ms
+WIRE_REQUESTS = 50
+
+#Largest last/first per-record log cost accepted by reconnect_logging
+MAX_LOG_COST_RATIO = 2.0
+
+#Registered benchmarks: name -> function(args) returning {metric: (value, better)}
+#where better is 'lower' or 'higher'
+BENCHMARKS = {}
+
+
+def benchmark(name: Text) -> Callable:
+    """
+    Decorator registering a benchmark function under name
+    """
+    def register(function):
+        BENCHMARKS[name] = function
+        return function
+    return register
+
+
+def _run_simulator(conn, kwargs):
+    """
+    Child process body: runs a simulator and executes calls sent over conn
+    """
+    sim = simulator.GimbalSimulator(**kwargs)
+    conn.send(sim.port)
+    while True:
+        name, args = conn.recv()
+        if name == 'close':
+            sim.close()
+            conn.send(None)
+            return
+        conn.send(getattr(sim, name)(*args))
+
+
+class SimulatorProcess:
+    """GimbalSimulator running in a child process.
+
+    Attributes:
+        port: name of the simulated serial port
+    """
+
+    def __init__(self, **kwargs):
+        """
+        Starts the child process
+
+        Args:
+            **kwargs: passed on to GimbalSimulator()
+        """
+        context = multiprocessing.get_context('spawn')
+        self._conn, child = context.Pipe()
+        self._process = context.Process(target=_run_simulator, args=(child, kwargs),
+                                        daemon=True)
+        self._process.start()
+        self.port = self._conn.recv()
+
+    def call(self, name: Text, *args):
+        """
+        Calls a method of the simulator and returns its result
+        """
+        self._conn.send((name, args))
+        return self._conn.recv()
+
+    def close(self):
+        """
+        Closes the simulator and waits for the child process to exit
+        """
+        self.call('close')
+        self._process.join()
+
+    def kill(self):
+        """
+        Kills the child process without closing the simulator, like
+        pulling the USB cable; the port fails for whoever has it open
+        """
+        self._process.kill()
+        self._process.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _percentiles(prefix: Text, samples: List[float], scale: float = 1000.0) -> Dict:
+    """
+    Returns p50/p90/p99 of samples (seconds) as lower-is-better metrics in ms
+    """
+    return {prefix + '.p' + str(pct) + '_ms': (gb.percentile(samples, pct) * scale, 'lower')
+            for pct in (50, 90, 99)}
+
+
+@benchmark('connect')
+def bench_connect(args) -> Dict:
+    """
+    Time from opening the port to the DEVN reply, board already booted
+    """
+    samples = []
+    with SimulatorProcess() as sim:
+        for _ in range(args.connects):
+            gimbal = gb.Gimbal(sim.port)
+            samples.append(gimbal.connect_time)
+            gimbal.close()
+    return _percentiles('connect', samples)
+
+
+@benchmark('attach')
+def bench_attach(args) -> Dict:
+    """
+    Time to a usable gimbal when a tool restarts: opening the port as
+    usual, which resets the Nano (emulated by rebooting the simulator with
+    a 1.5 s boot, the 1 s settle delay of setup() plus the bootloader),
+    against attaching to the running firmware with reset=False
+    """
+    with SimulatorProcess(boot_time=1.5) as sim:
+        sim.call('reset')
+        gimbal = gb.Gimbal(sim.port)
+        gimbal.close()
+        reset = []
+        for _ in range(2):
+            sim.call('reset')
+            gimbal = gb.Gimbal(sim.port)
+            reset.append(gimbal.connect_time)
+            gimbal.close()
+        attach = []
+        for _ in range(args.connects):
+            gimbal = gb.Gimbal(sim.port, reset=False)
+            attach.append(gimbal.connect_time)
+            gimbal.close()
+    results = _percentiles('attach.no_reset', attach)
+    results['attach.reset.p50_ms'] = (gb.percentile(reset, 50) * 1000, 'lower')
+    return results
+
+
+@benchmark('rtt')
+def bench_rtt(args) -> Dict:
+    """
+    Round-trip time of GETVE -> VERS and GETDN -> DEVN
+    """
+    results = {}
+    with SimulatorProcess() as sim:
+        gimbal = gb.Gimbal(sim.port)
+        for out_header, in_header in (('GETVE', 'VERS'), ('GETDN', 'DEVN')):
+            samples = []
+            for _ in range(args.requests):
+                start = time.perf_counter()
+                gimbal.send(out_header, 0)
+                gimbal.read(in_header)
+                samples.append(time.perf_counter() - start)
+            results.update(_percentiles('rtt.' + out_header, samples))
+        gimbal.close()
+    return results
+
+
+@benchmark('daemon')
+def bench_daemon(args) -> Dict:
+    """
+    Time for a tool to attach to a GimbalDaemon, GETVE round trips through
+    it, and the share of DATA samples reaching each of three clients
+    """
+    path = os.path.join(tempfile.gettempdir(), 'gimbal-bench-' + str(os.getpid()) + '.sock')
+    with SimulatorProcess(data_rate=args.data_rate) as sim:
+        server = daemon.GimbalDaemon(sim.port, path).start()
+        try:
+            attach = []
+            for _ in range(args.connects):
+                start = time.perf_counter()
+                client = daemon.DaemonClient(path=path)
+                attach.append(time.perf_counter() - start)
+                client.close()
+            results = _percentiles('daemon.attach', attach)
+
+            clients = [daemon.DaemonClient(path=path) for _ in range(3)]
+            rtt = []
+            for _ in range(args.requests):
+                start = time.perf_counter()
+                clients[0].request("GETVE", 0, "VERS").result(2.0)
+                rtt.append(time.perf_counter() - start)
+            results.update(_percentiles('daemon.rtt.GETVE', rtt))
+
+            totals = [client.telemetry.total for client in clients]
+            published = server.gimbal.telemetry.total
+            time.sleep(args.duration)
+            published = server.gimbal.telemetry.total - published
+            seen = min(client.telemetry.total - total for client, total in zip(clients, totals))
+            results['daemon.seen_ratio'] = (seen / max(published, 1), 'higher')
+            for client in clients:
+                client.close()
+        finally:
+            server.close()
+    return results
+
+
+def _wait_state(gimbal: supervisor.SupervisedGimbal, state: Text, timeout: float = 30.0):
+    """
+    Polls until a supervised gimbal is in state
+    """
+    deadline = time.monotonic() + timeout
+    while gimbal.state != state:
+        if time.monotonic() > deadline:
+            raise TimeoutError('Gimbal not ' + state + ' within ' + str(timeout) + 's')
+        time.sleep(0.001)
+
+
+@benchmark('recovery')
+def bench_recovery(args) -> Dict:
+    """
+    SupervisedGimbal on a symlink to the simulator port, standing in for
+    /dev/serial/by-id. The simulator process is killed, like a pulled
+    cable, and a new one started behind the link. Reports the time for the
+    reader to notice, from the new port appearing to the state being
+    replayed, the outage, and the share of outages after which the new
+    simulator had exactly the state set before
+    """
+    outages = 5
+    directory = tempfile.mkdtemp()
+    link = os.path.join(directory, 'gimbal')
+    sim = SimulatorProcess(data_rate=0)
+    os.symlink(sim.port, link)
+    detect, recover, restored = [], [], 0
+    gimbal = supervisor.SupervisedGimbal(link)
+    try:
+        for outage in range(outages):
+            gimbal.set_direction(outage % 2)
+            gimbal.set_setpoint(10.0 + outage)
+            gimbal.set_enable(0)
+            gimbal.set_position(60 + outage)
+            gimbal.get_version()
+            killed = time.monotonic()
+            sim.kill()
+            _wait_state(gimbal, supervisor.RECONNECTING)
+            detect.append(time.monotonic() - killed)
+            sim = SimulatorProcess(data_rate=0)
+            os.symlink(sim.port, link + '.new')
+            os.replace(link + '.new', link)
+            appeared = time.monotonic()
+            _wait_state(gimbal, supervisor.CONNECTED)
+            recover.append(time.monotonic() - appeared)
+            #Answered after the replayed commands were handled
+            gimbal.get_version()
+            restored += sim.call('state') == {'enabled': False, 'direction': outage % 2,
+                                              'setpoint': 10.0 + outage,
+                                              'output': 60.0 + outage, 'print_en': 1}
+        histogram = gimbal.metrics.histogram('outage')
+    finally:
+        gimbal.close()
+        sim.close()
+        os.remove(link)
+        os.rmdir(directory)
+    results = _percentiles('recovery.detect', detect)
+    results.update(_percentiles('recovery.recover', recover))
+    results['recovery.outage.p50_ms'] = (histogram.percentile(50) * 1000, 'lower')
+    results['recovery.restored_ratio'] = (restored / outages, 'higher')
+    return results
+
+
+@benchmark('requests')
+def bench_requests(args) -> Dict:
+    """
+    GETVE requests per second over a link with 5 ms latency, one at a time vs
+    pipelined, against an unpaced simulator (host only) and against one paced
+    like the firmware at 115200 baud (wire). On the wire, request() keeps
+    only RX_BUFFER bytes of requests unanswered, so none should be lost.
+    """
+    results = {}
+    for mode, sim_kwargs, count in (('host', {}, args.requests),
+                                    ('wire', WIRE, min(args.requests, WIRE_REQUESTS))):
+        with SimulatorProcess(latency=0.005, **sim_kwargs) as sim:
+            gimbal = gb.Gimbal(sim.port)
+            start = time.perf_counter()
+            for _ in range(count):
+                gimbal.get_version()
+            serial = time.perf_counter() - start
+            start = time.perf_counter()
+            #Queued requests time out from the call, so allow for the whole batch
+            futures = [gimbal.request("GETVE", 0, "VERS", timeout=10.0) for _ in range(count)]
+            answered = 0
+            for future in futures:
+                try:
+                    future.result()
+                    answered += 1
+                except TimeoutError:
+                    pass
+            pipelined = time.perf_counter() - start
+            gimbal.close()
+        results['requests.' + mode + '.serial_per_s'] = (count / serial, 'higher')
+        results['requests.' + mode + '.pipelined_per_s'] = (answered / pipelined, 'higher')
+        results['requests.' + mode + '.answered_ratio'] = (answered / count, 'higher')
+    return results
+
+
+def _set_position(duration: float, **sim_kwargs) -> Tuple[int, int, float, int, int]:
+    """
+    Calls set_position() for duration seconds, then waits for the simulator
+    to go quiet. Returns calls, calls whose write timed out, elapsed
+    seconds, SETPO commands the simulator handled intact and input bytes
+    it dropped.
+    """
+    with SimulatorProcess(data_rate=0, **sim_kwargs) as sim:
+        gimbal = gb.Gimbal(sim.port)
+        before = sim.call('stats')['received']
+        calls = timeouts = 0
+        start = time.perf_counter()
+        while time.perf_counter() - start < duration:
+            try:
+                gimbal.set_position(50 + calls % 80)
+            except TimeoutError:
+                timeouts += 1
+            calls += 1
+        elapsed = time.perf_counter() - start
+        #Waits until nothing more is handled, e.g. the receive buffer drained
+        deadline = time.monotonic() + 5
+        received, last = sim.call('stats')['received'], -1
+        while received != last and time.monotonic() < deadline:
+            time.sleep(0.5)
+            received, last = sim.call('stats')['received'], received
+        intact = sum(1 for header, data in sim.call('history', before)
+                     if header == 'SETPO' and data.isdigit())
+        rx_dropped = sim.call('stats')['rx_dropped']
+        gimbal.close()
+    return calls, timeouts, elapsed, intact, rx_dropped
+
+
+@benchmark('set_position')
+def bench_set_position(args) -> Dict:
+    """
+    Sustained set_position() rate, counted as commands the gimbal handled,
+    against an unpaced simulator (host only) and against one paced like
+    the firmware at 115200 baud (wire), where most calls are lost
+    """
+    results = {}
+    for mode, sim_kwargs in (('host', {}), ('wire', WIRE)):
+        calls, timeouts, elapsed, intact, rx_dropped = _set_position(args.duration, **sim_kwargs)
+        prefix = 'set_position.' + mode
+        results[prefix + '.calls_per_s'] = (calls / elapsed, 'higher')
+        results[prefix + '.handled_per_s'] = (intact / elapsed, 'higher')
+        results[prefix + '.lost_ratio'] = (1 - intact / calls, 'lower')
+        results[prefix + '.write_timeouts'] = (timeouts, 'lower')
+        results[prefix + '.rx_dropped'] = (rx_dropped, 'lower')
+    return results
+
+
+def _telemetry(args, binary: bool) -> Dict:
+    """
+    DATA packets parsed per second, host CPU time and reader wakeups per
+    1000 samples.
+
+    Most of the CPU time is per wakeup (select, ioctl and read calls) and
+    per sample (queue, ring, stream monitor and metrics), the same for both
+    encodings; decoding is a small share, so binary frames save little host
+    CPU over text lines. Their gain is on the wire, where a frame takes 20
+    bytes against 27 to 33 for a line.
+    """
+    prefix = 'telemetry.binary.' if binary else 'telemetry.ascii.'
+    with SimulatorProcess(data_rate=args.data_rate) as sim:
+        gimbal = gb.Gimbal(sim.port, queue_size=10000, binary=binary)
+        count = 0
+        reads = gimbal.metrics.snapshot()['counters'].get('reads', 0)
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        while time.perf_counter() - start < args.duration:
+            gimbal.read_data()
+            count += 1
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+        reads = gimbal.metrics.snapshot()['counters']['reads'] - reads
+        gimbal.close()
+    return {prefix + 'samples_per_s': (count / elapsed, 'higher'),
+            prefix + 'cpu_ms_per_1000': (cpu / count * 1e6, 'lower'),
+            prefix + 'reads_per_1000': (reads / count * 1000, 'lower')}
+
+
+@benchmark('telemetry')
+def bench_telemetry(args) -> Dict:
+    """
+    Text DATA packets, as sent by firmware before v2.4 or with SETBN;0
+    """
+    return _telemetry(args, binary=False)
+
+
+@benchmark('telemetry_binary')
+def bench_telemetry_binary(args) -> Dict:
+    """
+    Binary DATA frames, as sent by firmware v2.4 after SETBN;1
+    """
+    return _telemetry(args, binary=True)
+
+
+def _read_shared(conn, name: Text, duration: float):
+    """
+    Child process body: polls a shared telemetry ring and sends back the
+    delay from receipt by the owner to each sample being seen, the share
+    of published samples seen, the process CPU time used and the samples seen
+    """
+    ring = telemetry.SharedTelemetryRing.attach(name)
+    seen = first = ring.total
+    delays = []
+    count = 0
+    cpu_start = time.process_time()
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        samples, seen = ring.read_since(seen)
+        if len(samples):
+            now = time.monotonic()
+            delays.extend((now - samples['host_time']).tolist())
+            count += len(samples)
+        time.sleep(0.001)
+    conn.send((delays, count / max(seen - first, 1), time.process_time() - cpu_start, count))
+    ring.close()
+
+
+@benchmark('shared_telemetry')
+def bench_shared_telemetry(args) -> Dict:
+    """
+    Three processes reading the telemetry of one Gimbal through a
+    SharedTelemetryRing: delay to each reader and owner CPU per 1000 samples
+    """
+    context = multiprocessing.get_context('spawn')
+    readers = []
+    with SimulatorProcess(data_rate=args.data_rate) as sim:
+        gimbal = gb.Gimbal(sim.port, telemetry_name='gimbal_bench_' + str(os.getpid()))
+        try:
+            for _ in range(3):
+                conn, child = context.Pipe()
+                process = context.Process(target=_read_shared, daemon=True,
+                                          args=(child, gimbal.telemetry.name, args.duration))
+                process.start()
+                readers.append((conn, process))
+            total = gimbal.telemetry.total
+            cpu_start = time.process_time()
+            results = [conn.recv() for conn, _ in readers]
+            cpu = time.process_time() - cpu_start
+            published = max(gimbal.telemetry.total - total, 1)
+        finally:
+            for _, process in readers:
+                process.join()
+            gimbal.close()
+    delays = [delay for result in results for delay in result[0]]
+    metrics = _percentiles('shared_telemetry.delay', delays)
+    metrics['shared_telemetry.seen_ratio'] = (min(result[1] for result in results), 'higher')
+    metrics['shared_telemetry.owner_cpu_ms_per_1000'] = (cpu / published * 1e6, 'lower')
+    metrics['shared_telemetry.reader_cpu_ms_per_1000'] = (
+        sum(result[2] for result in results) / max(sum(result[3] for result in results), 1) * 1e6, 'lower')
+    return metrics
+
+
+def _cpu_percent(duration: float) -> float:
+    """
+    Returns the CPU time used by this process over duration, in percent of one core
+    """
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    time.sleep(duration)
+    return (time.process_time() - cpu_start) / (time.perf_counter() - start) * 100
+
+
+@benchmark('manager')
+def bench_manager(args) -> Dict:
+    """
+    Host CPU while N gimbals each stream 100 DATA packets per second,
+    served by one GimbalManager loop, and by one reader thread per
+    Gimbal for the largest N
+    """
+    counts = sorted(args.devices)
+    results = {}
+    sims = []
+    try:
+        for _ in range(counts[-1]):
+            sims.append(SimulatorProcess(data_rate=100))
+        for count in counts:
+            with manager.GimbalManager() as gimbals:
+                errors = gimbals.open_all([sim.port for sim in sims[:count]])
+                if errors:
+                    raise RuntimeError('Could not open ' + ', '.join(errors))
+                results['manager.n' + str(count) + '.cpu_pct'] = (_cpu_percent(args.duration), 'lower')
+        gimbals = [gb.Gimbal(sim.port) for sim in sims]
+        results['threads.n' + str(counts[-1]) + '.cpu_pct'] = (_cpu_percent(args.duration), 'lower')
+        for gimbal in gimbals:
+            gimbal.close()
+    finally:
+        for sim in sims:
+            sim.close()
+    return results
+
+
+@benchmark('broadcast')
+def bench_broadcast(args) -> Dict:
+    """
+    Skew between gimbals of one broadcast() SETPO: between the host
+    writes, and between the first DATA samples showing the new output
+    """
+    results = {}
+    for count in (4, 16):
+        sims = [SimulatorProcess(data_rate=500) for _ in range(count)]
+        try:
+            with manager.GimbalManager() as gimbals:
+                errors = gimbals.open_all([sim.port for sim in sims])
+                if errors:
+                    raise RuntimeError('Could not open ' + ', '.join(errors))
+                gimbals.send_all("SETEN", 0)
+                time.sleep(0.1)
+                write_skews, change_skews = [], []
+                for repeat in range(50):
+                    result = gimbals.broadcast("SETPO", 60 + 60 * (repeat % 2))
+                    write_skews.append(result.write_skew)
+                    if result.change_skew is not None:
+                        change_skews.append(result.change_skew)
+                    time.sleep(0.01)
+        finally:
+            for sim in sims:
+                sim.close()
+        prefix = 'broadcast.n' + str(count)
+        results.update(_percentiles(prefix + '.write_skew', write_skews))
+        results.update(_percentiles(prefix + '.change_skew', change_skews or [float('nan')]))
+        results[prefix + '.missed'] = (50 - len(change_skews), 'lower')
+    return results
+
+
+@benchmark('clock')
+def bench_clock(args) -> Dict:
+    """
+    ClockSync on synthetic DATA times: a device running 50 ppm slow,
+    millis() wrapping after one minute, and 1 ms + exponential(0.5 ms)
+    USB latency. Reports update cost, drift error and conversion error
+    against the noise-free mean arrival time.
+    """
+    rng = random.Random(0)
+    clock = clocksync.ClockSync()
+    drift = 50e-6
+    start = clocksync.DEVICE_WRAP - 60000
+    period = 0.1667
+    errors = []
+    cost = 0.0
+    for index in range(6000):
+        elapsed = index * period
+        device_time = int(start + elapsed * 1000) % clocksync.DEVICE_WRAP
+        arrival = 100.0 + elapsed * (1 + drift) + 0.0015
+        begin = time.perf_counter()
+        clock.update(device_time, arrival - 0.0005 + rng.expovariate(1 / 0.0005))
+        cost += time.perf_counter() - begin
+        if index >= clock.window:
+            errors.append(abs(clock.device_to_host(device_time) - arrival))
+    results = _percentiles('clock.error', errors)
+    results['clock.update_us'] = (cost / 6000 * 1e6, 'lower')
+    results['clock.drift_error_ppm'] = (abs(clock.drift_ppm - drift * 1e6), 'lower')
+    return results
+
+
+@benchmark('stream')
+def bench_stream(args) -> Dict:
+    """
+    StreamMonitor on synthetic firmware DATA times with 1% of packets
+    dropped, 0.2% repeated and a backlog of 5 packets delivered at once
+    every 100 packets. Reports the cost per packet of add() and add_many()
+    and the miscounted drops, duplicates and bursts; all should be 0.
+    """
+    rng = random.Random(0)
+    stamps, arrivals = [], []
+    dropped = duplicates = 0
+    count = 20000
+    for index in range(count):
+        if 0 < index < count - 1 and rng.random() < 0.01:
+            dropped += 1
+            continue
+        device_time = int(index * monitor.DATA_PERIOD)
+        #Packets 0-3 of every hundred are held back and arrive with packet 4
+        arrival = 10.0 + max(index, index - index % 100 + 4) * monitor.DATA_PERIOD / 1000
+        stamps.append(device_time)
+        arrivals.append(arrival)
+        if index % 100 > 4 and rng.random() < 0.002:
+            duplicates += 1
+            stamps.append(device_time)
+            arrivals.append(arrival + 0.01)
+    bursts = count // 100
+    stream = monitor.StreamMonitor()
+    start = time.perf_counter()
+    for device_time, arrival in zip(stamps, arrivals):
+        stream.add(device_time, arrival)
+    add = (time.perf_counter() - start) / len(stamps)
+    batched = monitor.StreamMonitor()
+    chunks = [np.array(stamps[index:index + 50]) for index in range(0, len(stamps), 50)]
+    start = time.perf_counter()
+    for number, chunk in enumerate(chunks):
+        batched.add_many(chunk, number * 10.0)
+    add_many = (time.perf_counter() - start) / len(stamps)
+    return {'stream.add_us': (add * 1e6, 'lower'),
+            'stream.add_many_us': (add_many * 1e6, 'lower'),
+            'stream.dropped_error': (abs(stream.dropped - dropped) + abs(batched.dropped - dropped), 'lower'),
+            'stream.duplicates_error': (abs(stream.duplicates - duplicates) + abs(batched.duplicates - duplicates), 'lower'),
+            'stream.bursts_error': (abs(stream.bursts - bursts), 'lower'),
+            'stream.false_alarms': (stream.short + stream.resets + batched.short + batched.resets, 'lower')}
+
+
+@benchmark('metrics')
+def bench_metrics(args) -> Dict:
+    """
+    Cost of recording one histogram value and of a snapshot() of a
+    registry holding the metrics of a busy gimbal
+    """
+    registry = metrics.Metrics()
+    count = 100000
+    start = time.perf_counter()
+    for value in range(1, count + 1):
+        registry.observe('loop_duration', value)
+    observe = (time.perf_counter() - start) / count
+    for name in ('write_latency', 'rtt.GETVE', 'rtt.GETEP', 'rx_interval', 'rx_jitter'):
+        registry.observe_many(name, [1e-4] * 1000)
+    start = time.perf_counter()
+    for _ in range(100):
+        registry.snapshot()
+    snapshot = (time.perf_counter() - start) / 100
+    return {'metrics.observe_us': (observe * 1e6, 'lower'),
+            'metrics.snapshot_ms': (snapshot * 1e3, 'lower')}
+
+
+@benchmark('logging')
+def bench_logging(args) -> Dict:
+    """
+    Caller-side cost of logging a SENT:SETPO record: file handler, queued and
+    sampled by the handler's filter, and sampled with keep() before the
+    record is built, as Gimbal.send() does
+    """
+    results = {}
+    records = 20000
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in ('sync', 'async', 'keep'):
+            log = logging.getLogger('benchmark.' + name)
+            log.propagate = False
+            log.setLevel(logging.DEBUG)
+            if name == 'sync':
+                handler = RotatingFileHandler(os.path.join(tmp, name + '.log'),
+                                              maxBytes=5*1024*1024, backupCount=1)
+                closer = handler
+            else:
+                closer = logs.AsyncLogHandler(os.path.join(tmp, name + '.log'))
+                handler = closer.handler
+            handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(message)s'))
+            log.addHandler(handler)
+            start = time.perf_counter()
+            if name == 'keep':
+                for i in range(records):
+                    if closer.filter.keep('SENT:SETPO'):
+                        log.info('SENT:SETPO;' + str(50 + i % 80), extra=logs.KEPT)
+            else:
+                for i in range(records):
+                    log.info('SENT:SETPO;' + str(50 + i % 80))
+            elapsed = time.perf_counter() - start
+            log.removeHandler(handler)
+            closer.close()
+            results['logging.' + name + '.us_per_record'] = (elapsed / records * 1e6, 'lower')
+    return results
+
+
+@benchmark('reconnect_logging')
+def bench_reconnect_logging(args) -> Dict:
+    """
+    Per-record logging cost on the first and last of many reconnects.
+
+    Handlers piling up on a logger make every record cost more after each
+    reconnect, so the ratio stays near 1 only if they are reused.
+
+    Raises:
+        AssertionError: If more than one handler is in use after the
+            reconnects, any is left after the last close, or the cost
+            ratio exceeds MAX_LOG_COST_RATIO
+    """
+    records = 200
+    costs = []
+    with SimulatorProcess(data_rate=0) as sim:
+        for _ in range(args.reconnects):
+            gimbal = gb.Gimbal(sim.port)
+            start = time.perf_counter()
+            for i in range(records):
+                gimbal.log.info('SENT:GETVE;' + str(i))
+            costs.append((time.perf_counter() - start) / records * 1e6)
+            handlers = logs.handler_count()
+            gimbal.close()
+    window = max(1, len(costs) // 10)
+    first = gb.percentile(costs[:window], 50)
+    last = gb.percentile(costs[-window:], 50)
+    if handlers != 1:
+        raise AssertionError('{} log handlers after {} reconnects, expected 1'.format(
+            handlers, args.reconnects))
+    if logs.handler_count() != 0:
+        raise AssertionError('{} log handlers left after close'.format(logs.handler_count()))
+    if last / first > MAX_LOG_COST_RATIO:
+        raise AssertionError('Log cost grew from {:.1f}us to {:.1f}us over {} reconnects'.format(
+            first, last, args.reconnects))
+    return {'reconnect.log_us_first': (first, 'lower'),
+            'reconnect.log_us_last': (last, 'lower'),
+            'reconnect.log_cost_ratio': (last / first, 'lower'),
+            'reconnect.handlers': (handlers, 'lower')}
+
+
+def _capture(args) -> bytes:
+    """
+    Returns the raw serial capture for parser benchmarks.
+
+    Uses the file given with --capture (e.g. recorded with
+    'cat /dev/ttyUSB0 > capture.bin'), otherwise builds one that looks like
+    a long run: DATA packets with a LOOP warning and a corrupted line now
+    and then.
+    """
+    if args.capture:
+        with open(args.capture, 'rb') as capture_file:
+            return capture_file.read()
+    lines = []
+    for i in range(100000):
+        lines.append(framing.format_data((i % 900 / 10 - 45, 5555 + i % 7, i % 300 / 10, i * 167)).encode())
+        if i % 500 == 0:
+            lines.append(b'LOOP;' + str(5700 + i % 50).encode())
+        if i % 5000 == 0:
+            lines.append(b'DA\xffTA;garbage')
+    return b'\r\n'.join(lines) + b'\r\n'
+
+
+def _serial_framing(capture: bytes, chunked: bool) -> float:
+    """
+    Seconds to read and parse every line of capture from a pseudo-terminal
+    """
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    port = serial.Serial(os.ttyname(slave), 115200, timeout=1)
+    writer = threading.Thread(target=lambda: [os.write(master, capture[pos:pos + 4096])
+                                              for pos in range(0, len(capture), 4096)],
+                              daemon=True)
+    lines = capture.count(b'\n')
+    parser = framing.PacketParser(['WARN', 'LOOP', 'DATA', 'EEPR', 'VERS', 'DEVN'])
+    start = time.perf_counter()
+    writer.start()
+    if chunked:
+        while parser.counters['lines'] < lines:
+            parser.feed(port.read(port.in_waiting or 1))
+    else:
+        for _ in range(lines):
+            try:
+                text = port.readline().decode('utf-8').strip()
+            except UnicodeDecodeError:
+                continue
+            if text.split(';')[0] == 'DATA':
+                try:
+                    framing.parse_data(text)
+                except ValueError:
+                    continue
+    elapsed = time.perf_counter() - start
+    writer.join()
+    port.close()
+    os.close(master)
+    return elapsed
+
+
+@benchmark('framing')
+def bench_framing(args) -> Dict:
+    """
+    Parse cost per line of a capture: per-line readline(), PacketParser on
+    chunks, and the NumPy batch parser on the whole capture.
+
+    'parse' metrics read the capture from memory, 'serial' metrics stream
+    the first 20000 lines of it through a pseudo-terminal and pyserial.
+    """
+    capture = _capture(args)
+    lines = capture.count(b'\n')
+
+    start = time.perf_counter()
+    for line in iter(io.BytesIO(capture).readline, b''):
+        try:
+            text = line.decode('utf-8').strip()
+        except UnicodeDecodeError:
+            continue
+        if text.split(';')[0] == 'DATA':
+            try:
+                framing.parse_data(text)
+            except ValueError:
+                continue
+    readline = time.perf_counter() - start
+
+    parser = framing.PacketParser(['WARN', 'LOOP', 'DATA', 'EEPR', 'VERS', 'DEVN'])
+    view = memoryview(capture)
+    start = time.perf_counter()
+    for pos in range(0, len(capture), 4096):
+        parser.feed(view[pos:pos + 4096])
+    chunked = time.perf_counter() - start
+
+    start = time.perf_counter()
+    telemetry.parse_block(capture)
+    batch = time.perf_counter() - start
+
+    head = b''.join(capture.splitlines(keepends=True)[:20000])
+    head_lines = head.count(b'\n')
+    serial_readline = _serial_framing(head, chunked=False)
+    serial_chunked = _serial_framing(head, chunked=True)
+    return {'framing.parse.readline.us_per_line': (readline / lines * 1e6, 'lower'),
+            'framing.parse.chunked.us_per_line': (chunked / lines * 1e6, 'lower'),
+            'framing.parse.batch.us_per_line': (batch / lines * 1e6, 'lower'),
+            'framing.serial.readline.us_per_line': (serial_readline / head_lines * 1e6, 'lower'),
+            'framing.serial.chunked.us_per_line': (serial_chunked / head_lines * 1e6, 'lower'),
+            'framing.serial.speedup': (serial_readline / serial_chunked, 'higher')}
+
+
+def run(names: List[Text], args) -> Dict:
+    """
+    Runs the named benchmarks and returns the results document
+    """
+    metrics = {}
+    for name in names:
+        print('Running ' + name + '...', file=sys.stderr)
+        for metric, (value, better) in BENCHMARKS[name](args).items():
+            metrics[metric] = {'value': value, 'better': better, 'benchmark': name}
+    return {'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'benchmarks': list(names),
+            'python': platform.python_version(),
+            'machine': platform.platform(),
+            'metrics': metrics}
+
+
+def compare(results: Dict, baseline: Dict, threshold: float) -> List[Tuple[Text, float, float, float]]:
+    """
+    Finds metrics that got worse than the baseline by more than threshold.
+    A baseline of 0 has no relative change, so any value worse than 0 is a regression.
+
+    Args:
+        results (dict): document returned by run()
+        baseline (dict): document loaded from a baseline file
+        threshold (float): allowed relative change, e.g. 0.15 for 15%
+
+    Returns:
+        list: (metric, baseline value, new value, relative change) of every regression
+    """
+    regressions = []
+    for metric, new in results['metrics'].items():
+        old = baseline['metrics'].get(metric)
+        if old is None:
+            continue
+        if old['value'] == 0:
+            #Zero baselines are absolute: reported change is +/-inf
+            change = math.copysign(math.inf, new['value']) if new['value'] else 0.0
+            worse = change if new['better'] == 'lower' else -change
+            if worse > 0:
+                regressions.append((metric, old['value'], new['value'], change))
+            continue
+        change = (new['value'] - old['value']) / old['value']
+        worse = change if new['better'] == 'lower' else -change
+        if worse > threshold:
+            regressions.append((metric, old['value'], new['value'], change))
+    return regressions
+
+
+def missing(results: Dict, baseline: Dict) -> List[Text]:
+    """
+    Finds baseline metrics that the benchmarks run for results did not report
+
+    Args:
+        results (dict): document returned by run()
+        baseline (dict): document loaded from a baseline file
+
+    Returns:
+        list: sorted names of the missing metrics
+    """
+    ran = set(results.get('benchmarks', ()))
+    lost = []
+    for metric, old in baseline['metrics'].items():
+        if metric in results['metrics']:
+            continue
+        #Baselines saved before metrics named their benchmark count as run
+        if 'benchmark' not in old or old['benchmark'] in ran:
+            lost.append(metric)
+    return sorted(lost)
+
+
+def main(argv: Optional[List[Text]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the gimbal host stack')
+    parser.add_argument('--only', nargs='+', choices=sorted(BENCHMARKS),
+                        help='benchmarks to run (default: all)')
+    parser.add_argument('--save', metavar='FILE', help='write results to FILE as a new baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare results with baseline FILE')
+    parser.add_argument('--threshold', type=float, default=0.15,
+                        help='relative change counted as a regression (default 0.15)')
+    parser.add_argument('--duration', type=float, default=2.0,
+                        help='seconds per throughput benchmark')
+    parser.add_argument('--requests', type=int, default=200, help='requests per RTT benchmark')
+    parser.add_argument('--connects', type=int, default=20, help='connects per connect benchmark')
+    parser.add_argument('--reconnects', type=int, default=1000,
+                        help='reconnects per reconnect_logging benchmark')
+    parser.add_argument('--devices', type=int, nargs='+', default=[1, 4, 16, 32],
+                        help='gimbal counts for the manager benchmark')
+    parser.add_argument('--capture', metavar='FILE',
+                        help='raw serial capture for the framing benchmark (default: generated)')
+    parser.add_argument('--data-rate', type=float, default=5000.0,
+                        help='simulated DATA packets per second')
+    args = parser.parse_args(argv)
+
+    results = run(args.only or list(BENCHMARKS), args)
+    for metric, entry in sorted(results['metrics'].items()):
+        print('{:<40}{:>14.3f}'.format(metric, entry['value']))
+    if args.save:
+        with open(args.save, 'w') as out_file:
+            json.dump(results, out_file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as in_file:
+            baseline = json.load(in_file)
+        regressions = compare(results, baseline, args.threshold)
+        for metric, old, new, change in regressions:
+            print('REGRESSION {}: {:.3f} -> {:.3f} ({:+.1%})'.format(metric, old, new, change))
+        lost = missing(results, baseline)
+        for metric in lost:
+            print('MISSING {}: in baseline but not in results'.format(metric))
+        if regressions or lost:
+            return 1
+        print('No regressions beyond {:.0%}'.format(args.threshold))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
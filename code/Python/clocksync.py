@@ -0,0 +1,183 @@
+#!/usr/bin/python3
+'''
+GIMBAL CLOCK SYNC
+MAPS THE DEVICE TIME OF DATA PACKETS TO HOST time.monotonic() AND BACK
+
+printData() stamps every DATA packet with millis(), a 32-bit counter that
+wraps after about 49.7 days, starts from 0 at every reset and runs off a
+crystal that is tens of ppm off. ClockSync unwraps the counter and fits
+host receive time = offset + slope * device time with an exponentially
+weighted linear regression, updated in O(1) per sample, so the fit follows
+crystal drift and temperature.
+
+Receive times include the USB latency, so converted times are times of
+arrival of a just-printed packet, not of the print itself.
+
+Usage:
+    clock = ClockSync()
+    clock.update(curr_time, host_time)      #for every DATA sample
+    clock.device_to_host(curr_time)         #-> time.monotonic() value
+    clock.host_to_device(time.monotonic())  #-> millis() value
+
+Organization: Davis Drone Club
+'''
+
+import threading
+from typing import Optional, Tuple
+
+#Width of the device time counter and seconds per count, for millis()
+DEVICE_WRAP = 2**32
+DEVICE_TICK = 1e-3
+
+
+class ClockSync:
+    """Streaming linear fit of host time against unwrapped device time.
+
+    Attributes:
+        count: samples used since creation or the last device reset
+        resets: times the device time jumped back without wrapping, i.e. the board restarted
+        window: samples after which an old sample's weight has fallen to 1/e
+    """
+
+    def __init__(self, window: int = 1000, wrap: int = DEVICE_WRAP, tick: float = DEVICE_TICK):
+        """
+        Args:
+            window (int, optional): see attributes. Defaults to 1000, about
+                three minutes of DATA packets at the firmware rate.
+            wrap (int, optional): device counter period. Defaults to 2**32.
+            tick (float, optional): nominal seconds per device count. Defaults to 1e-3.
+        """
+        self.window = window
+        self.wrap = wrap
+        self.tick = tick
+        self.resets = 0
+        self._decay = 1.0 - 1.0 / window
+        self._lock = threading.Lock()
+        self._clear()
+
+    def _clear(self):
+        self.count = 0
+        self._epoch = 0
+        self._last = None
+        self._weight = 0.0
+        self._mean_x = 0.0
+        self._mean_y = 0.0
+        self._var_x = 0.0
+        self._cov = 0.0
+        self._var_y = 0.0
+
+    def unwrap(self, device_time: int) -> int:
+        """
+        Returns device_time extended past the counter width, taking the
+        value closest to the latest sample
+        """
+        if self._last is None:
+            return device_time
+        base = self._last - self._last % self.wrap
+        candidates = (base - self.wrap + device_time, base + device_time, base + self.wrap + device_time)
+        return min(candidates, key=lambda value: abs(value - self._last))
+
+    def update(self, device_time: int, host_time: float):
+        """
+        Adds one (device time, host receive time) pair
+
+        Args:
+            device_time (int): currTime field of a DATA sample
+            host_time (float): time.monotonic() when it was received
+        """
+        device_time = int(device_time)
+        with self._lock:
+            self._update(device_time, host_time)
+
+    def _update(self, device_time: int, host_time: float):
+        if self._last is not None:
+            step = (device_time - self._last) % self.wrap
+            if step > self.wrap // 2:
+                #Jumped back by less than half a wrap: the board was reset
+                self.resets += 1
+                self._clear()
+        x = self.unwrap(device_time)
+        self._last = x
+        if self.count == 0:
+            self._epoch = x
+            self._mean_y = host_time
+        x -= self._epoch
+        #Exponentially weighted Welford update of means and co-moments
+        self._weight = self._decay * self._weight + 1.0
+        dx = x - self._mean_x
+        dy = host_time - self._mean_y
+        self._mean_x += dx / self._weight
+        self._mean_y += dy / self._weight
+        self._var_x = self._decay * self._var_x + dx * (x - self._mean_x)
+        self._cov = self._decay * self._cov + dx * (host_time - self._mean_y)
+        self._var_y = self._decay * self._var_y + dy * (host_time - self._mean_y)
+        self.count += 1
+
+    @property
+    def slope(self) -> float:
+        """
+        Host seconds per device count; the nominal tick until two distinct device times were seen
+        """
+        with self._lock:
+            return self._slope()
+
+    def _slope(self) -> float:
+        if self._var_x <= 0:
+            return self.tick
+        return self._cov / self._var_x
+
+    @property
+    def drift_ppm(self) -> float:
+        """
+        Device clock rate error in parts per million, positive when the device runs slow
+        """
+        return (self.slope / self.tick - 1.0) * 1e6
+
+    @property
+    def residual(self) -> Optional[float]:
+        """
+        Weighted RMS distance of receive times from the fit in seconds, None before three samples
+        """
+        with self._lock:
+            if self.count < 3:
+                return None
+            spread = self._var_y - self._slope() * self._cov if self._var_x > 0 else self._var_y
+            return (max(spread, 0.0) / self._weight) ** 0.5
+
+    def _fit(self) -> Tuple[int, float, float, float]:
+        """
+        Returns epoch, mean device time, mean host time and slope, read together
+
+        Raises:
+            ValueError: If no sample was added yet
+        """
+        with self._lock:
+            if self.count == 0:
+                raise ValueError('No samples yet')
+            return self._epoch, self._mean_x, self._mean_y, self._slope()
+
+    def device_to_host(self, device_time: int) -> float:
+        """
+        Converts a device time to host time.monotonic()
+
+        Args:
+            device_time (int): device counter value as printed, within
+                half a wrap of the latest sample
+
+        Raises:
+            ValueError: If no sample was added yet
+        """
+        epoch, mean_x, mean_y, slope = self._fit()
+        x = self.unwrap(int(device_time)) - epoch
+        return mean_y + slope * (x - mean_x)
+
+    def host_to_device(self, host_time: float) -> float:
+        """
+        Converts a host time.monotonic() value to the device counter, wrapped like millis()
+
+        Raises:
+            ValueError: If no sample was added yet
+        """
+        epoch, mean_x, mean_y, slope = self._fit()
+        x = mean_x + (host_time - mean_y) / slope
+        return (x + epoch) % self.wrap
@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+'''
+COMMAND COALESCER
+LATEST-WINS SEND PATH FOR IDEMPOTENT GIMBAL COMMANDS
+
+Organization: Davis Drone Club
+'''
+
+import threading
+import time
+from typing import Callable, Dict, Text, Union
+
+
+class CommandCoalescer:
+    """Sends only the newest value of each header, at a limited rate.
+
+    Meant for commands that set state, such as SETPO, where only the most
+    recent value matters. submit() records the value and returns at once.
+    A flusher thread writes the pending values at most max_rate times a
+    second and skips values equal to the last one written for that header.
+
+    Attributes:
+        max_rate: maximum number of flushes per second
+        submitted: number of values passed to submit()
+        written: number of values actually written
+        replaced: number of pending values overwritten by a newer one
+        repeated: number of values dropped because they were already written
+    """
+
+    def __init__(self, write: Callable[[Text, Union[int, float]], None],
+                 max_rate: float = 50.0):
+        """
+        Starts the flusher thread
+
+        Args:
+            write (callable): called as write(header, value) to send a packet
+            max_rate (float, optional): flushes per second. Defaults to 50.
+        """
+        self.max_rate = max_rate
+        self.submitted = 0
+        self.written = 0
+        self.replaced = 0
+        self.repeated = 0
+        self.error = None
+        self._write = write
+        self._pending = {}
+        self._last = {}
+        self._closed = False
+        self._cond = threading.Condition()
+        self._flusher = threading.Thread(target=self._flush_loop, name='gimbal-coalescer',
+                                         daemon=True)
+        self._flusher.start()
+
+    def submit(self, header: Text, value: Union[int, float]):
+        """
+        Queues value as the newest value of header.
+
+        Raises:
+            Exception: the error raised by the last failed write, once
+        """
+        with self._cond:
+            if self.error is not None:
+                error, self.error = self.error, None
+                raise error
+            self.submitted += 1
+            if header in self._pending:
+                self.replaced += 1
+                del self._pending[header]
+            if self._last.get(header) == value:
+                self.repeated += 1
+                return
+            self._pending[header] = value
+            self._cond.notify()
+
+    def flush(self):
+        """
+        Writes all pending values now, ignoring the rate limit
+        """
+        with self._cond:
+            batch, self._pending = self._pending, {}
+        self._write_batch(batch)
+
+    def reset(self):
+        """
+        Forgets the last written values, e.g. after the gimbal restarted
+        """
+        with self._cond:
+            self._last.clear()
+
+    def forget(self, header: Text):
+        """
+        Forgets the last written value of header, e.g. after it was sent
+        around the coalescer, so the next value of it is always written
+        """
+        with self._cond:
+            self._last.pop(header, None)
+
+    def close(self):
+        """
+        Writes pending values and stops the flusher thread
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._flusher is not threading.current_thread():
+            self._flusher.join()
+        self.flush()
+
+    @property
+    def saved(self) -> int:
+        """
+        Number of submitted values that never had to be written
+        """
+        with self._cond:
+            return self.submitted - self.written - len(self._pending)
+
+    def stats(self) -> Dict[Text, int]:
+        """
+        Returns the counters as a dict
+        """
+        return {'submitted': self.submitted, 'written': self.written,
+                'replaced': self.replaced, 'repeated': self.repeated,
+                'saved': self.saved}
+
+    def _flush_loop(self):
+        """
+        Writes pending values, waiting 1/max_rate seconds between flushes
+        """
+        period = 1.0 / self.max_rate
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                batch, self._pending = self._pending, {}
+            next_flush = time.monotonic() + period
+            self._write_batch(batch)
+            with self._cond:
+                while not self._closed:
+                    remaining = next_flush - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+
+    def _write_batch(self, batch: Dict[Text, Union[int, float]]):
+        """
+        Writes a batch of values, keeping the first error for submit() to raise
+        """
+        for header, value in batch.items():
+            try:
+                self._write(header, value)
+            except Exception as e:
+                with self._cond:
+                    self.error = e
+                return
+            with self._cond:
+                self.written += 1
+                self._last[header] = value
@@ -0,0 +1,705 @@
+#!/usr/bin/python3
+'''
+GIMBAL DAEMON
+SHARES ONE GIMBAL WITH MANY LOCAL TOOLS OVER A UNIX DOMAIN SOCKET
+
+The daemon opens the port once through Gimbal, so the reset and handshake
+are paid once. Tools connect with DaemonClient in milliseconds, send any
+command, make requests, and receive only the packets they subscribed to.
+
+Protocol: every message is a 3 byte head, type (u8) and payload length
+(u16 little-endian), followed by the payload. Client messages start their
+payload with a u16 id that the daemon echoes in its answer.
+
+Type | Direction | Payload
+-----|-----------|--------
+HELLO     | daemon -> client | port;major,minor of the firmware version
+COMMAND   | client -> daemon | id, 'SETSP;10'; answered by ACK or ERROR
+REQUEST   | client -> daemon | id, timeout (u16 ms), 'GETVE;0;VERS'; answered by REPLY or ERROR
+SUBSCRIBE | client -> daemon | id, DATA decimation (u16, 0 for none), 'WARN,LOOP'; answered by ACK
+ACK       | daemon -> client | id
+ERROR     | daemon -> client | id, 'ValueError;Invalid header'
+REPLY     | daemon -> client | id, 'VERS;2,4'
+PACKET    | daemon -> client | a subscribed packet, e.g. 'WARN;Unknown mode'
+SAMPLES   | daemon -> client | DATA samples as raw telemetry.SAMPLE_DTYPE records
+
+Usage:
+    python daemon.py /dev/ttyUSB0          serve a gimbal until interrupted
+
+    client = DaemonClient('/dev/ttyUSB0')
+    client.send("SETSP", 10)
+    print(client.request("GETVE", 0, "VERS").result())
+    print(client.read_data())
+
+Organization: Davis Drone Club
+'''
+
+import argparse
+import builtins
+import concurrent.futures
+import os
+import queue
+import selectors
+import socket
+import struct
+import tempfile
+import threading
+import time
+from typing import List, Optional, Text, Tuple, Union
+
+import numpy as np
+
+import gimbal as gb
+from telemetry import DATA_FIELDS, SAMPLE_DTYPE, TelemetryRing
+
+#Message types
+HELLO, COMMAND, REQUEST, SUBSCRIBE = 0x01, 0x02, 0x03, 0x04
+ACK, ERROR, REPLY, PACKET, SAMPLES = 0x81, 0x82, 0x83, 0x84, 0x85
+
+HEAD = struct.Struct('<BH')
+U16 = struct.Struct('<H')
+MAX_PAYLOAD = 0xFFFF
+
+#DATA samples per SAMPLES message
+SAMPLES_PER_MESSAGE = MAX_PAYLOAD // SAMPLE_DTYPE.itemsize
+
+#Bytes queued for a client before packets and samples to it are dropped
+CLIENT_BUFFER = 1 << 20
+
+#Packets sent to a client that has not subscribed yet
+DEFAULT_HEADERS = ['DATA', 'WARN', 'LOOP']
+
+
+def socket_path(port: Text) -> Text:
+    """
+    Returns the default socket of the daemon serving port, e.g.
+    '/dev/ttyUSB0' -> '/tmp/gimbal-ttyUSB0.sock'
+    """
+    name = os.path.basename(port.rstrip('/\\')) or 'gimbal'
+    return os.path.join(tempfile.gettempdir(), 'gimbal-' + name + '.sock')
+
+
+def encode(kind: int, payload: bytes = b'') -> bytes:
+    """
+    Returns one framed message
+
+    Raises:
+        ValueError: If payload is longer than MAX_PAYLOAD
+    """
+    if len(payload) > MAX_PAYLOAD:
+        raise ValueError('Payload too long: ' + str(len(payload)))
+    return HEAD.pack(kind, len(payload)) + payload
+
+
+def decode(buf: bytearray) -> List[Tuple[int, bytes]]:
+    """
+    Removes all complete messages from buf
+
+    Returns:
+        list: (type, payload) of every complete message
+    """
+    messages = []
+    start = 0
+    while len(buf) - start >= HEAD.size:
+        kind, length = HEAD.unpack_from(buf, start)
+        end = start + HEAD.size + length
+        if end > len(buf):
+            break
+        messages.append((kind, bytes(buf[start + HEAD.size:end])))
+        start = end
+    del buf[:start]
+    return messages
+
+
+def _number(text: Text) -> Union[int, float]:
+    """
+    Converts command data to int or float: '1' -> 1, '2.5' -> 2.5
+    """
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def _error(error: Exception) -> bytes:
+    """
+    Returns an exception as 'Type;message'
+    """
+    return (type(error).__name__ + ';' + str(error)).encode('utf-8')
+
+
+def _exception(payload: bytes) -> Exception:
+    """
+    Rebuilds an exception sent by the daemon; unknown types become Exception
+    """
+    name, _, message = payload.decode('utf-8').partition(';')
+    kind = getattr(builtins, name, None)
+    if not (isinstance(kind, type) and issubclass(kind, Exception)):
+        kind = Exception
+    return kind(message)
+
+
+class _DaemonGimbal(gb.Gimbal):
+    """Gimbal whose unclaimed packets go to the daemon instead of read() queues"""
+
+    def __init__(self, daemon: 'GimbalDaemon', port: Text, **kwargs):
+        self._daemon = daemon
+        gb.Gimbal.__init__(self, port, **kwargs)
+
+    def _enqueue(self, header: Text, stamp: float, packets: list):
+        packets = self._resolve(header, packets)
+        if header == 'DATA':
+            #Samples are already in the telemetry ring
+            self._daemon._wake()
+        elif packets:
+            self._daemon._post_packets([self._as_text(packet) for packet in packets])
+
+
+class _Client:
+    """Connection of one tool to the daemon"""
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.inbuf = bytearray()
+        self.outbuf = bytearray()
+        self.headers = set(DEFAULT_HEADERS) - {'DATA'}
+        self.data_every = 1
+        self.dropped = 0
+
+
+class GimbalDaemon:
+    """Serves one gimbal to any number of DaemonClient connections.
+
+    A single loop thread accepts clients, runs their commands and
+    forwards packets and telemetry to them; the Gimbal reader thread
+    stays the only reader of the port.
+
+    Attributes:
+        gimbal: the Gimbal owning the port
+        path: path of the Unix domain socket
+    """
+
+    def __init__(self, port: Text, path: Optional[Text] = None, **kwargs):
+        """
+        Connects to the gimbal and starts listening
+
+        Args:
+            port (str): COM port of gimbal
+            path (str, optional): socket to listen on. Defaults to socket_path(port).
+            **kwargs: passed on to Gimbal(), e.g. telemetry_name
+
+        Raises:
+            OSError: If another daemon is listening on path
+            Exception: Errors of Gimbal()
+        """
+        self.path = path or socket_path(port)
+        self._selector = selectors.DefaultSelector()
+        self._clients = {}
+        self._packets = []
+        self._replies = []
+        self._posted_lock = threading.Lock()
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        self._woken = False
+        self._stop = False
+        self._thread = None
+        self._listener = self._listen(self.path)
+        try:
+            self.gimbal = _DaemonGimbal(self, port, **kwargs)
+        except Exception:
+            self._listener.close()
+            os.unlink(self.path)
+            raise
+        if self.gimbal.telemetry is None:
+            self.gimbal.close()
+            self._listener.close()
+            os.unlink(self.path)
+            raise ValueError('The daemon needs a telemetry ring')
+        self._seen = self.gimbal.telemetry.total
+        self._hello = encode(HELLO, (port + ';' + ','.join(self.gimbal.get_version())).encode('utf-8'))
+        self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+        self._selector.register(self._listener, selectors.EVENT_READ, self._listener)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @staticmethod
+    def _listen(path: Text) -> socket.socket:
+        """
+        Binds the socket, replacing a stale one left by a daemon that died
+        """
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except OSError:
+                os.unlink(path)
+            else:
+                raise OSError('A daemon is already listening on ' + path)
+            finally:
+                probe.close()
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen(16)
+        listener.setblocking(False)
+        return listener
+
+    def start(self) -> 'GimbalDaemon':
+        """
+        Runs serve_forever() in a background thread
+        """
+        self._thread = threading.Thread(target=self.serve_forever, name='gimbal-daemon', daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        """
+        Serves clients until close() is called
+        """
+        try:
+            while not self._stop:
+                for key, mask in self._selector.select(0.5):
+                    if key.data is None:
+                        self._drain_wake()
+                    elif key.data is self._listener:
+                        self._accept()
+                    else:
+                        if mask & selectors.EVENT_READ:
+                            self._receive(key.data)
+                        if mask & selectors.EVENT_WRITE and key.data.sock.fileno() in self._clients:
+                            self._flush(key.data)
+                self._forward()
+        finally:
+            for client in list(self._clients.values()):
+                self._drop(client)
+            self._selector.close()
+
+    def close(self):
+        """
+        Disconnects all clients, closes the gimbal and removes the socket
+        """
+        self._stop = True
+        self._wake()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._listener.close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self.gimbal.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+    def _wake(self):
+        if self._woken:
+            return
+        self._woken = True
+        try:
+            os.write(self._wake_w, b'\0')
+        except (BlockingIOError, OSError):
+            pass
+
+    def _drain_wake(self):
+        try:
+            while os.read(self._wake_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        #Cleared after draining: a wake from now on writes a new byte
+        self._woken = False
+
+    def _post_packets(self, packets: List[Text]):
+        with self._posted_lock:
+            self._packets += packets
+        self._wake()
+
+    def _post_reply(self, client: _Client, request_id: int, future: concurrent.futures.Future):
+        """
+        Done callback of a request; runs in the Gimbal reader thread
+        """
+        if future.cancelled():
+            message = encode(ERROR, U16.pack(request_id) + b'TimeoutError;Request cancelled')
+        elif future.exception() is not None:
+            message = encode(ERROR, U16.pack(request_id) + _error(future.exception()))
+        else:
+            message = encode(REPLY, U16.pack(request_id) + future.result().encode('utf-8'))
+        with self._posted_lock:
+            self._replies.append((client, message))
+        self._wake()
+
+    def _accept(self):
+        try:
+            sock, _ = self._listener.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        client = _Client(sock)
+        self._clients[sock.fileno()] = client
+        self._selector.register(sock, selectors.EVENT_READ, client)
+        self._queue(client, self._hello, always=True)
+
+    def _drop(self, client: _Client):
+        if self._clients.pop(client.sock.fileno(), None) is None:
+            return
+        self._selector.unregister(client.sock)
+        client.sock.close()
+
+    def _receive(self, client: _Client):
+        try:
+            chunk = client.sock.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            chunk = b''
+        if not chunk:
+            self._drop(client)
+            return
+        client.inbuf += chunk
+        for kind, payload in decode(client.inbuf):
+            self._handle(client, kind, payload)
+
+    def _handle(self, client: _Client, kind: int, payload: bytes):
+        """
+        Runs one client message
+        """
+        if len(payload) < U16.size:
+            return
+        request_id = U16.unpack_from(payload)[0]
+        try:
+            if kind == COMMAND:
+                header, _, data = payload[U16.size:].decode('utf-8').partition(';')
+                self.gimbal.send(header, _number(data))
+                self._queue(client, encode(ACK, U16.pack(request_id)), always=True)
+            elif kind == REQUEST:
+                timeout = U16.unpack_from(payload, U16.size)[0] / 1000.0
+                header, data, reply_header = payload[2 * U16.size:].decode('utf-8').split(';')
+                future = self.gimbal.request(header, _number(data), reply_header, timeout)
+                future.add_done_callback(lambda done: self._post_reply(client, request_id, done))
+            elif kind == SUBSCRIBE:
+                client.data_every = U16.unpack_from(payload, U16.size)[0]
+                headers = payload[2 * U16.size:].decode('utf-8')
+                client.headers = set(headers.split(',')) - {'DATA', ''}
+                self._queue(client, encode(ACK, U16.pack(request_id)), always=True)
+            else:
+                raise ValueError('Unknown message type ' + str(kind))
+        except Exception as e:
+            self._queue(client, encode(ERROR, U16.pack(request_id) + _error(e)), always=True)
+
+    def _queue(self, client: _Client, message: bytes, always: bool = False):
+        """
+        Adds a message to the unsent bytes of a client. Packets and
+        samples are dropped while CLIENT_BUFFER bytes are waiting.
+        """
+        if not always and len(client.outbuf) >= CLIENT_BUFFER:
+            client.dropped += 1
+            return
+        client.outbuf += message
+
+    def _forward(self):
+        """
+        Queues posted replies and packets, and the new telemetry, for every
+        client wanting them, then writes what the sockets take
+        """
+        with self._posted_lock:
+            replies, self._replies = self._replies, []
+            packets, self._packets = self._packets, []
+        for client, message in replies:
+            if client.sock.fileno() in self._clients:
+                self._queue(client, message, always=True)
+        for packet in packets:
+            header = packet.split(';', 1)[0]
+            message = encode(PACKET, packet.encode('utf-8'))
+            for client in self._clients.values():
+                if header in client.headers:
+                    self._queue(client, message)
+        samples, total = self.gimbal.telemetry.since(self._seen)
+        first = total - len(samples)
+        self._seen = total
+        if len(samples):
+            for client in self._clients.values():
+                if client.data_every <= 0:
+                    continue
+                chosen = samples[(-first) % client.data_every::client.data_every]
+                for start in range(0, len(chosen), SAMPLES_PER_MESSAGE):
+                    self._queue(client, encode(SAMPLES, chosen[start:start + SAMPLES_PER_MESSAGE].tobytes()))
+        for client in list(self._clients.values()):
+            if client.outbuf:
+                self._flush(client)
+
+    def _flush(self, client: _Client):
+        """
+        Writes what the socket takes, watching it for writability while bytes remain
+        """
+        try:
+            sent = client.sock.send(client.outbuf)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self._drop(client)
+            return
+        del client.outbuf[:sent]
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if client.outbuf else 0)
+        if self._selector.get_key(client.sock).events != events:
+            self._selector.modify(client.sock, events, client)
+
+
+class DaemonClient:
+    """Connection of a tool to a GimbalDaemon.
+
+    Received packets wait in per-header queues like those of Gimbal, and
+    DATA samples are also kept in a local telemetry ring.
+
+    Attributes:
+        port: COM port of the gimbal served by the daemon
+        version: firmware version, e.g. ['2', '4']
+        telemetry: TelemetryRing of the DATA samples received
+        queue_size: number of unread packets kept per header
+    """
+
+    def __init__(self, port: Optional[Text] = None, path: Optional[Text] = None,
+                 headers: Optional[List[Text]] = None, data_every: int = 1,
+                 queue_size: int = 100, telemetry_size: int = 4096, timeout: float = 2.0):
+        """
+        Connects to the daemon
+
+        Args:
+            port (str, optional): COM port of the gimbal, used to find the socket
+            path (str, optional): socket of the daemon. Defaults to socket_path(port).
+            headers (list, optional): packets to receive. Defaults to DEFAULT_HEADERS.
+            data_every (int, optional): receive every n-th DATA sample. Defaults to 1.
+            queue_size (int, optional): unread packets kept per header. Defaults to 100.
+            telemetry_size (int, optional): DATA samples kept. Defaults to 4096.
+            timeout (float, optional): seconds to wait for the daemon. Defaults to 2.0.
+
+        Raises:
+            FileNotFoundError: If no daemon is listening
+            TimeoutError: If the daemon does not answer
+        """
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.settimeout(timeout)
+        self._sock.connect(path or socket_path(port))
+        self._inbuf = bytearray()
+        self._timeout = timeout
+        messages = []
+        while not messages:
+            chunk = self._sock.recv(65536)
+            if not chunk:
+                raise ConnectionError('Daemon closed the connection')
+            self._inbuf += chunk
+            messages = decode(self._inbuf)
+        kind, payload = messages[0]
+        if kind != HELLO:
+            raise ConnectionError('Not a gimbal daemon')
+        self.port, _, version = payload.decode('utf-8').partition(';')
+        self.version = version.split(',')
+        self.queue_size = queue_size
+        self.telemetry = TelemetryRing(telemetry_size)
+        self._queues = {}
+        self._futures = {}
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._error = None
+        self._sock.settimeout(None)
+        self._reader = threading.Thread(target=self._read_loop, name='gimbal-client', daemon=True)
+        self._reader.start()
+        for kind, payload in messages[1:]:
+            self._handle(time.monotonic(), kind, payload)
+        if headers is not None or data_every != 1:
+            self.subscribe(DEFAULT_HEADERS if headers is None else headers, data_every)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _call(self, kind: int, head: bytes, body: Text) -> concurrent.futures.Future:
+        """
+        Sends a message whose answer resolves the returned future
+        """
+        future = concurrent.futures.Future()
+        with self._lock:
+            if self._error is not None:
+                raise ConnectionError(str(self._error))
+            request_id = self._next_id
+            self._next_id = (self._next_id + 1) & 0xFFFF
+            self._futures[request_id] = future
+        message = encode(kind, U16.pack(request_id) + head + body.encode('utf-8'))
+        try:
+            with self._send_lock:
+                self._sock.sendall(message)
+        except OSError as e:
+            with self._lock:
+                self._futures.pop(request_id, None)
+            raise ConnectionError(str(e))
+        return future
+
+    def _wait(self, future: concurrent.futures.Future, timeout: float):
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            raise TimeoutError('No answer within ' + str(timeout) + 's')
+
+    def send(self, header: Text, data: Union[int, float]):
+        """
+        Sends a packet to the gimbal through the daemon
+
+        Raises:
+            ValueError: If header or data is invalid.
+            TimeoutError: If the daemon does not answer.
+            ConnectionError: If the daemon is gone.
+        """
+        self._wait(self._call(COMMAND, b'', header + ';' + str(data)), self._timeout)
+
+    def request(self, header: Text, data: Union[int, float], reply_header: Text,
+                timeout: float = 2.0) -> concurrent.futures.Future:
+        """
+        Sends a packet and returns a future for its reply, see Gimbal.request()
+
+        Returns:
+            concurrent.futures.Future: resolves to the reply, e.g. 'VERS;2,4'
+        """
+        head = U16.pack(min(int(timeout * 1000), 0xFFFF))
+        return self._call(REQUEST, head, ';'.join((header, str(data), reply_header)))
+
+    def get_version(self, timeout: float = 2.0) -> List[Text]:
+        """
+        Asks the gimbal for its firmware version, e.g. ['2', '4']
+        """
+        packet = self._wait(self.request("GETVE", 0, "VERS", timeout), timeout + self._timeout)
+        return packet.split(';')[1].split(',')
+
+    def subscribe(self, headers: List[Text], data_every: int = 1):
+        """
+        Chooses the packets the daemon forwards
+
+        Args:
+            headers (list): e.g. ['DATA', 'WARN']
+            data_every (int, optional): forward every n-th DATA sample. Defaults to 1.
+        """
+        every = data_every if 'DATA' in headers else 0
+        self._wait(self._call(SUBSCRIBE, U16.pack(every), ','.join(headers)), self._timeout)
+
+    def read(self, header: Text, timeout: float = 2.0) -> Text:
+        """
+        Waits for the next subscribed packet with the desired header
+
+        Raises:
+            TimeoutError: If no packet arrived before the deadline
+        """
+        try:
+            return self._queue(header).get(timeout=timeout)[1]
+        except queue.Empty:
+            raise TimeoutError('No ' + header + ' packet within ' + str(timeout) + 's')
+
+    def read_data(self, timeout: float = 2.0) -> Tuple[float, Tuple[float, int, float, int]]:
+        """
+        Waits for the next DATA sample, see Gimbal.read_data()
+
+        Returns:
+            (float, tuple): time.monotonic() at reception by the daemon and
+                (angle, loop duration, output, time)
+        """
+        try:
+            return self._queue('DATA').get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError('No DATA packet within ' + str(timeout) + 's')
+
+    def close(self):
+        """
+        Disconnects from the daemon; the gimbal stays connected
+        """
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._reader.join()
+        self._sock.close()
+
+    def _queue(self, header: Text) -> queue.Queue:
+        with self._lock:
+            if header not in self._queues:
+                self._queues[header] = queue.Queue(self.queue_size)
+            return self._queues[header]
+
+    def _put(self, header: Text, items: list):
+        """
+        Queues packets of header, dropping the oldest when the queue is full
+        """
+        packet_queue = self._queue(header)
+        for item in items:
+            while True:
+                try:
+                    packet_queue.put_nowait(item)
+                    break
+                except queue.Full:
+                    try:
+                        packet_queue.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    def _read_loop(self):
+        error = ConnectionError('Daemon closed the connection')
+        while True:
+            try:
+                chunk = self._sock.recv(65536)
+            except OSError as e:
+                error = ConnectionError(str(e))
+                break
+            if not chunk:
+                break
+            self._inbuf += chunk
+            stamp = time.monotonic()
+            for kind, payload in decode(self._inbuf):
+                self._handle(stamp, kind, payload)
+        with self._lock:
+            self._error = error
+            futures, self._futures = self._futures, {}
+        for future in futures.values():
+            if not future.done():
+                future.set_exception(error)
+
+    def _handle(self, stamp: float, kind: int, payload: bytes):
+        if kind == SAMPLES:
+            samples = np.frombuffer(payload, dtype=SAMPLE_DTYPE)
+            self.telemetry.extend(samples)
+            recent = samples[-self.queue_size:]
+            self._put('DATA', list(zip(recent['host_time'].tolist(), recent[DATA_FIELDS].tolist())))
+        elif kind == PACKET:
+            packet = payload.decode('utf-8')
+            self._put(packet.split(';', 1)[0], [(stamp, packet)])
+        elif kind in (ACK, REPLY, ERROR):
+            request_id = U16.unpack_from(payload)[0]
+            with self._lock:
+                future = self._futures.pop(request_id, None)
+            if future is None:
+                return
+            if kind == ERROR:
+                future.set_exception(_exception(payload[U16.size:]))
+            else:
+                future.set_result(payload[U16.size:].decode('utf-8') if kind == REPLY else None)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Share one gimbal with local tools')
+    parser.add_argument('port', help='COM port of the gimbal')
+    parser.add_argument('--socket', help='socket to listen on (default: ' + socket_path('<port>') + ')')
+    parser.add_argument('--telemetry-name', help='also publish telemetry in shared memory under this name')
+    parser.add_argument('--no-reset', action='store_true', help='attach without resetting the gimbal')
+    args = parser.parse_args()
+
+    daemon = GimbalDaemon(args.port, args.socket, telemetry_name=args.telemetry_name,
+                          reset=not args.no_reset)
+    print('Serving {} on {}'.format(args.port, daemon.path))
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daemon.close()
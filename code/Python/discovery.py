@@ -0,0 +1,273 @@
+#!/usr/bin/python3
+'''
+GIMBAL DISCOVERY
+FINDS GIMBALS ON ALL SERIAL PORTS AT ONCE
+
+Organization: Davis Drone Club
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional, Text
+
+import serial.tools.list_ports as lp
+
+import gimbal as gb
+
+#USB vendor IDs of the USB-serial chips found on Arduino Nanos:
+#Arduino, Arduino.org, WCH CH340, FTDI, Silicon Labs CP210x
+GIMBAL_USB_VIDS = (0x2341, 0x2A03, 0x1A86, 0x0403, 0x10C4)
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.ddc_gimbal', 'devices.json')
+
+
+class GimbalInfo(NamedTuple):
+    """A port that answered as a gimbal.
+
+    Attributes:
+        port: device name, e.g. 'COM3' or '/dev/ttyUSB0'
+        description: port description reported by the OS
+        version: firmware version as [major, minor] strings
+        device_id: USB fingerprint of the port, see device_id(), or None
+    """
+    port: Text
+    description: Text
+    version: List[Text]
+    device_id: Optional[Text] = None
+
+
+def device_id(port_info) -> Optional[Text]:
+    """
+    Returns a fingerprint identifying the USB device behind a port.
+
+    The fingerprint is 'VID:PID:serial' when the chip reports a serial
+    number. CH340 clones do not, so 'VID:PID@location' (the USB path) is
+    used instead, which stays the same as long as the cable stays in the
+    same socket.
+
+    Args:
+        port_info (ListPortInfo): entry returned by comports()
+
+    Returns:
+        str, or None for ports that are not USB devices
+    """
+    if port_info.vid is None:
+        return None
+    usb = '{:04X}:{:04X}'.format(port_info.vid, port_info.pid)
+    if port_info.serial_number:
+        return usb + ':' + port_info.serial_number
+    if port_info.location:
+        return usb + '@' + port_info.location
+    return None
+
+
+def candidate_ports(usb_vids: Iterable[int] = GIMBAL_USB_VIDS) -> list:
+    """
+    Lists the ports that can be a gimbal without opening them.
+
+    Ports that are not USB devices (Bluetooth serial, modems, onboard UARTs)
+    and USB devices from other vendors are skipped.
+
+    Args:
+        usb_vids (iterable, optional): accepted USB vendor IDs. Defaults to GIMBAL_USB_VIDS.
+
+    Returns:
+        list: ListPortInfo entries
+    """
+    usb_vids = set(usb_vids)
+    return [port for port in lp.comports() if port.vid in usb_vids]
+
+
+class DeviceCache:
+    """On-disk record of confirmed gimbals, keyed by device_id().
+
+    Each entry holds the port, DEVN name, firmware version and the time the
+    device was last confirmed.
+
+    Attributes:
+        path: location of the JSON file
+    """
+
+    def __init__(self, path: Text = DEFAULT_CACHE_PATH):
+        """
+        Loads the cache. A missing or unreadable file gives an empty cache.
+
+        Args:
+            path (str, optional): location of the JSON file. Defaults to ~/.ddc_gimbal/devices.json.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as cache_file:
+                self._entries = json.load(cache_file)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def get(self, key: Text) -> Optional[Dict]:
+        """
+        Returns the entry of a device, or None if it is unknown
+        """
+        with self._lock:
+            return self._entries.get(key)
+
+    def devices(self) -> List[Text]:
+        """
+        Returns the ids of all known devices
+        """
+        with self._lock:
+            return list(self._entries)
+
+    def confirm(self, key: Text, port: Text, version: List[Text], name: Text = 'ddc-gimbal'):
+        """
+        Records a successful handshake with a device
+        """
+        with self._lock:
+            self._entries[key] = {'port': port, 'devn': name, 'version': list(version),
+                                  'confirmed': time.time()}
+            self._save()
+
+    def invalidate(self, key: Text):
+        """
+        Forgets a device, e.g. after its handshake failed
+        """
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self._save()
+
+    def _save(self):
+        """
+        Writes the cache atomically. Must be called with the lock held.
+        """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as cache_file:
+            json.dump(self._entries, cache_file, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+def probe_port(port: Text, description: Text = '', connect_timeout: float = 5.0,
+               key: Optional[Text] = None) -> Optional[GimbalInfo]:
+    """
+    Connects to a single port and asks for the firmware version.
+
+    Args:
+        port (str): the serial port name
+        description (str, optional): port description to report. Defaults to ''.
+        connect_timeout (float, optional): seconds to wait for DEVN. Defaults to 5.0.
+        key (str, optional): device_id() of the port. Defaults to None.
+
+    Returns:
+        GimbalInfo, or None if the port is not a gimbal or could not be opened
+    """
+    try:
+        gimbal = gb.Gimbal(port, connect_timeout=connect_timeout)
+    except Exception:
+        return None
+    try:
+        return GimbalInfo(port, description, gimbal.get_version(), key)
+    except Exception:
+        return None
+    finally:
+        gimbal.close()
+
+
+def discover_gimbals(ports: Optional[List[Text]] = None, connect_timeout: float = 5.0,
+                     usb_vids: Iterable[int] = GIMBAL_USB_VIDS,
+                     cache: Optional[DeviceCache] = None) -> List[GimbalInfo]:
+    """
+    Probes all candidate ports concurrently.
+
+    Every port is probed on its own thread, so the total time is that of
+    the slowest single probe, at most about connect_timeout.
+
+    Args:
+        ports (list, optional): port names to probe. Defaults to the USB ports
+            from candidate_ports().
+        connect_timeout (float, optional): seconds to wait for DEVN. Defaults to 5.0.
+        usb_vids (iterable, optional): accepted USB vendor IDs when ports is not
+            given. Defaults to GIMBAL_USB_VIDS.
+        cache (DeviceCache, optional): updated with every gimbal found; cached
+            devices whose port did not answer as a gimbal are forgotten. Defaults to None.
+
+    Returns:
+        list: GimbalInfo of every port that answered DEVN;ddc-gimbal, in port order
+    """
+    if ports is None:
+        candidates = [(port.device, port.description, device_id(port))
+                      for port in candidate_ports(usb_vids)]
+    else:
+        candidates = [(port, '', None) for port in ports]
+    if not candidates:
+        return []
+    with ThreadPoolExecutor(max_workers=len(candidates)) as pool:
+        results = list(pool.map(lambda c: probe_port(c[0], c[1], connect_timeout, c[2]), candidates))
+    if cache is not None:
+        for (_, _, key), info in zip(candidates, results):
+            if key is None:
+                continue
+            if info is not None:
+                cache.confirm(key, info.port, info.version)
+            elif cache.get(key) is not None:
+                #No answer or not a gimbal anymore, stop steering connect_known() here
+                cache.invalidate(key)
+    return [info for info in results if info is not None]
+
+
+def find_port(key: Text) -> Optional[Text]:
+    """
+    Returns the current port name of a device, without opening any port
+    """
+    for port in lp.comports():
+        if device_id(port) == key:
+            return port.device
+    return None
+
+
+def connect_known(key: Text, cache: Optional[DeviceCache] = None, **kwargs) -> gb.Gimbal:
+    """
+    Reconnects to a device from the cache in a single handshake.
+
+    The port is looked up by fingerprint, so the device is found again
+    even if the OS gave it a different name. If the handshake fails the
+    cache entry is invalidated.
+
+    Args:
+        key (str): device_id() of the gimbal
+        cache (DeviceCache, optional): Defaults to the cache at DEFAULT_CACHE_PATH.
+        **kwargs: passed on to Gimbal()
+
+    Returns:
+        Gimbal: the connected gimbal
+
+    Raises:
+        KeyError: If the device is not in the cache
+        FileNotFoundError: If the device is not plugged in
+        Exception: If the handshake failed
+    """
+    if cache is None:
+        cache = DeviceCache()
+    entry = cache.get(key)
+    if entry is None:
+        raise KeyError('Unknown device: ' + key)
+    port = find_port(key)
+    if port is None:
+        raise FileNotFoundError('Device not connected: ' + key)
+    try:
+        gimbal = gb.Gimbal(port, **kwargs)
+    except Exception:
+        cache.invalidate(key)
+        raise
+    try:
+        version = gimbal.get_version()
+    except Exception:
+        gimbal.close()
+        cache.invalidate(key)
+        raise
+    #Record what the device reports now, e.g. after a firmware update
+    cache.confirm(key, port, version, gimbal.device_name)
+    return gimbal
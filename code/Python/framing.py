@@ -0,0 +1,353 @@
+#!/usr/bin/python3
+'''
+GIMBAL FRAMING
+SPLITS THE SERIAL STREAM INTO TEXT PACKETS AND BINARY FRAMES
+
+Firmware v2.4 can send DATA packets as binary frames (see SETBN in
+code/README.md): a 0 byte, the COBS encoding of a DataFrame struct and
+its CRC-16/XMODEM, and another 0 byte. Text packets never contain a 0
+byte, so both kinds share one stream.
+
+PacketParser turns raw chunks into packets. Lines are split in C with
+bytes.split(), the header is looked up as bytes, and DATA numbers are
+parsed straight from bytes; only the rare non-DATA lines are decoded.
+
+Organization: Davis Drone Club
+'''
+
+import binascii
+import struct
+from typing import Dict, Iterable, List, Text, Tuple
+
+#Frame type byte of a binary DATA packet
+DATA_FRAME_TYPE = 0x01
+
+#DataFrame struct of code.ino: type, angle, loop duration, output, time
+#(AVR int is 16 bit, double is 32 bit)
+DATA_FRAME = struct.Struct('<BfhfI')
+CRC = struct.Struct('<H')
+
+#Firmware version that introduced binary DATA packets
+BINARY_VERSION = (2, 4)
+
+#Lines without a header that the firmware prints -> header they are passed on
+#with, e.g. after every TUNEx (processTune() in functions.ino); counted as
+#'messages', not rejected
+FIRMWARE_MESSAGES = {b'TUNING UPDATE RECEIVED': 'TUNE'}
+
+#Counters of PacketParser that count rejected lines and frames
+REJECTED_COUNTERS = ('decode_errors', 'unknown', 'malformed', 'bad_frames')
+
+
+def crc16(data: bytes) -> int:
+    """
+    Returns the CRC-16/XMODEM of data, as computed by crc16() in communication.ino
+    """
+    return binascii.crc_hqx(data, 0)
+
+
+def cobs_encode(data: bytes) -> bytes:
+    """
+    COBS encodes data so that the result contains no 0 bytes
+    """
+    out = bytearray()
+    for block in bytes(data).split(b'\x00'):
+        while len(block) >= 0xFE:
+            out.append(0xFF)
+            out += block[:0xFE]
+            block = block[0xFE:]
+        out.append(len(block) + 1)
+        out += block
+    return bytes(out)
+
+
+def cobs_decode(data: bytes) -> bytes:
+    """
+    Reverses cobs_encode()
+
+    Raises:
+        ValueError: If data is not valid COBS
+    """
+    out = bytearray()
+    index = 0
+    length = len(data)
+    while index < length:
+        code = data[index]
+        end = index + code
+        if code == 0 or end > length:
+            raise ValueError('Invalid COBS data')
+        out += data[index + 1:end]
+        index = end
+        if code < 0xFF and index < length:
+            out.append(0)
+    return bytes(out)
+
+
+def encode_data_frame(angle: float, loop_duration: int, output: float, curr_time: int) -> bytes:
+    """
+    Builds a binary DATA packet exactly like printDataBinary(), delimiters included
+    """
+    payload = DATA_FRAME.pack(DATA_FRAME_TYPE, angle, loop_duration, output, curr_time)
+    return b'\x00' + cobs_encode(payload + CRC.pack(crc16(payload))) + b'\x00'
+
+
+def decode_data_frames(frames: List[bytes]) -> Tuple[List[Tuple[float, int, float, int]], int]:
+    """
+    Decodes many binary DATA frames at once.
+
+    A DataFrame and its CRC are shorter than 254 bytes, so a valid frame is
+    exactly one byte longer and COBS decoding it only means zeroing the
+    code bytes in place, not rebuilding it block by block as cobs_decode()
+    does. The payloads of all valid frames are joined and unpacked with a
+    single struct.iter_unpack() call.
+
+    Args:
+        frames (list): frames without their 0 delimiters, as from StreamSplitter
+
+    Returns:
+        (list, int): (angle, loop duration, output, time) per valid frame, and
+            the number of frames rejected for bad COBS, length, type or CRC
+    """
+    payloads = bytearray()
+    rejected = 0
+    size = DATA_FRAME.size
+    length = size + CRC.size + 1
+    for frame in frames:
+        if len(frame) != length:
+            rejected += 1
+            continue
+        payload = bytearray(frame)
+        index = 0
+        while index < length:
+            code = payload[index]
+            if code == 0:
+                break
+            payload[index] = 0
+            index += code
+        if (index != length or payload[1] != DATA_FRAME_TYPE
+                or crc16(payload[1:size + 1]) != payload[size + 1] | payload[size + 2] << 8):
+            rejected += 1
+            continue
+        payloads += payload[1:size + 1]
+    return [sample[1:] for sample in DATA_FRAME.iter_unpack(payloads)], rejected
+
+
+def format_data(sample: Tuple[float, int, float, int]) -> Text:
+    """
+    Formats a decoded sample as the equivalent text packet, like printData()
+    """
+    return 'DATA;{:.2f},{},{:.2f},{}'.format(*sample)
+
+
+def parse_data(packet: Text) -> Tuple[float, int, float, int]:
+    """
+    Parses a text DATA packet into (angle, loop duration, output, time)
+
+    Raises:
+        ValueError: If the packet is malformed
+    """
+    angle, loop_duration, output, curr_time = packet.split(';', 1)[1].split(',')
+    return float(angle), int(loop_duration), float(output), int(curr_time)
+
+
+def parse_data_bytes(payload: bytes) -> Tuple[float, int, float, int]:
+    """
+    Parses the payload of a text DATA packet, b'1.03,5555,0.00,8039',
+    into (angle, loop duration, output, time) without decoding it
+
+    Raises:
+        ValueError: If the payload is malformed
+    """
+    angle, loop_duration, output, curr_time = payload.split(b',')
+    return float(angle), int(loop_duration), float(output), int(curr_time)
+
+
+class StreamSplitter:
+    """Splits a mixed byte stream into text lines and binary frames.
+
+    Bytes are fed in chunks of any size. Incomplete lines and frames are
+    kept until the rest arrives.
+    """
+
+    def __init__(self):
+        self._buf = bytearray()
+
+    def reset(self):
+        """
+        Drops an incomplete line or frame, e.g. after the port was reopened
+        """
+        self._buf.clear()
+
+    def feed(self, chunk: bytes) -> Tuple[List[bytes], List[bytes]]:
+        """
+        Adds a chunk and returns everything completed by it.
+
+        Returns:
+            (list, list): text lines without line ending, and binary frames
+                without their 0 delimiters
+        """
+        buf = self._buf
+        buf += chunk
+        lines = []
+        frames = []
+        if 0 not in buf:
+            end = buf.rfind(b'\n')
+            if end >= 0:
+                lines = bytes(buf[:end]).replace(b'\r\n', b'\n').rstrip(b'\r').split(b'\n')
+                del buf[:end + 1]
+            return lines, frames
+        pos = 0
+        length = len(buf)
+        while pos < length:
+            if buf[pos] == 0:
+                end = buf.find(b'\x00', pos + 1)
+                if end < 0:
+                    break
+                if end == pos + 1:
+                    #Two 0 bytes in a row: the first one closed a frame that
+                    #started before we were listening, the second opens the next
+                    pos = end
+                    continue
+                frames.append(bytes(buf[pos + 1:end]))
+                pos = end + 1
+            else:
+                end = buf.find(b'\n', pos)
+                zero = buf.find(b'\x00', pos)
+                if zero >= 0 and (end < 0 or zero < end):
+                    #A frame cut into a text line, keep the fragment as a line
+                    lines.append(bytes(buf[pos:zero]))
+                    pos = zero
+                elif end >= 0:
+                    lines.append(bytes(buf[pos:end].rstrip(b'\r')))
+                    pos = end + 1
+                else:
+                    break
+        del buf[:pos]
+        return lines, frames
+
+
+class PacketParser:
+    """Incremental parser from raw serial chunks to packets.
+
+    DATA packets, text or binary, come out as (angle, loop duration,
+    output, time) tuples, all other packets as str without line ending.
+    Lines that cannot be used are counted, never raised.
+
+    Attributes:
+        counters: number of 'lines' and 'frames' seen, and of lines and
+            frames rejected as 'decode_errors' (not UTF-8), 'unknown'
+            (unknown header), 'malformed' (bad DATA fields) and 'bad_frames'
+            (bad COBS, length, type or CRC), and of known header-less
+            'messages', see FIRMWARE_MESSAGES; these come out as packets
+            too if their header is accepted
+    """
+
+    def __init__(self, headers: Iterable[Text], delim: Text = ';'):
+        """
+        Args:
+            headers (iterable): headers to accept, e.g. ['DATA', 'WARN']
+            delim (str, optional): header delimiter. Defaults to ';'.
+        """
+        self._splitter = StreamSplitter()
+        self._headers = {header.encode('utf-8'): header for header in headers}
+        self._delim = delim.encode('utf-8')
+        self._data_prefix = b'DATA' + self._delim if 'DATA' in self._headers.values() else None
+        self.counters = {'lines': 0, 'frames': 0, 'decode_errors': 0, 'unknown': 0,
+                         'malformed': 0, 'bad_frames': 0, 'messages': 0}
+
+    def feed(self, chunk: bytes) -> List[Tuple[Text, object]]:
+        """
+        Adds a chunk and returns the packets completed by it.
+
+        Returns:
+            list: (header, packet), in arrival order for each header
+        """
+        return self.parse(*self._splitter.feed(chunk))
+
+    def parse(self, lines: List[bytes], frames: List[bytes]) -> List[Tuple[Text, object]]:
+        """
+        Parses lines and frames returned by split(), see feed()
+        """
+        payloads, packets = self.sort_lines(lines)
+        counters = self.counters
+        for payload in payloads:
+            try:
+                packets.append(('DATA', parse_data_bytes(payload)))
+            except ValueError:
+                counters['malformed'] += 1
+        if frames:
+            packets.extend(('DATA', sample) for sample in self.decode_frames(frames))
+        return packets
+
+    def reset(self):
+        """
+        Drops an incomplete line or frame, keeping the counters
+        """
+        self._splitter.reset()
+
+    def split(self, chunk: bytes) -> Tuple[List[bytes], List[bytes]]:
+        """
+        Adds a chunk and returns the lines and binary frames completed by it,
+        see StreamSplitter.feed()
+        """
+        return self._splitter.feed(chunk)
+
+    def sort_lines(self, lines: List[bytes]) -> Tuple[List[bytes], List[Tuple[Text, Text]]]:
+        """
+        Separates text DATA packets from all other packets, without parsing them.
+
+        Returns:
+            (list, list): payloads of the DATA lines, e.g. b'1.03,5555,0.00,8039',
+                and (header, str) of the other lines
+        """
+        packets = []
+        counters = self.counters
+        headers = self._headers
+        delim = self._delim
+        data_prefix = self._data_prefix
+        if data_prefix is None:
+            payloads = []
+            others = lines
+        else:
+            skip = len(data_prefix)
+            payloads = [line[skip:] for line in lines if line.startswith(data_prefix)]
+            others = [line for line in lines if not line.startswith(data_prefix)]
+        for line in others:
+            head, _, payload = line.partition(delim)
+            header = headers.get(head.strip())
+            if header is None:
+                message = FIRMWARE_MESSAGES.get(line.strip())
+                if message is not None:
+                    counters['messages'] += 1
+                    if message in headers.values():
+                        packets.append((message, line.decode('utf-8').strip()))
+                    continue
+                try:
+                    head.decode('utf-8')
+                    counters['unknown'] += 1
+                except UnicodeDecodeError:
+                    counters['decode_errors'] += 1
+            elif header == 'DATA':
+                payloads.append(payload)
+            else:
+                try:
+                    packets.append((header, line.decode('utf-8').strip()))
+                except UnicodeDecodeError:
+                    counters['decode_errors'] += 1
+        counters['lines'] += len(lines)
+        return payloads, packets
+
+    def decode_frames(self, frames: List[bytes]) -> List[Tuple[float, int, float, int]]:
+        """
+        Decodes binary DATA frames, counting the rejected ones
+        """
+        samples, rejected = decode_data_frames(frames)
+        self.counters['frames'] += len(frames)
+        self.counters['bad_frames'] += rejected
+        return samples
+
+    def stats(self) -> Dict[Text, int]:
+        """
+        Returns a copy of the counters
+        """
+        return dict(self.counters)
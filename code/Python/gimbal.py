@@ -8,128 +8,191 @@ Author: Nicholas Chan (ngchan@ucdavis.edu)
 Date: July 2018
 '''
 
-import logging
-from logging.handlers import RotatingFileHandler
+import asyncio
+import concurrent.futures
+import os
+import queue
 import serial
-from typing import Union, Text
+import threading
+from collections import deque
+from typing import Dict, Iterable, List, Mapping, NamedTuple, Optional, Tuple, Union, Text
 import time
 
-class Gimbal:
-    """Functions for communicating with Gimbal 2.0.
+try:
+    import termios
+except ImportError:
+    #Windows
+    termios = None
+
+from coalescer import CommandCoalescer
+from clocksync import ClockSync
+import framing
+import logs
+from metrics import Metrics
+from monitor import StreamMonitor
+from telemetry import BatchParser, DATA_FIELDS, SharedTelemetryRing, TelemetryRing
+
+#Chunks with at least this many lines and frames are parsed with NumPy, see Gimbal._dispatch()
+BATCH_LINES = 32
+
+#Shortest time between two reads of the reader thread, see Gimbal._read_loop()
+READ_INTERVAL = 0.001
+
+#Seconds a timed out or cancelled request still claims its late reply, see request()
+REPLY_GRACE = 1.0
+
+#Bytes the Nano buffers until checkSerial() takes them, one per control loop;
+#request() keeps at most this many bytes of requests unanswered or unread
+RX_BUFFER = 64
+
+#Seconds per firmware control loop (LOOP_PERIOD_US in code.ino)
+LOOP_PERIOD = 5555e-6
+
+#Seconds taken by recent connects, from opening the port to the DEVN reply
+connect_times = deque(maxlen=1000)
+
+#Commands changing a GimbalConfig field -> the field and the decimals EEPR prints it with
+CONFIG_SETTERS = {"TUNEP": ('kp', 4), "TUNEI": ('ki', 4), "TUNED": ('kd', 4),
+                  "SETDB": ('deadband', 2)}
+
+#Commands answered by TUNING UPDATE RECEIVED, queued under the header TUNE
+TUNE_HEADERS = frozenset(["TUNEP", "TUNEI", "TUNED"])
+
+#Commands after which a cached GimbalConfig is out of date
+CONFIG_INVALIDATORS = frozenset(CONFIG_SETTERS) | {"CALGY"}
+
+
+def percentile(values: Iterable[float], pct: float) -> float:
+    """
+    Returns the pct-th percentile of values, interpolating between samples
+
+    Raises:
+        ValueError: If values is empty
+    """
+    ordered = sorted(values)
+    if not ordered:
+        raise ValueError('No values')
+    rank = (len(ordered) - 1) * pct / 100.0
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def connect_time_percentiles(pcts: Iterable[float] = (50, 90, 99)) -> Dict[float, float]:
+    """
+    Returns percentiles of recent connect times in seconds, keyed by percentile
+
+    Example:
+        {50: 1.62, 90: 1.71, 99: 1.80}
+    """
+    if not connect_times:
+        return {}
+    return {pct: percentile(connect_times, pct) for pct in pcts}
+
+class GimbalConfig(NamedTuple):
+    """Values reported by the EEPR packet.
 
     Attributes:
-        arduino: serial.Serial object
-        data_delim: delimiter for parsing gimbal data
-        out_headers: valid data headers for writing to gimbal
-        in_headers: valid data headers for reading from gimbal
+        kp, ki, kd: PID gains
+        deadband: deadband in degrees
+        gyro_x, gyro_y, gyro_z: gyro calibration offsets
     """
-    
-    def __init__(self, port: Text, delim: Text= ';'):
+    kp: float
+    ki: float
+    kd: float
+    deadband: float
+    gyro_x: float
+    gyro_y: float
+    gyro_z: float
+
+    @classmethod
+    def from_packet(cls, packet: Text) -> 'GimbalConfig':
         """
-        Initializes gimbal class and connects to gimbal
+        Parses an EEPR packet, e.g. 'EEPR;0.1000,3.0000,0.0015,2.00,0.12,-0.40,0.03'
 
-        Args:
-            port (str): COM port of gimbal.
-            delim (str, optional): common data delimiter. Defaults to ';'.
-            
         Raises:
-            PermissionError: If COM port permission is denied or COM port open elsewhere.
-            FileNotFoundError: If COM port could not be found.
-            TimeoutError: If COM port times out.
-            Exception: All other serial related errors.
-        """
-        self.out_headers = ["TUNEP", "TUNEI", "TUNED", "SETSP", "SETDB",
-                            "SETDR", "SETPT", "SETEN", "SETPO", "CALGY",
-                            "GETEP", "GETVE", "GETDN"]
-        
-        self.in_headers = ["WARN", "LOOP", "DATA", "EEPR", "VERS", "DEVN"]
-        self.data_delim = delim
-        self._init_log()
-        self._connect(port)
-        time.sleep(3)
-        self.send("GETDN",0)
-        try:
-            name = self.read("DEVN").strip().split(';')
-            if name[1] != "ddc-gimbal":
-                raise Exception("Not a gimbal!")
-        except Exception as e:
-            self.log.error(str(e))
-            raise Exception(str(e))
-        
-    def set_enable(self, value):
-        """
-        Enables or disables the gimbal
+            ValueError: If the packet does not hold seven numbers
         """
-        if value == 1 or value == 0:
-            self.send("SETEN", value)
-        else:
-            raise ValueError('Invalid value')
+        values = packet.split(';', 1)[-1].split(',')
+        if len(values) != len(cls._fields):
+            raise ValueError('Malformed EEPR packet: ' + packet)
+        return cls(*(float(value) for value in values))
 
-    def set_direction(self, value):
-        """
-        Sets direction of gimbal
-        """
-        if value == 1 or value == 0:
-            self.send("SETDR", value)
-        else:
-            raise ValueError('Invalid value')
 
-    def set_position(self, value):
-        """
-        Sets position of gimbal
-        """
-        self.send("SETPO", round(value))
-        
-    def close(self):
-        """
-        closes the com port
-        """
-        self.arduino.close()
-            
-    def read(self, header: Text):
-        """
-        Reads lines from the gimbal until desired header is found.
+def _same(a: float, b: float, digits: int) -> bool:
+    """
+    Returns True if a and b print the same with digits decimals, allowing for float error
+    """
+    return abs(a - b) <= 0.5 * 10 ** -digits + 1e-9
 
-        Returns:
-            *Return here*
 
-        Raises:
-            ValueError: If desired header is invalid
-        """
-        if header not in self.in_headers:
-            raise ValueError('Invalid header')
-        try:
-            data = self.arduino.readline()
-            data = data.decode('utf-8').strip()
+class _GimbalBase:
+    """Packet formatting, port setup and logging shared by Gimbal and AsyncGimbal.
 
-            for i in range(50):
-                if data == '':
-                    raise TimeoutError('Reached end of buffer')
-                elif header not in data:
-                    time.sleep(0.05)
-                    data = self.arduino.readline()
-                    data = data.decode('utf-8').strip()
-                else:
-                    self.log.info('RECV:' + data)
-                    return data
-            raise TimeoutError('Not found in last 10 messages')
-        except TimeoutError as e:
-            raise e
-        except Exception as e:
-            print('err: ' + str(e))
+    Attributes:
+        port: COM port of gimbal
+        data_delim: delimiter for parsing gimbal data
+        out_headers: valid data headers for writing to gimbal
+        in_headers: valid data headers for reading from gimbal
+        binary: True once the gimbal sends DATA packets as binary frames
+        reset_on_open: False to open the port without resetting the Nano, see _attach_port()
+        device_name: name in the DEVN reply, None until connected
+        log: logger of this gimbal, see logs.get_logger()
+        metrics: Metrics registry of this gimbal; times in seconds, firmware values in us:
+            histograms write_latency, rtt.<request header>, rx_interval and
+            rx_jitter (between received DATA chunks), loop_duration (DATA field)
+            and loop_overrun (LOOP value); counters loop_overruns, warn,
+            stream.<StreamMonitor.counters()> and the packet_counters() of the parser,
+            whose error counters count framing errors only
+        clock: ClockSync mapping the time field of DATA packets to time.monotonic()
+        stream: StreamMonitor checking DATA packets for gaps, duplicates and bursts
+    """
+
+    def __init__(self, port: Text, delim: Text = ';'):
+        self.port = port
+        self.out_headers = ["TUNEP", "TUNEI", "TUNED", "SETSP", "SETDB",
+                            "SETDR", "SETPT", "SETEN", "SETPO", "CALGY",
+                            "GETEP", "GETVE", "GETDN", "SETBN"]
         
+        self.in_headers = ["WARN", "LOOP", "DATA", "EEPR", "VERS", "DEVN", "TUNE"]
+        self.data_delim = delim
+        self.binary = False
+        self.reset_on_open = True
+        self.device_name = None
+        self._parser = framing.PacketParser(self.in_headers, delim)
+        self._pending = {header: deque() for header in self.in_headers}
+        self._pending_lock = threading.Lock()
+        self._stale_replies = 0
+        self._request_bytes = 0
+        self._rx_clear = 0.0
+        self._written = 0
+        self._backlog = deque()
+        self._flow_lock = threading.Lock()
+        self._config = None
+        self._config_lock = threading.Lock()
+        self.config_version = 0
+        self._last_rx = None
+        self._last_rx_interval = None
+        self.metrics = Metrics()
+        self.metrics.watch(self.packet_counters)
+        self.clock = ClockSync()
+        self.stream = StreamMonitor(rejected=self._rejected_lines)
+        self.metrics.watch(lambda: {'stream.' + name: count for name, count in self.stream.counters().items()})
+        self._init_log()
 
-    def send(self, header: Text, data: Union[int, float]):
+    def _encode(self, header: Text, data: Union[int, float]) -> bytes:
         """
-        Formats and sends a data packet to the gimbal.
+        Validates and formats a data packet.
 
         Args:
             header (str): the header value as a string
             data (float/int): data as a float or an int
 
+        Returns:
+            bytes: the packet, ready to be written to the port
+
         Raises:
             ValueError: If header or data is invalid.
-            TimeoutError: If serial timeout exceeded.
         """
         if not (isinstance(data, float) or isinstance(data, int)):
             err_msg = 'Gimbal.send(): Only float or int allowed'
@@ -143,25 +206,118 @@ class Gimbal:
             err_msg = 'Gimbal.send(): Invalid header'
             self.log.error(err_msg)
             raise ValueError(err_msg)
+        if header in CONFIG_INVALIDATORS:
+            self._invalidate_config()
         msg = header + self.data_delim + str(data) + '\n'
-        
-        try:
-            self.arduino.write(msg.encode('utf-8'))
-        except serial.SerialTimeoutException as e:
-            err_msg = "SerialTimeout: " + str(e)
-            self.log.error(err_msg)
-            raise TimeoutError(err_msg)
-        else:
-            self.log.info('SENT:' + msg.strip())
-            
-    def _connect(self, port: Text, timeout: float = .5, baude: int = 115200):
+        return msg.encode('utf-8')
+
+    def _invalidate_config(self):
         """
-        Connects to the gimbal serial port.
+        Drops the cached config and bumps config_version
+        """
+        with self._config_lock:
+            self.config_version += 1
+            self._config = None
 
-        Args:
-            port (str): the serial port name.
-            timeout (float, optional): timeout duration Defaults to 5.0.
-            baude (int, optional): serial port speed. Defaults to 115200.
+    def _store_config(self, packet: Text, version: int) -> GimbalConfig:
+        """
+        Parses an EEPR reply to a GETEP sent at config_version == version.
+        It is cached unless a config command was sent since.
+        """
+        config = GimbalConfig.from_packet(packet)
+        with self._config_lock:
+            if self.config_version == version:
+                self._config = config
+        return config
+
+    def _config_changes(self, current: GimbalConfig,
+                        target: Union[GimbalConfig, Mapping[Text, float]]) -> List[Tuple[Text, float]]:
+        """
+        Returns the (header, value) commands turning current into target.
+        Gyro calibration cannot be set and is ignored.
+
+        Raises:
+            ValueError: If target names a field GimbalConfig does not have
+        """
+        fields = target._asdict() if isinstance(target, GimbalConfig) else dict(target)
+        unknown = set(fields) - set(GimbalConfig._fields)
+        if unknown:
+            raise ValueError('Unknown config fields: ' + ', '.join(sorted(unknown)))
+        changes = []
+        for header, (name, digits) in CONFIG_SETTERS.items():
+            if name in fields and not _same(float(fields[name]), getattr(current, name), digits):
+                changes.append((header, float(fields[name])))
+        return changes
+
+    def _check_config(self, config: GimbalConfig, changes: List[Tuple[Text, float]]):
+        """
+        Raises an Exception unless config holds every value of changes
+        """
+        wrong = ['{} {} != {}'.format(name, getattr(config, name), value)
+                 for header, value in changes
+                 for name, digits in [CONFIG_SETTERS[header]]
+                 if not _same(getattr(config, name), value, digits)]
+        if wrong:
+            msg = 'Config not applied: ' + ', '.join(wrong)
+            self.log.error(msg)
+            raise Exception(msg)
+
+    def _check_bool(self, value):
+        """
+        Raises ValueError unless value is 0 or 1
+        """
+        if not (value == 1 or value == 0):
+            raise ValueError('Invalid value')
+
+    def _record_connect(self, start: float):
+        """
+        Stores the time taken by a connect started at time.monotonic() == start
+        """
+        self.connect_time = time.monotonic() - start
+        connect_times.append(self.connect_time)
+        self.log.info("Gimbal ready after " + str(round(self.connect_time, 3)) + "s")
+
+    def _packets(self, chunk: bytes) -> List[Tuple[Text, object]]:
+        """
+        Splits received bytes into packets.
+
+        DATA packets, text or binary, are returned as (angle, loop duration,
+        output, time) tuples, all others as str. Lines that cannot be used
+        are dropped and counted, see packet_counters().
+
+        Returns:
+            list: (header, packet) tuples
+        """
+        return self._parser.feed(chunk)
+
+    def _as_text(self, packet) -> Text:
+        """
+        Returns a packet as text, formatting DATA samples like printData()
+        """
+        if isinstance(packet, tuple):
+            return framing.format_data(packet)
+        return packet
+
+    def _supports_binary(self, version: List[Text]) -> bool:
+        """
+        Returns True if firmware version [major, minor] can send binary DATA packets
+        """
+        return tuple(int(part) for part in version) >= framing.BINARY_VERSION
+
+    def _check_name(self, packet: Text):
+        """
+        Raises an Exception unless packet is the DEVN reply of a gimbal,
+        else stores the name as device_name
+        """
+        name = packet.strip().split(self.data_delim)
+        if name[1] != "ddc-gimbal":
+            raise Exception("Not a gimbal!")
+        self.device_name = name[1]
+
+    def _open_port(self, port: Text, timeout: float, baude: int,
+                   write_timeout: float = 0) -> serial.Serial:
+        """
+        Opens the gimbal serial port, translating serial errors.
 
         Raises:
             PermissionError: If COM port permission is denied, COM port open elsewhere.
@@ -170,7 +326,10 @@ class Gimbal:
             Exception: All other serial related errors.
         """
         try:
-            self.arduino = serial.Serial(port,baude, timeout=timeout, write_timeout=0)
+            if self.reset_on_open:
+                arduino = serial.Serial(port,baude, timeout=timeout, write_timeout=write_timeout)
+            else:
+                arduino = self._attach_port(port, timeout, baude, write_timeout)
         except serial.SerialException as e:
             if "PermissionError" in str(e):
                 msg = "COM port may be open elsewhere: "+str(e)
@@ -194,29 +353,1433 @@ class Gimbal:
             raise Exception(msg)
         else:
             self.log.info("Connected on " + port)
-        
-    def _init_log(self, filename: Text = 'gimbal.log',
-                formatstr: Text = '%(asctime)s:%(levelname)s:%(message)s'):
+            return arduino
+
+    def _attach_port(self, port: Text, timeout: float, baude: int,
+                     write_timeout: float) -> serial.Serial:
+        """
+        Opens the port without the DTR edge that resets the Nano.
+
+        On Windows DTR and RTS are kept deasserted from the start. On Linux
+        and macOS the driver asserts both on open and, with HUPCL set (the
+        default), deasserts them on close, so the open after every close
+        resets the board. HUPCL is cleared here: the first attach after
+        plugging in may still reset the board, later ones do not. Run
+        `stty -F <port> -hupcl` once to avoid that reset too.
+
+        A newline is sent first, ending any line a previous tool left
+        half-written in the firmware's input buffer.
+        """
+        arduino = serial.Serial()
+        arduino.port = port
+        arduino.baudrate = baude
+        arduino.timeout = timeout
+        arduino.write_timeout = write_timeout
+        if termios is None:
+            arduino.dtr = False
+            arduino.rts = False
+        arduino.open()
+        if termios is not None:
+            attributes = termios.tcgetattr(arduino.fd)
+            attributes[2] &= ~termios.HUPCL
+            termios.tcsetattr(arduino.fd, termios.TCSANOW, attributes)
+        arduino.write(b'\n')
+        return arduino
+
+    def _init_log(self):
         """
         Initializes the gimbal logger
 
+        The logger is keyed by port and shares one queued file handler with
+        all other gimbals in the process; use logs.configure() to change the
+        log file, format or sampling.
+        """
+        self.log = logs.get_logger(self.port)
+        self._log_open = True
+
+    def _close_log(self):
+        """
+        Releases the gimbal logger, at most once
+        """
+        if self._log_open:
+            self._log_open = False
+            logs.release_logger(self.port)
+
+    def packet_counters(self) -> Dict[Text, int]:
+        """
+        Returns the number of lines and frames received and rejected, see
+        framing.PacketParser, and of late replies dropped as 'stale_replies'.
+        Known firmware messages such as TUNING UPDATE RECEIVED are counted
+        as 'messages', not as errors, and queued under the header TUNE.
+        """
+        counters = self._parser.stats()
+        counters['stale_replies'] = self._stale_replies
+        return counters
+
+    def _rejected_lines(self) -> int:
+        """
+        Returns the number of lines and frames the parser could not use
+        """
+        counters = self._parser.stats()
+        return sum(counters[name] for name in framing.REJECTED_COUNTERS)
+
+    def _add_request(self, reply_header: Text, future, timeout: float, header: Text = ''):
+        """
+        Registers a future to be resolved by the next unclaimed reply_header packet
+
         Args:
-            filename (str): name of log file (default 'gimbal.log')
-            formatstr (str): string format of log entries (default time:level:message)
+            header (str, optional): header of the request, names its rtt metric
+
+        Raises:
+            ValueError: If reply_header is invalid
         """
-        log_format = logging.Formatter(formatstr)
-        log_file   = filename
-        log_handler= RotatingFileHandler(log_file, mode='a', maxBytes=5*1024*1024, backupCount=1,
-                                         encoding=None, delay=0)
-        log_handler.setFormatter(log_format)
-        log_handler.setLevel(logging.DEBUG)
+        if reply_header not in self._pending:
+            raise ValueError('Invalid header')
+        now = time.monotonic()
+        with self._pending_lock:
+            self._pending[reply_header].append((now + timeout, future, header or reply_header, now))
 
-        self.log = logging.getLogger('root')
-        self.log.setLevel(logging.DEBUG)
-        self.log.addHandler(log_handler)
+    def _remove_request(self, reply_header: Text, future):
+        """
+        Forgets a request whose command could not be sent
+        """
+        with self._pending_lock:
+            pending = self._pending[reply_header]
+            for entry in list(pending):
+                if entry[1] is future:
+                    pending.remove(entry)
 
-    def get_version(self):
-        self.send("GETVE", 0)
-        packet = self.read("VERS").split(';')
-        version = packet[1].split(',')
-        return version
+    def _resolve(self, header: Text, packets: list) -> list:
+        """
+        Hands packets to the pending requests of header, oldest request first.
+
+        A request that timed out or was cancelled keeps its place for
+        REPLY_GRACE seconds, so that its late reply is dropped instead of
+        answering the next request.
+
+        Returns:
+            list: packets no request was waiting for
+        """
+        pending = self._pending[header]
+        if not pending:
+            return packets
+        now = time.monotonic()
+        results = []
+        late = []
+        with self._pending_lock:
+            self._purge(pending, now)
+            index = 0
+            while index < len(packets) and pending:
+                deadline, future, request, sent = pending.popleft()
+                if future.done() or now > deadline:
+                    self._stale_replies += 1
+                    #Not expired yet if the reader was busy past the deadline
+                    late.append(future)
+                else:
+                    results.append((future, self._as_text(packets[index]), request, sent))
+                index += 1
+        for future in late:
+            self._settle(future, exception=TimeoutError('No ' + header + ' reply before the deadline'))
+        for future, data, request, sent in results:
+            self.metrics.observe('rtt.' + request, now - sent)
+            if logs.keep(logs.category('RECV:' + data)):
+                self.log.info('RECV:' + data, extra=logs.KEPT)
+            self._settle(future, result=data)
+        return packets[index:]
+
+    def _observe_data(self, stamp: float, loop_durations):
+        """
+        Records the metrics of DATA samples received at stamp
+
+        Args:
+            loop_durations (int/ndarray): loop duration field of one or many samples
+        """
+        if self._last_rx is not None and stamp != self._last_rx:
+            interval = stamp - self._last_rx
+            self.metrics.observe('rx_interval', interval)
+            if self._last_rx_interval is not None:
+                self.metrics.observe('rx_jitter', abs(interval - self._last_rx_interval))
+            self._last_rx_interval = interval
+        self._last_rx = stamp
+        if isinstance(loop_durations, int):
+            self.metrics.observe('loop_duration', loop_durations)
+        else:
+            self.metrics.observe_many('loop_duration', loop_durations)
+
+    def _observe(self, header: Text, packets: list):
+        """
+        Records the metrics of LOOP and WARN packets
+        """
+        if header == 'LOOP':
+            self.metrics.count('loop_overruns', len(packets))
+            for packet in packets:
+                try:
+                    self.metrics.observe('loop_overrun', float(packet.split(self.data_delim, 1)[1]))
+                except (IndexError, ValueError):
+                    pass
+        elif header == 'WARN':
+            self.metrics.count('warn', len(packets))
+
+    def _expire_requests(self):
+        """
+        Fails every request whose deadline has passed with TimeoutError
+        """
+        now = time.monotonic()
+        expired = []
+        with self._pending_lock:
+            for header, pending in self._pending.items():
+                expired += [(header, future) for deadline, future, _, _ in pending
+                            if now > deadline and not future.done()]
+                self._purge(pending, now)
+        with self._flow_lock:
+            expired += [(entry[2], entry[5]) for entry in self._backlog
+                        if now > entry[3] and not entry[5].done()]
+        for header, future in expired:
+            self._settle(future, exception=TimeoutError('No ' + header + ' reply before the deadline'))
+
+    def _fail_requests(self, error: Exception):
+        """
+        Fails every pending and queued request, e.g. when the port closes
+        """
+        with self._flow_lock:
+            queued = [entry[5] for entry in self._backlog]
+            self._backlog.clear()
+        for future in queued:
+            self._settle(future, exception=error)
+        with self._pending_lock:
+            futures = [entry[1] for pending in self._pending.values() for entry in pending]
+            for pending in self._pending.values():
+                pending.clear()
+        for future in futures:
+            self._settle(future, exception=error)
+
+    def _wrote(self, size: int):
+        """
+        Notes size bytes written to the port, which the firmware takes one
+        per control loop
+        """
+        with self._flow_lock:
+            self._written += size
+            self._rx_clear = max(self._rx_clear, time.monotonic()) + size * LOOP_PERIOD
+
+    def _request_done(self, size: int, read: int, future):
+        """
+        Uncounts a request of size bytes once its future is done. A reply
+        shows that the firmware has read the first read bytes written, so
+        only those written since can still be in its buffer.
+        """
+        if not future.cancelled() and future.exception() is None:
+            with self._flow_lock:
+                self._rx_clear = min(self._rx_clear,
+                                     time.monotonic() + (self._written - read) * LOOP_PERIOD)
+        self._release_request(size)
+
+    def _fits(self, size: int) -> bool:
+        """
+        Returns whether a request of size bytes may be sent now, see RX_BUFFER.
+
+        The bytes still in the Nano's buffer are those of unanswered
+        requests, or, if more, of everything written that the firmware
+        cannot have read yet, e.g. set commands, which have no reply.
+        Must be called with the flow lock held on Gimbal.
+        """
+        unread = max(self._request_bytes, (self._rx_clear - time.monotonic()) / LOOP_PERIOD)
+        return unread <= 0 or unread + size <= RX_BUFFER
+
+    def _rx_delay(self, size: int) -> float:
+        """
+        Returns the seconds until the firmware has read enough of what was
+        written for a request of size bytes to fit, if no request is unanswered
+        """
+        wait = self._rx_clear - time.monotonic() - max(RX_BUFFER - size, 0) * LOOP_PERIOD
+        return max(wait, 0.0) + 0.001
+
+    def _purge(self, pending: deque, now: float):
+        """
+        Drops requests past their grace period. Must be called with the lock held.
+        """
+        if any(now > entry[0] + REPLY_GRACE for entry in pending):
+            kept = [entry for entry in pending if now <= entry[0] + REPLY_GRACE]
+            pending.clear()
+            pending.extend(kept)
+
+    def _settle(self, future, result=None, exception: Optional[Exception] = None):
+        """
+        Completes a future unless it was cancelled or completed meanwhile
+        """
+        if future.done():
+            return
+        try:
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+        except (concurrent.futures.InvalidStateError, asyncio.InvalidStateError):
+            pass
+
+    def log_counters(self) -> Dict[Text, int]:
+        """
+        Returns the number of log records sampled out and dropped
+        """
+        return logs.counters()
+
+
+class Gimbal(_GimbalBase):
+    """Functions for communicating with Gimbal 2.0.
+
+    Attributes:
+        arduino: serial.Serial object
+        data_delim: delimiter for parsing gimbal data
+        out_headers: valid data headers for writing to gimbal
+        in_headers: valid data headers for reading from gimbal
+        queue_size: number of unread packets kept per in_header
+        coalesce_headers: headers that may be sent through the coalescer
+        coalescer: CommandCoalescer object, or None when coalescing is off
+        connect_time: seconds from opening the port to the DEVN reply
+        telemetry: TelemetryRing filled with every DATA sample, or None;
+            a SharedTelemetryRing when telemetry_name is given
+        metrics: as _GimbalBase, plus the counter reads (chunks read by the
+            reader thread, see _read_loop())
+    """
+    
+    def __init__(self, port: Text, delim: Text= ';', queue_size: int = 100,
+                 coalesce_rate: Optional[float] = None, connect_timeout: float = 5.0,
+                 probe_interval: float = 0.25, binary: bool = True,
+                 telemetry_size: int = 4096, telemetry_name: Optional[Text] = None,
+                 reset: bool = True):
+        """
+        Initializes gimbal class and connects to gimbal
+
+        A reader thread owns the serial port once connected. Every line it
+        receives is timestamped and placed in the queue of its header, where
+        it waits for read(). When a queue is full the oldest packet is dropped.
+
+        Args:
+            port (str): COM port of gimbal.
+            delim (str, optional): common data delimiter. Defaults to ';'.
+            queue_size (int, optional): unread packets kept per header. Defaults to 100.
+            coalesce_rate (float, optional): if given, set_position, set_setpoint
+                and set_deadband go through a CommandCoalescer flushing at most
+                this many times a second. Defaults to None.
+            connect_timeout (float, optional): seconds to wait for the gimbal to
+                answer GETDN after opening the port. Defaults to 5.0.
+            probe_interval (float, optional): seconds between GETDN probes. Defaults to 0.25.
+            binary (bool, optional): switch DATA packets to binary frames if the
+                firmware reports v2.4 or later. Defaults to True.
+            telemetry_size (int, optional): DATA samples kept in the telemetry
+                ring, 0 for no ring. Defaults to 4096.
+            telemetry_name (str, optional): publish the ring in shared memory
+                under this name, for SharedTelemetryRing.attach() in other
+                processes. Defaults to None.
+            reset (bool, optional): False to attach to a running gimbal
+                without resetting it; its RAM state, e.g. setpoint and
+                enable, is kept and it answers GETDN within milliseconds.
+                Defaults to True.
+            
+        Raises:
+            PermissionError: If COM port permission is denied or COM port open elsewhere.
+            FileNotFoundError: If COM port could not be found.
+            TimeoutError: If COM port times out.
+            Exception: All other serial related errors.
+        """
+        _GimbalBase.__init__(self, port, delim)
+        self.queue_size = queue_size
+        self._queues = {header: queue.Queue(queue_size) for header in self.in_headers}
+        self.coalesce_headers = ["SETPO", "SETSP", "SETDB"]
+        self.coalescer = None
+        self._parser = BatchParser(self.in_headers, delim)
+        self.reset_on_open = reset
+        if telemetry_size <= 0:
+            self.telemetry = None
+        elif telemetry_name is not None:
+            self.telemetry = SharedTelemetryRing(telemetry_size, telemetry_name)
+        else:
+            self.telemetry = TelemetryRing(telemetry_size)
+        start = time.monotonic()
+        try:
+            self._connect(port)
+        except Exception:
+            self._close_telemetry()
+            self._close_log()
+            raise
+        try:
+            self._handshake(connect_timeout, probe_interval, binary)
+        except Exception as e:
+            self.log.error(str(e))
+            self.close()
+            raise Exception(str(e))
+        self._record_connect(start)
+        if coalesce_rate is not None:
+            self.coalescer = CommandCoalescer(self.send, coalesce_rate)
+        
+    def set_enable(self, value):
+        """
+        Enables or disables the gimbal
+        """
+        self._check_bool(value)
+        self.send("SETEN", value)
+
+    def set_direction(self, value):
+        """
+        Sets direction of gimbal
+        """
+        self._check_bool(value)
+        self.send("SETDR", value)
+
+    def set_position(self, value):
+        """
+        Sets position of gimbal
+        """
+        self._send_set("SETPO", round(value))
+
+    def set_setpoint(self, value: float):
+        """
+        Sets the setpoint of the PID controller in degrees
+        """
+        self._send_set("SETSP", value)
+
+    def set_deadband(self, value: float):
+        """
+        Sets the deadband size in degrees
+        """
+        self._send_set("SETDB", value)
+
+    def set_kp(self, value: float):
+        """
+        Sets Kp of the PID controller, stored in EEPROM
+        """
+        self.send("TUNEP", value)
+
+    def set_ki(self, value: float):
+        """
+        Sets Ki of the PID controller, stored in EEPROM
+        """
+        self.send("TUNEI", value)
+
+    def set_kd(self, value: float):
+        """
+        Sets Kd of the PID controller, stored in EEPROM
+        """
+        self.send("TUNED", value)
+
+    def set_print(self, value):
+        """
+        Enables or disables DATA packets
+        """
+        self._check_bool(value)
+        self.send("SETPT", value)
+
+    def calibrate_gyro(self):
+        """
+        Recalibrates the gyro. The gimbal must be kept still.
+        """
+        self.send("CALGY", 0)
+        
+    def close(self):
+        """
+        Sends pending coalesced commands, stops the reader thread and closes the com port
+        """
+        if self.coalescer is not None:
+            self.coalescer.close()
+        if self.binary:
+            try:
+                self.send("SETBN", 0)
+            except Exception:
+                pass
+        self._stop_reader()
+        self._fail_requests(ConnectionError('Gimbal closed'))
+        self.arduino.close()
+        self._close_telemetry()
+        self._close_log()
+
+    def _close_telemetry(self):
+        """
+        Removes a shared telemetry ring so that no process can attach anymore
+        """
+        if isinstance(self.telemetry, SharedTelemetryRing):
+            self.telemetry.close()
+            
+    def read(self, header: Text, timeout: float = 2.0) -> Text:
+        """
+        Waits for the next packet with the desired header.
+
+        Args:
+            header (str): header of the packet, e.g. 'VERS'
+            timeout (float, optional): seconds to wait for the packet. Defaults to 2.0.
+
+        Returns:
+            str: the packet without line ending, e.g. 'VERS;2,3'
+
+        Raises:
+            ValueError: If desired header is invalid
+            TimeoutError: If no packet arrived before the deadline
+        """
+        return self.read_stamped(header, timeout)[1]
+
+    def read_stamped(self, header: Text, timeout: float = 2.0) -> Tuple[float, Text]:
+        """
+        Same as read(), but also returns the time the packet was received.
+
+        Returns:
+            (float, str): time.monotonic() at reception and the packet
+
+        Raises:
+            ValueError: If desired header is invalid
+            TimeoutError: If no packet arrived before the deadline
+        """
+        if header not in self.in_headers:
+            raise ValueError('Invalid header')
+        try:
+            stamp, data = self._queues[header].get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError('No ' + header + ' packet within ' + str(timeout) + 's')
+        data = self._as_text(data)
+        if logs.keep('RECV:' + header):
+            self.log.info('RECV:' + data, extra=logs.KEPT)
+        return stamp, data
+
+    def read_data(self, timeout: float = 2.0) -> Tuple[float, Tuple[float, int, float, int]]:
+        """
+        Waits for the next DATA packet and returns its values.
+
+        Works for text and binary DATA packets alike; neither is converted
+        to or from str.
+
+        Args:
+            timeout (float, optional): seconds to wait for the packet. Defaults to 2.0.
+
+        Returns:
+            (float, tuple): time.monotonic() at reception and
+                (angle, loop duration, output, time)
+
+        Raises:
+            TimeoutError: If no packet arrived before the deadline
+        """
+        try:
+            stamp, data = self._queues['DATA'].get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError('No DATA packet within ' + str(timeout) + 's')
+        return stamp, data
+
+    def _handshake(self, connect_timeout: float, probe_interval: float, binary: bool):
+        """
+        Waits for the gimbal to answer GETDN, then switches DATA packets to
+        binary frames if binary is set and the firmware supports them
+        """
+        self._probe(connect_timeout, probe_interval)
+        if binary and self._supports_binary(self.get_version()):
+            self.send("SETBN", 1)
+            self.binary = True
+
+    def _probe(self, connect_timeout: float, probe_interval: float):
+        """
+        Sends GETDN every probe_interval seconds until the gimbal answers.
+
+        The Nano resets when the port opens and ignores serial input until
+        setup() has finished, so the first probes usually go unanswered.
+        A gimbal attached with reset=False answers the first one.
+
+        Raises:
+            TimeoutError: If no DEVN reply arrived within connect_timeout
+            Exception: If the reply is not from a gimbal
+        """
+        deadline = time.monotonic() + connect_timeout
+        reply = self.request("GETDN", 0, "DEVN", connect_timeout)
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                packet = reply.result(max(min(probe_interval, remaining), 0))
+            except concurrent.futures.TimeoutError:
+                if time.monotonic() >= deadline:
+                    reply.cancel()
+                    raise TimeoutError('No DEVN reply within ' + str(connect_timeout) + 's')
+                #Probe again, the first DEVN reply answers the request
+                self.send("GETDN", 0)
+                continue
+            self._check_name(packet)
+            return
+
+    def _start_reader(self):
+        """
+        Starts the thread that reads from the serial port
+        """
+        self._reader_stop = threading.Event()
+        self._reader = threading.Thread(target=self._read_loop, name='gimbal-reader',
+                                        daemon=True)
+        self._reader.start()
+
+    def _stop_reader(self):
+        """
+        Stops the reader thread and waits for it, unless called from it
+        """
+        self._reader_stop.set()
+        cancel_read = getattr(self.arduino, 'cancel_read', None)
+        if cancel_read is not None:
+            try:
+                cancel_read()
+            except Exception:
+                pass
+        if self._reader is not threading.current_thread():
+            self._reader.join()
+
+    def _read_loop(self):
+        """
+        Reads from the serial port until the gimbal is closed.
+
+        Each wakeup costs more system calls than decoding a sample, so
+        after a chunk with DATA samples the next read is held back until
+        READ_INTERVAL has passed: a fast DATA stream is then handled a few
+        samples per chunk instead of one. Replies to requests are read at
+        once unless they follow DATA by less than READ_INTERVAL.
+        """
+        last = 0.0
+        samples = self.stream.samples
+        while not self._reader_stop.is_set():
+            if self.stream.samples != samples:
+                samples = self.stream.samples
+                wait = last + READ_INTERVAL - time.monotonic()
+                if wait > 0 and self._reader_stop.wait(wait):
+                    return
+            try:
+                chunk = self.arduino.read(self.arduino.in_waiting or 1)
+                if len(chunk) == 1:
+                    #Woken by the first byte; the rest of its packet is usually there
+                    chunk += self.arduino.read(self.arduino.in_waiting)
+            except Exception as e:
+                if not self._reader_stop.is_set():
+                    self._reader_failed(e)
+                return
+            last = time.monotonic()
+            if chunk:
+                self.metrics.count('reads')
+                self._dispatch(last, chunk)
+            if any(self._pending.values()):
+                self._expire_requests()
+
+    def _reader_failed(self, error: Exception):
+        """
+        Called on the reader thread when reading fails, before the thread
+        stops; fails all pending requests
+        """
+        self.log.error('Reader stopped: ' + str(error))
+        self._fail_requests(ConnectionError('Reader stopped: ' + str(error)))
+
+    def _dispatch(self, stamp: float, chunk: bytes):
+        """
+        Places every packet completed by chunk in the queue of its header,
+        and DATA samples in the telemetry ring.
+
+        A chunk of BATCH_LINES lines and frames or more, i.e. a backlog, has
+        its DATA samples decoded together (see telemetry.BatchParser); only the
+        newest queue_size of them are queued, as older ones would be
+        dropped anyway. Smaller chunks are cheaper to parse line by line.
+
+        Args:
+            stamp (float): time.monotonic() when the chunk was received
+            chunk (bytes): bytes read from the port
+        """
+        lines, frames = self._parser.split(chunk)
+        if len(lines) + len(frames) < BATCH_LINES:
+            last = None
+            for header, data in self._parser.parse(lines, frames):
+                if header == 'DATA':
+                    self._observe_data(stamp, data[1])
+                    self.stream.add(data[3], stamp)
+                    last = data
+                    if self.telemetry is not None:
+                        self.telemetry.append(stamp, *data)
+                else:
+                    self._observe(header, [data])
+                self._enqueue(header, stamp, [data])
+            if last is not None:
+                self.clock.update(last[3], stamp)
+            return
+        samples, packets = self._parser.parse_batch(lines, frames, stamp)
+        if len(samples):
+            self._observe_data(stamp, samples['loop_duration'])
+            self.stream.add_many(samples['time'], stamp)
+            self.clock.update(samples['time'][-1], stamp)
+            if self.telemetry is not None:
+                self.telemetry.extend(samples)
+            self._enqueue('DATA', stamp, samples[DATA_FIELDS][-self.queue_size:].tolist())
+        for header, data in packets:
+            self._observe(header, [data])
+            self._enqueue(header, stamp, [data])
+
+    def _enqueue(self, header: Text, stamp: float, packets: list):
+        """
+        Hands packets to pending requests, and puts the rest in the queue
+        of header, dropping the oldest when it is full
+        """
+        packets = self._resolve(header, packets)
+        packet_queue = self._queues[header]
+        for data in packets:
+            while True:
+                try:
+                    packet_queue.put_nowait((stamp, data))
+                    break
+                except queue.Full:
+                    try:
+                        packet_queue.get_nowait()
+                    except queue.Empty:
+                        pass
+
+    def send(self, header: Text, data: Union[int, float]):
+        """
+        Formats and sends a data packet to the gimbal.
+
+        Args:
+            header (str): the header value as a string
+            data (float/int): data as a float or an int
+
+        Raises:
+            ValueError: If header or data is invalid.
+            TimeoutError: If serial timeout exceeded.
+        """
+        msg = self._encode(header, data)
+        self._forget_coalesced(header)
+        
+        try:
+            start = time.perf_counter()
+            self.arduino.write(msg)
+            self.metrics.observe('write_latency', time.perf_counter() - start)
+            self._wrote(len(msg))
+        except serial.SerialTimeoutException as e:
+            err_msg = "SerialTimeout: " + str(e)
+            self.log.error(err_msg)
+            raise TimeoutError(err_msg)
+        else:
+            if logs.keep('SENT:' + header):
+                self.log.info('SENT:' + msg.decode('utf-8').strip(), extra=logs.KEPT)
+
+    def send_latest(self, header: Text, data: Union[int, float]):
+        """
+        Queues a set command on the coalescer, which keeps only the newest
+        value per header and skips values the gimbal already has.
+
+        Args:
+            header (str): one of coalesce_headers
+            data (float/int): data as a float or an int
+
+        Raises:
+            ValueError: If header or data is invalid, or coalescing is off.
+            TimeoutError: If an earlier coalesced write timed out.
+        """
+        if self.coalescer is None:
+            raise ValueError('Gimbal.send_latest(): coalescing is off')
+        if header not in self.coalesce_headers:
+            raise ValueError('Gimbal.send_latest(): ' + header + ' cannot be coalesced')
+        self._encode(header, data)
+        self.coalescer.submit(header, data)
+
+    def _forget_coalesced(self, header: Text):
+        """
+        Makes the coalescer write the next value of a header whose device
+        value a send changes: the header itself, and SETPO after SETEN,
+        which hands the servo output to or takes it from the PID loop
+        """
+        if self.coalescer is not None:
+            self.coalescer.forget("SETPO" if header == "SETEN" else header)
+
+    def _send_set(self, header: Text, data: Union[int, float]):
+        """
+        Sends a set command through the coalescer when it is on
+        """
+        if self.coalescer is None:
+            self.send(header, data)
+        else:
+            self.send_latest(header, data)
+            
+    def _connect(self, port: Text, timeout: float = .5, baude: int = 115200):
+        """
+        Connects to the gimbal serial port.
+
+        Args:
+            port (str): the serial port name.
+            timeout (float, optional): timeout duration Defaults to 5.0.
+            baude (int, optional): serial port speed. Defaults to 115200.
+
+        Raises:
+            PermissionError: If COM port permission is denied, COM port open elsewhere.
+            FileNotFoundError: If COM port could not be found.
+            TimeoutError: If COM port times out.
+            Exception: All other serial related errors.
+        """
+        self.arduino = self._open_port(port, timeout, baude)
+        self._start_reader()
+        
+    def request(self, header: Text, data: Union[int, float], reply_header: Text,
+                timeout: float = 2.0) -> concurrent.futures.Future:
+        """
+        Sends a packet and returns a future for its reply, without waiting.
+
+        Replies are matched to requests in the order they were sent, per
+        reply header, so several requests can be in flight at once:
+
+            version = gimbal.request("GETVE", 0, "VERS")
+            eeprom = gimbal.request("GETEP", 0, "EEPR")
+            print(version.result(), eeprom.result())
+
+        checkSerial() takes one character per control loop and the Nano
+        buffers RX_BUFFER received bytes, so a request is only sent while
+        the requests still unanswered take fewer bytes than that; the rest
+        wait in order and are sent as replies come in, time out or are
+        cancelled. Their timeout counts from this call.
+
+        A reply claimed by a request never reaches read(). The future
+        fails with TimeoutError once the deadline has passed (checked
+        whenever the reader wakes, at least every 0.5 s) and with
+        ConnectionError if the gimbal closes first. Cancelling it drops
+        the reply when it comes.
+
+        Args:
+            header (str): header of the request, e.g. 'GETVE'
+            data (float/int): data of the request
+            reply_header (str): header of the reply, e.g. 'VERS'
+            timeout (float, optional): seconds until the request fails. Defaults to 2.0.
+
+        Returns:
+            concurrent.futures.Future: resolves to the reply, e.g. 'VERS;2,4'
+
+        Raises:
+            ValueError: If a header or data is invalid.
+            TimeoutError: If serial timeout exceeded.
+        """
+        future = concurrent.futures.Future()
+        size = len(self._encode(header, data))
+        if reply_header not in self._pending:
+            raise ValueError('Invalid header')
+        with self._flow_lock:
+            queued = bool(self._backlog) or not self._fits(size)
+            if queued:
+                self._backlog.append((header, data, reply_header,
+                                      time.monotonic() + timeout, size, future))
+                if not self._request_bytes:
+                    self._retry_later(size)
+            else:
+                self._request_bytes += size
+        if not queued:
+            self._send_request(header, data, reply_header, timeout, size, future)
+        return future
+
+    def _send_request(self, header: Text, data: Union[int, float], reply_header: Text,
+                      timeout: float, size: int, future: concurrent.futures.Future):
+        """
+        Sends a request whose size is already counted as unanswered, and
+        uncounts it once the future is done
+        """
+        self._add_request(reply_header, future, timeout, header)
+        with self._flow_lock:
+            read = self._written + size
+        try:
+            self.send(header, data)
+        except Exception:
+            self._remove_request(reply_header, future)
+            self._release_request(size)
+            raise
+        future.add_done_callback(lambda done: self._request_done(size, read, done))
+
+    def _release_request(self, size: int):
+        """
+        Uncounts an answered, failed or cancelled request and sends the
+        queued ones that now fit
+        """
+        with self._flow_lock:
+            self._request_bytes -= size
+        while True:
+            with self._flow_lock:
+                if not self._backlog:
+                    return
+                header, data, reply_header, deadline, needed, future = self._backlog[0]
+                if not future.done() and not self._fits(needed):
+                    if not self._request_bytes:
+                        self._retry_later(needed)
+                    return
+                self._backlog.popleft()
+                if future.done():
+                    continue
+                if deadline <= time.monotonic():
+                    expired = True
+                else:
+                    expired = False
+                    self._request_bytes += needed
+            if expired:
+                self._settle(future, exception=TimeoutError('No ' + reply_header +
+                                                            ' reply before the deadline'))
+                continue
+            try:
+                self._send_request(header, data, reply_header, deadline - time.monotonic(),
+                                   needed, future)
+            except Exception as e:
+                self._settle(future, exception=e)
+
+    def _retry_later(self, size: int):
+        """
+        Sends the queued requests once the firmware has read enough for one
+        of size bytes; for when no reply is coming to trigger it
+        """
+        timer = threading.Timer(self._rx_delay(size), self._release_request, (0,))
+        timer.daemon = True
+        timer.start()
+
+    def _wait(self, future: concurrent.futures.Future, timeout: float) -> Text:
+        """
+        Waits for the reply of a request, cancelling it on timeout
+
+        Raises:
+            TimeoutError: If no reply arrived within timeout
+        """
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise TimeoutError('No reply within ' + str(timeout) + 's')
+
+    def get_version(self, timeout: float = 2.0):
+        packet = self._wait(self.request("GETVE", 0, "VERS", timeout), timeout).split(';')
+        version = packet[1].split(',')
+        return version
+
+    def get_eeprom(self) -> List[float]:
+        """
+        Reads the values stored in EEPROM
+
+        Returns:
+            list: Kp, Ki, Kd, deadband and gyro x, y, z calibration
+        """
+        return list(self.get_config(refresh=True))
+
+    def get_config(self, refresh: bool = False, timeout: float = 2.0) -> GimbalConfig:
+        """
+        Returns the EEPR values, asking the gimbal only when needed.
+
+        The reply is cached until this gimbal object sends TUNEP, TUNEI,
+        TUNED, SETDB or CALGY; changes made by anyone else are only seen
+        with refresh=True.
+
+        Args:
+            refresh (bool, optional): ignore the cache. Defaults to False.
+            timeout (float, optional): seconds to wait for the EEPR reply. Defaults to 2.0.
+
+        Raises:
+            TimeoutError: If no reply arrived within timeout
+            ValueError: If the reply is malformed
+        """
+        config = self._config
+        if config is not None and not refresh:
+            return config
+        version = self.config_version
+        return self._store_config(self._wait(self.request("GETEP", 0, "EEPR", timeout), timeout), version)
+
+    def apply_config(self, target: Union[GimbalConfig, Mapping[Text, float]],
+                     timeout: float = 2.0) -> GimbalConfig:
+        """
+        Sends only the gains and deadband that differ from the gimbal's,
+        then checks them with one GETEP.
+
+        Each TUNEx command makes the firmware rewrite its EEPROM, so
+        tuning scripts should call this instead of setting every gain:
+
+            gimbal.apply_config({'ki': 5, 'deadband': 1.5})
+
+        The firmware takes one character per control loop into a 64-byte
+        buffer and stalls in writeVals() after every TUNEx, so each TUNEx
+        waits for its TUNING UPDATE RECEIVED before anything else is sent.
+
+        Args:
+            target (GimbalConfig/dict): wanted values; gyro calibration is
+                ignored, and with a dict, missing fields are left alone
+            timeout (float, optional): seconds to wait for each EEPR reply. Defaults to 2.0.
+
+        Returns:
+            GimbalConfig: the config read back from the gimbal
+
+        Raises:
+            ValueError: If target has unknown fields or invalid values
+            TimeoutError: If the gimbal does not reply
+            Exception: If the gimbal does not report the new values
+        """
+        current = self.get_config(timeout=timeout)
+        changes = self._config_changes(current, target)
+        if not changes:
+            return current
+        for header, value in changes:
+            if header in TUNE_HEADERS:
+                self._wait(self.request(header, value, "TUNE", timeout), timeout)
+            else:
+                self.send(header, value)
+        if self.coalescer is not None:
+            self.coalescer.reset()
+        config = self.get_config(refresh=True, timeout=timeout)
+        self._check_config(config, changes)
+        return config
+
+
+
+class AsyncGimbal(_GimbalBase):
+    """Functions for communicating with Gimbal 2.0 from an asyncio event loop.
+
+    The serial port is opened non-blocking and its file descriptor is watched
+    by the event loop, so any number of gimbals can share one loop without
+    threads. Needs a loop that supports add_reader(), i.e. not the Windows
+    proactor loop.
+
+    Usage:
+        gimbal = await AsyncGimbal.connect('/dev/ttyUSB0')
+        await gimbal.set_enable(1)
+
+    Attributes:
+        arduino: serial.Serial object
+        data_delim: delimiter for parsing gimbal data
+        out_headers: valid data headers for writing to gimbal
+        in_headers: valid data headers for reading from gimbal
+        queue_size: number of unread packets kept per in_header
+    """
+
+    def __init__(self, port: Text, delim: Text = ';', queue_size: int = 100):
+        """
+        Initializes the gimbal class without connecting. See connect().
+
+        Args:
+            port (str): COM port of gimbal.
+            delim (str, optional): common data delimiter. Defaults to ';'.
+            queue_size (int, optional): unread packets kept per header. Defaults to 100.
+        """
+        _GimbalBase.__init__(self, port, delim)
+        self.queue_size = queue_size
+        self.arduino = None
+        self._queues = {header: asyncio.Queue(queue_size) for header in self.in_headers}
+        self._tx_buf = bytearray()
+        self._drained = None
+        self._error = None
+        self._room = asyncio.Event()
+
+    @classmethod
+    async def connect(cls, port: Text, delim: Text = ';', queue_size: int = 100,
+                      baude: int = 115200, connect_timeout: float = 5.0,
+                      probe_interval: float = 0.25, binary: bool = True,
+                      reset: bool = True) -> 'AsyncGimbal':
+        """
+        Connects to a gimbal and checks its device name.
+
+        Args:
+            port (str): COM port of gimbal.
+            delim (str, optional): common data delimiter. Defaults to ';'.
+            queue_size (int, optional): unread packets kept per header. Defaults to 100.
+            baude (int, optional): serial port speed. Defaults to 115200.
+            connect_timeout (float, optional): seconds to wait for the gimbal to
+                answer GETDN after opening the port. Defaults to 5.0.
+            probe_interval (float, optional): seconds between GETDN probes. Defaults to 0.25.
+            binary (bool, optional): switch DATA packets to binary frames if the
+                firmware reports v2.4 or later. Defaults to True.
+            reset (bool, optional): False to attach to a running gimbal
+                without resetting it. Defaults to True.
+
+        Raises:
+            PermissionError: If COM port permission is denied or COM port open elsewhere.
+            FileNotFoundError: If COM port could not be found.
+            TimeoutError: If COM port times out.
+            Exception: All other serial related errors.
+        """
+        self = cls(port, delim, queue_size)
+        self.reset_on_open = reset
+        start = time.monotonic()
+        try:
+            self.arduino = self._open_port(port, 0, baude)
+        except Exception:
+            self._close_log()
+            raise
+        self._loop = asyncio.get_running_loop()
+        self._fd = self.arduino.fileno()
+        os.set_blocking(self._fd, False)
+        self._loop.add_reader(self._fd, self._on_readable)
+        try:
+            await self._probe(connect_timeout, probe_interval)
+            if binary and self._supports_binary(await self.get_version()):
+                await self.send("SETBN", 1)
+                self.binary = True
+        except Exception as e:
+            self.log.error(str(e))
+            self.close()
+            raise Exception(str(e))
+        self._record_connect(start)
+        return self
+
+    async def _probe(self, connect_timeout: float, probe_interval: float):
+        """
+        Sends GETDN every probe_interval seconds until the gimbal answers.
+
+        Raises:
+            TimeoutError: If no DEVN reply arrived within connect_timeout
+            Exception: If the reply is not from a gimbal
+        """
+        deadline = time.monotonic() + connect_timeout
+        reply = await self.request("GETDN", 0, "DEVN", connect_timeout)
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                packet = await asyncio.wait_for(asyncio.shield(reply),
+                                                max(min(probe_interval, remaining), 0))
+            except asyncio.TimeoutError:
+                if time.monotonic() >= deadline:
+                    reply.cancel()
+                    raise TimeoutError('No DEVN reply within ' + str(connect_timeout) + 's')
+                #Probe again, the first DEVN reply answers the request
+                await self.send("GETDN", 0)
+                continue
+            self._check_name(packet)
+            return
+
+    async def set_enable(self, value):
+        """
+        Enables or disables the gimbal
+        """
+        self._check_bool(value)
+        await self.send("SETEN", value)
+
+    async def set_direction(self, value):
+        """
+        Sets direction of gimbal
+        """
+        self._check_bool(value)
+        await self.send("SETDR", value)
+
+    async def set_position(self, value):
+        """
+        Sets position of gimbal
+        """
+        await self.send("SETPO", round(value))
+
+    async def set_setpoint(self, value: float):
+        """
+        Sets the setpoint of the PID controller in degrees
+        """
+        await self.send("SETSP", value)
+
+    async def set_deadband(self, value: float):
+        """
+        Sets the deadband size in degrees
+        """
+        await self.send("SETDB", value)
+
+    async def set_kp(self, value: float):
+        """
+        Sets Kp of the PID controller, stored in EEPROM
+        """
+        await self.send("TUNEP", value)
+
+    async def set_ki(self, value: float):
+        """
+        Sets Ki of the PID controller, stored in EEPROM
+        """
+        await self.send("TUNEI", value)
+
+    async def set_kd(self, value: float):
+        """
+        Sets Kd of the PID controller, stored in EEPROM
+        """
+        await self.send("TUNED", value)
+
+    async def set_print(self, value):
+        """
+        Enables or disables DATA packets
+        """
+        self._check_bool(value)
+        await self.send("SETPT", value)
+
+    async def calibrate_gyro(self):
+        """
+        Recalibrates the gyro. The gimbal must be kept still.
+        """
+        await self.send("CALGY", 0)
+
+    async def request(self, header: Text, data: Union[int, float], reply_header: Text,
+                      timeout: float = 2.0) -> asyncio.Future:
+        """
+        Sends a packet and returns a future for its reply, see Gimbal.request().
+
+        Returns once the packet is written; await the future for the reply:
+
+            version = await gimbal.request("GETVE", 0, "VERS")
+            eeprom = await gimbal.request("GETEP", 0, "EEPR")
+            print(await version, await eeprom)
+
+        While the requests still unanswered take RX_BUFFER bytes, this
+        waits for room before writing.
+
+        Raises:
+            ValueError: If a header or data is invalid.
+            ConnectionError: If the port failed
+            TimeoutError: If there was no room within timeout
+        """
+        size = len(self._encode(header, data))
+        if reply_header not in self._pending:
+            raise ValueError('Invalid header')
+        deadline = self._loop.time() + timeout
+        while not self._fits(size):
+            self._room.clear()
+            remaining = deadline - self._loop.time()
+            if remaining <= 0:
+                raise TimeoutError('No room for ' + header + ' within ' + str(timeout) + 's')
+            #Without unanswered requests, only the firmware reading frees room
+            wait = remaining if self._request_bytes else min(remaining, self._rx_delay(size))
+            try:
+                await asyncio.wait_for(self._room.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+        self._request_bytes += size
+        future = self._loop.create_future()
+        self._add_request(reply_header, future, timeout, header)
+        self._loop.call_later(timeout, self._expire_requests)
+        read = self._written + size
+        try:
+            await self.send(header, data)
+        except Exception:
+            self._remove_request(reply_header, future)
+            self._release_request(size)
+            raise
+        future.add_done_callback(lambda done: self._request_done(size, read, done))
+        return future
+
+    def _release_request(self, size: int):
+        """
+        Uncounts an answered, failed or cancelled request and wakes the
+        requests waiting for room
+        """
+        self._request_bytes -= size
+        self._room.set()
+
+    async def _wait(self, future: asyncio.Future, timeout: float) -> Text:
+        """
+        Waits for the reply of a request, cancelling it on timeout
+
+        Raises:
+            TimeoutError: If no reply arrived within timeout
+        """
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError('No reply within ' + str(timeout) + 's')
+
+    async def get_version(self, timeout: float = 2.0):
+        reply = await self.request("GETVE", 0, "VERS", timeout)
+        packet = (await self._wait(reply, timeout)).split(';')
+        version = packet[1].split(',')
+        return version
+
+    async def get_eeprom(self) -> List[float]:
+        """
+        Reads the values stored in EEPROM
+
+        Returns:
+            list: Kp, Ki, Kd, deadband and gyro x, y, z calibration
+        """
+        return list(await self.get_config(refresh=True))
+
+    async def get_config(self, refresh: bool = False, timeout: float = 2.0) -> GimbalConfig:
+        """
+        Returns the EEPR values, asking the gimbal only when needed, see Gimbal.get_config()
+        """
+        config = self._config
+        if config is not None and not refresh:
+            return config
+        version = self.config_version
+        reply = await self.request("GETEP", 0, "EEPR", timeout)
+        return self._store_config(await self._wait(reply, timeout), version)
+
+    async def apply_config(self, target: Union[GimbalConfig, Mapping[Text, float]],
+                           timeout: float = 2.0) -> GimbalConfig:
+        """
+        Sends only the gains and deadband that differ from the gimbal's,
+        then checks them with one GETEP, see Gimbal.apply_config()
+        """
+        current = await self.get_config(timeout=timeout)
+        changes = self._config_changes(current, target)
+        if not changes:
+            return current
+        for header, value in changes:
+            if header in TUNE_HEADERS:
+                await self._wait(await self.request(header, value, "TUNE", timeout), timeout)
+            else:
+                await self.send(header, value)
+        config = await self.get_config(refresh=True, timeout=timeout)
+        self._check_config(config, changes)
+        return config
+
+    def close(self):
+        """
+        Stops watching the port and closes it
+        """
+        if self.arduino is None:
+            return
+        if self.binary and self._error is None:
+            try:
+                os.write(self._fd, self._encode("SETBN", 0))
+            except OSError:
+                pass
+        self._loop.remove_reader(self._fd)
+        self._loop.remove_writer(self._fd)
+        if self._drained is not None and not self._drained.done():
+            self._drained.set_exception(ConnectionError('Gimbal closed'))
+        self._fail_requests(ConnectionError('Gimbal closed'))
+        self.arduino.close()
+        self.arduino = None
+        self._close_log()
+
+    async def read(self, header: Text, timeout: float = 2.0) -> Text:
+        """
+        Waits for the next packet with the desired header.
+
+        Args:
+            header (str): header of the packet, e.g. 'VERS'
+            timeout (float, optional): seconds to wait for the packet. Defaults to 2.0.
+
+        Returns:
+            str: the packet without line ending, e.g. 'VERS;2,3'
+
+        Raises:
+            ValueError: If desired header is invalid
+            TimeoutError: If no packet arrived before the deadline
+            ConnectionError: If the port failed
+        """
+        return (await self.read_stamped(header, timeout))[1]
+
+    async def read_stamped(self, header: Text, timeout: float = 2.0) -> Tuple[float, Text]:
+        """
+        Same as read(), but also returns the time the packet was received.
+
+        Returns:
+            (float, str): time.monotonic() at reception and the packet
+        """
+        if header not in self.in_headers:
+            raise ValueError('Invalid header')
+        if self._error is not None:
+            raise ConnectionError(str(self._error))
+        try:
+            stamp, data = await asyncio.wait_for(self._queues[header].get(), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError('No ' + header + ' packet within ' + str(timeout) + 's')
+        data = self._as_text(data)
+        if logs.keep('RECV:' + header):
+            self.log.info('RECV:' + data, extra=logs.KEPT)
+        return stamp, data
+
+    async def read_data(self, timeout: float = 2.0) -> Tuple[float, Tuple[float, int, float, int]]:
+        """
+        Waits for the next DATA packet and returns its values.
+
+        Returns:
+            (float, tuple): time.monotonic() at reception and
+                (angle, loop duration, output, time)
+
+        Raises:
+            TimeoutError: If no packet arrived before the deadline
+            ConnectionError: If the port failed
+        """
+        if self._error is not None:
+            raise ConnectionError(str(self._error))
+        try:
+            stamp, data = await asyncio.wait_for(self._queues['DATA'].get(), timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError('No DATA packet within ' + str(timeout) + 's')
+        return stamp, data
+
+    async def send(self, header: Text, data: Union[int, float]):
+        """
+        Formats and sends a data packet to the gimbal.
+
+        Returns once the packet has been handed to the OS. Packets queue up
+        behind each other while the port is not writable.
+
+        Args:
+            header (str): the header value as a string
+            data (float/int): data as a float or an int
+
+        Raises:
+            ValueError: If header or data is invalid.
+            ConnectionError: If the port failed
+        """
+        msg = self._encode(header, data)
+        if self._error is not None:
+            raise ConnectionError(str(self._error))
+        self._wrote(len(msg))
+        if not self._tx_buf:
+            try:
+                start = time.perf_counter()
+                written = os.write(self._fd, msg)
+                self.metrics.observe('write_latency', time.perf_counter() - start)
+            except BlockingIOError:
+                written = 0
+            except OSError as e:
+                self._fail(e)
+                raise ConnectionError(str(e))
+            msg = msg[written:]
+        if msg:
+            self._tx_buf += msg
+            if self._drained is None or self._drained.done():
+                self._drained = self._loop.create_future()
+                self._loop.add_writer(self._fd, self._on_writable)
+            await asyncio.shield(self._drained)
+        if logs.keep('SENT:' + header):
+            self.log.info('SENT:' + header + self.data_delim + str(data), extra=logs.KEPT)
+
+    def _on_writable(self):
+        """
+        Writes buffered packets once the port accepts more data
+        """
+        try:
+            written = os.write(self._fd, self._tx_buf)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._fail(e)
+            return
+        del self._tx_buf[:written]
+        if not self._tx_buf:
+            self._loop.remove_writer(self._fd)
+            self._drained.set_result(None)
+
+    def _on_readable(self):
+        """
+        Reads what the port holds and queues every complete packet by header
+        """
+        try:
+            chunk = os.read(self._fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._fail(e)
+            return
+        if not chunk:
+            #Readable but empty: the device hung up
+            self._fail(ConnectionError('Port closed'))
+            return
+        stamp = time.monotonic()
+        last = None
+        for header, data in self._packets(chunk):
+            if header == 'DATA':
+                self._observe_data(stamp, data[1])
+                self.stream.add(data[3], stamp)
+                last = data
+            else:
+                self._observe(header, [data])
+            if not self._resolve(header, [data]):
+                continue
+            packet_queue = self._queues[header]
+            if packet_queue.full():
+                packet_queue.get_nowait()
+            packet_queue.put_nowait((stamp, data))
+        if last is not None:
+            self.clock.update(last[3], stamp)
+
+    def _fail(self, error: Exception):
+        """
+        Stops watching a port that has failed, e.g. after the USB cable was pulled
+        """
+        self.log.error('Port failed: ' + str(error))
+        self._error = error
+        self._loop.remove_reader(self._fd)
+        self._loop.remove_writer(self._fd)
+        if self._drained is not None and not self._drained.done():
+            self._drained.set_exception(ConnectionError(str(error)))
+        self._fail_requests(ConnectionError(str(error)))
@@ -0,0 +1,241 @@
+#!/usr/bin/python3
+'''
+GIMBAL LOGGING
+NON-BLOCKING, SAMPLED LOGGING FOR THE SEND/READ HOT PATHS
+
+Records are put on a bounded queue and written to the log file by a
+background thread, so logging a command costs microseconds instead of a
+file write. High-rate categories such as SENT:SETPO can be sampled; hot
+paths ask keep() first, so a record sampled out is never built.
+
+Each gimbal gets a logger named 'gimbal.<port>' from get_logger(). All of
+them share a single handler on the 'gimbal' logger, so reconnecting never
+adds handlers. The handler is created on first use with the settings from
+configure() and closed when the last logger is released.
+
+Organization: Davis Drone Club
+'''
+
+import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import queue
+import threading
+from typing import Dict, Optional, Text
+
+#Default sampling: log 1 in N records of these categories
+DEFAULT_SAMPLING = {'SENT:SETPO': 10, 'SENT:SETSP': 10, 'RECV:DATA': 100}
+
+#Name of the logger holding the shared handler
+BASE_LOGGER = 'gimbal'
+
+#extra= of records already sampled by keep(), so the filter passes them
+KEPT = {'kept': True}
+
+_lock = threading.Lock()
+_config = {'filename': 'gimbal.log', 'formatstr': '%(asctime)s:%(levelname)s:%(message)s',
+           'sampling': None, 'max_queue': 10000}
+_shared = None
+_users = {}
+
+
+def category(message: Text) -> Text:
+    """
+    Returns the category of a log message: 'SENT:SETPO;90' -> 'SENT:SETPO'
+    """
+    return message.split(';', 1)[0]
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps only 1 in N INFO and DEBUG records per category.
+
+    Warnings, errors and records logged with extra=KEPT always pass.
+
+    Attributes:
+        rates: category -> N
+        sampled: number of records left out
+    """
+
+    def __init__(self, rates: Optional[Dict[Text, int]] = None):
+        super().__init__()
+        self.rates = dict(DEFAULT_SAMPLING if rates is None else rates)
+        self.sampled = 0
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.INFO or not self.rates or getattr(record, 'kept', False):
+            return True
+        return self.keep(category(str(record.msg)))
+
+    def keep(self, key: Text) -> bool:
+        """
+        Returns whether the next INFO record of category key is logged,
+        counting it as sampled if not
+        """
+        rate = self.rates.get(key)
+        if rate is None or rate <= 1:
+            return True
+        with self._lock:
+            seen = self._seen.get(key, 0)
+            self._seen[key] = seen + 1
+            if seen % rate == 0:
+                return True
+            self.sampled += 1
+            return False
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler that drops records instead of blocking when the queue is full.
+
+    Attributes:
+        dropped: number of records lost to a full queue
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class AsyncLogHandler:
+    """Queue handler and background writer for one log file.
+
+    Attributes:
+        handler: DroppingQueueHandler to add to a logger
+        filter: SamplingFilter applied before records are queued, and by keep()
+    """
+
+    def __init__(self, filename: Text = 'gimbal.log',
+                 formatstr: Text = '%(asctime)s:%(levelname)s:%(message)s',
+                 sampling: Optional[Dict[Text, int]] = None, max_queue: int = 10000):
+        """
+        Opens the log file and starts the writer thread
+
+        Args:
+            filename (str, optional): name of log file. Defaults to 'gimbal.log'.
+            formatstr (str, optional): string format of log entries. Defaults to time:level:message.
+            sampling (dict, optional): category -> N, log 1 in N records.
+                Defaults to DEFAULT_SAMPLING; pass {} to log everything.
+            max_queue (int, optional): records waiting to be written before
+                new ones are dropped. Defaults to 10000.
+        """
+        file_handler = RotatingFileHandler(filename, mode='a', maxBytes=5*1024*1024,
+                                           backupCount=1, encoding=None, delay=0)
+        file_handler.setFormatter(logging.Formatter(formatstr))
+        file_handler.setLevel(logging.DEBUG)
+        self.filter = SamplingFilter(sampling)
+        self.handler = DroppingQueueHandler(queue.Queue(max_queue))
+        self.handler.addFilter(self.filter)
+        self._listener = QueueListener(self.handler.queue, file_handler)
+        self._file_handler = file_handler
+        self._listener.start()
+
+    def counters(self) -> Dict[Text, int]:
+        """
+        Returns the number of records sampled out and dropped
+        """
+        return {'sampled': self.filter.sampled, 'dropped': self.handler.dropped}
+
+    def close(self):
+        """
+        Writes the records still queued, stops the writer thread and closes the file
+        """
+        self._listener.stop()
+        self._file_handler.close()
+
+
+def configure(filename: Optional[Text] = None, formatstr: Optional[Text] = None,
+              sampling: Optional[Dict[Text, int]] = None, max_queue: Optional[int] = None):
+    """
+    Sets the process-wide log settings used by get_logger().
+
+    Must be called before the first gimbal connects; arguments left as
+    None keep their current value. See AsyncLogHandler for their meaning.
+
+    Raises:
+        RuntimeError: If gimbal loggers are already in use
+    """
+    with _lock:
+        if _shared is not None:
+            raise RuntimeError('Gimbal logging already in use, configure() it first')
+        for key, value in (('filename', filename), ('formatstr', formatstr),
+                           ('sampling', sampling), ('max_queue', max_queue)):
+            if value is not None:
+                _config[key] = value
+
+
+def get_logger(key: Text) -> logging.Logger:
+    """
+    Returns the logger of a gimbal, creating the shared handler on first use.
+
+    Every call must be matched by a release_logger() call.
+
+    Args:
+        key (str): identity of the gimbal, e.g. its port
+    """
+    global _shared
+    with _lock:
+        if _shared is None:
+            _shared = AsyncLogHandler(**_config)
+            base = logging.getLogger(BASE_LOGGER)
+            base.setLevel(logging.DEBUG)
+            base.addHandler(_shared.handler)
+        _users[key] = _users.get(key, 0) + 1
+    return logging.getLogger(BASE_LOGGER + '.' + key.replace('.', '_'))
+
+
+def release_logger(key: Text):
+    """
+    Releases a logger from get_logger(). The shared handler is flushed
+    and closed when no logger is in use anymore.
+    """
+    global _shared
+    with _lock:
+        count = _users.get(key, 0) - 1
+        if count > 0:
+            _users[key] = count
+            return
+        _users.pop(key, None)
+        if _users or _shared is None:
+            return
+        logging.getLogger(BASE_LOGGER).removeHandler(_shared.handler)
+        closing, _shared = _shared, None
+    closing.close()
+
+
+def keep(key: Text) -> bool:
+    """
+    Samples an INFO record of category key before it is built, e.g.
+
+        if logs.keep('SENT:SETPO'):
+            log.info('SENT:SETPO;' + str(value), extra=logs.KEPT)
+
+    A record left out then costs a counter increment instead of a
+    LogRecord. Log kept records with extra=KEPT so they are not sampled twice.
+    """
+    shared = _shared
+    return shared is None or shared.filter.keep(key)
+
+
+def counters() -> Dict[Text, int]:
+    """
+    Returns the number of records sampled out and dropped by the shared handler
+    """
+    with _lock:
+        if _shared is None:
+            return {'sampled': 0, 'dropped': 0}
+        return _shared.counters()
+
+
+def handler_count() -> int:
+    """
+    Returns the number of handlers on the gimbal loggers, 1 while any is in use
+    """
+    loggers = [logging.getLogger(BASE_LOGGER)]
+    loggers += [logging.getLogger(BASE_LOGGER + '.' + key.replace('.', '_')) for key in _users]
+    return sum(len(logger.handlers) for logger in loggers)
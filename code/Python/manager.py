@@ -0,0 +1,556 @@
+#!/usr/bin/python3
+'''
+GIMBAL MANAGER
+RUNS ANY NUMBER OF GIMBALS ON ONE SELECTOR LOOP
+
+Every port is opened non-blocking and watched by a single selectors
+thread, so N gimbals cost one thread instead of N reader threads. Each
+gimbal keeps its own packet queues and telemetry ring; commands can be
+sent to one gimbal or fanned out to all of them.
+
+broadcast() is for coordinated moves: it encodes the command for every
+gimbal first, writes all of them back-to-back from one thread and
+reports the skew between the gimbals.
+
+Usage:
+    with GimbalManager() as manager:
+        manager.open_all(['/dev/ttyUSB0', '/dev/ttyUSB1'])
+        manager.send_all("SETSP", 10)
+        print(manager['/dev/ttyUSB0'].read_data())
+
+Organization: Davis Drone Club
+'''
+
+from concurrent.futures import Future, ThreadPoolExecutor
+import os
+import selectors
+import threading
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Text, Union
+
+import gimbal as gb
+import logs
+
+#Bytes of unsent commands per gimbal before send() fails
+TX_LIMIT = 4096
+
+#Servo output limits, LOW_BOUND and HIGH_BOUND in code.ino
+OUTPUT_BOUNDS = (50, 130)
+
+#Degrees the angle must move toward a new setpoint before broadcast() counts it
+CHANGE_MARGIN = 0.5
+
+
+class BroadcastResult(NamedTuple):
+    """Timing of a broadcast(), host time.monotonic() values in seconds.
+
+    Attributes:
+        write_times: port -> time the write of the command returned
+        write_skew: last minus first write time
+        change_times: port -> receive time of the first DATA sample showing
+            the change, or None if none arrived before the timeout
+        change_skew: last minus first change time, or None if a change was missed
+        errors: port -> exception of every gimbal the command could not be sent to
+    """
+    write_times: Dict[Text, float]
+    write_skew: float
+    change_times: Dict[Text, Optional[float]]
+    change_skew: Optional[float]
+    errors: Dict[Text, Exception]
+
+
+def output_changed(before: Optional[tuple], sample: tuple) -> bool:
+    """
+    Test for a DATA sample showing any command: the servo output differs
+    from the last sample before the command.
+
+    Also fires on PID output jitter, so it is only the fallback of
+    command_effect() for commands without a known effect.
+
+    Args:
+        before (tuple): (angle, loop duration, output, time) before the command, or None
+        sample (tuple): a sample received after the command
+    """
+    return before is None or sample[2] != before[2]
+
+
+def command_effect(header: Text, data: Union[int, float]) -> Callable[[Optional[tuple], tuple], bool]:
+    """
+    Returns the test for a DATA sample showing the effect of one command.
+
+    SETPO shows once the output is the requested position, clamped like
+    the firmware does, which holds while the PID is disabled. SETSP shows
+    once the angle has moved CHANGE_MARGIN degrees toward the new setpoint,
+    or half the way if it was closer; steps inside the deadband never show.
+    Other commands fall back to output_changed().
+
+    Args:
+        header (str): the header value as a string
+        data (float/int): data as a float or an int
+
+    Returns:
+        callable: test(sample before, sample) like output_changed()
+    """
+    if header == "SETPO":
+        position = min(max(round(data), OUTPUT_BOUNDS[0]), OUTPUT_BOUNDS[1])
+        return lambda before, sample: abs(sample[2] - position) < 0.5
+    if header == "SETSP":
+        def moved(before, sample):
+            if before is None:
+                return True
+            distance = abs(data - before[0])
+            return distance - abs(data - sample[0]) >= min(CHANGE_MARGIN, distance / 2)
+        return moved
+    return output_changed
+
+
+class ManagedGimbal(gb.Gimbal):
+    """Gimbal whose port is served by a GimbalManager instead of a reader thread.
+
+    Has the full Gimbal API. Created by GimbalManager.open().
+
+    Attributes:
+        error: exception that stopped the port, or None
+    """
+
+    def __init__(self, manager: 'GimbalManager', port: Text, **kwargs):
+        """
+        Connects to a gimbal through manager
+
+        Args:
+            manager (GimbalManager): loop serving the port
+            port (str): COM port of gimbal
+            **kwargs: passed on to Gimbal()
+        """
+        self._manager = manager
+        self.error = None
+        gb.Gimbal.__init__(self, port, **kwargs)
+
+    def _connect(self, port: Text, timeout: float = .5, baude: int = 115200):
+        """
+        Opens the port non-blocking and hands it to the manager loop
+        """
+        self.arduino = self._open_port(port, 0, baude)
+        self._fd = self.arduino.fileno()
+        os.set_blocking(self._fd, False)
+        self._tx_buf = bytearray()
+        self._tx_lock = threading.Lock()
+        self._manager._call(self._manager._add, self)
+
+    def send(self, header: Text, data: Union[int, float]):
+        """
+        Formats and sends a data packet to the gimbal.
+
+        The packet is written at once if the port takes it, otherwise the
+        manager loop writes it when the port is ready.
+
+        Raises:
+            ValueError: If header or data is invalid.
+            TimeoutError: If TX_LIMIT bytes are already waiting.
+            ConnectionError: If the port failed.
+        """
+        msg = self._encode(header, data)
+        self._forget_coalesced(header)
+        start = time.perf_counter()
+        self._manager._write(self, msg)
+        self.metrics.observe('write_latency', time.perf_counter() - start)
+        self._wrote(len(msg))
+        if logs.keep('SENT:' + header):
+            self.log.info('SENT:' + msg.decode('utf-8').strip(), extra=logs.KEPT)
+
+    def close(self):
+        """
+        Sends pending coalesced commands and removes the gimbal from the manager
+        """
+        if self.coalescer is not None:
+            self.coalescer.close()
+        if self.binary and self.error is None:
+            try:
+                self.send("SETBN", 0)
+            except Exception:
+                pass
+        self._manager._call(self._manager._remove, self)
+        self._fail_requests(ConnectionError('Gimbal closed'))
+        self.arduino.close()
+        self._close_telemetry()
+        self._close_log()
+
+
+class GimbalManager:
+    """Serves many gimbals from one selector thread.
+
+    Attributes:
+        poll_interval: longest time the loop sleeps, which bounds how late
+            request deadlines fire
+    """
+
+    def __init__(self, poll_interval: float = 0.05):
+        """
+        Starts the loop thread
+
+        Args:
+            poll_interval (float, optional): see attributes. Defaults to 0.05.
+        """
+        self.poll_interval = poll_interval
+        self._selector = selectors.DefaultSelector()
+        self._devices = {}
+        self._calls = []
+        self._calls_lock = threading.Lock()
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name='gimbal-manager', daemon=True)
+        self._thread.start()
+
+    def __getitem__(self, port: Text) -> ManagedGimbal:
+        return self._devices[port]
+
+    def __contains__(self, port: Text) -> bool:
+        return port in self._devices
+
+    def __len__(self) -> int:
+        return len(self._devices)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def ports(self) -> List[Text]:
+        """
+        Ports of all open gimbals
+        """
+        return list(self._devices)
+
+    def open(self, port: Text, **kwargs) -> ManagedGimbal:
+        """
+        Connects to a gimbal and adds it to the loop.
+
+        Args:
+            port (str): COM port of gimbal
+            **kwargs: passed on to Gimbal(), e.g. connect_timeout
+
+        Returns:
+            ManagedGimbal: the connected gimbal
+
+        Raises:
+            ValueError: If the port is already open
+            Exception: Errors of Gimbal()
+        """
+        if port in self._devices:
+            raise ValueError('Port already open: ' + port)
+        return ManagedGimbal(self, port, **kwargs)
+
+    def open_all(self, ports: List[Text], **kwargs) -> Dict[Text, Exception]:
+        """
+        Connects to many gimbals at once; handshakes run in parallel.
+
+        Returns:
+            dict: port -> exception of every port that failed
+        """
+        def attempt(port):
+            try:
+                self.open(port, **kwargs)
+            except Exception as e:
+                return e
+            return None
+        if not ports:
+            return {}
+        with ThreadPoolExecutor(max_workers=len(ports)) as pool:
+            results = pool.map(attempt, ports)
+            return {port: error for port, error in zip(ports, results) if error is not None}
+
+    def send_all(self, header: Text, data: Union[int, float],
+                 ports: Optional[List[Text]] = None) -> Dict[Text, Exception]:
+        """
+        Sends the same packet to many gimbals.
+
+        Args:
+            header (str): the header value as a string
+            data (float/int): data as a float or an int
+            ports (list, optional): gimbals to send to. Defaults to all.
+
+        Returns:
+            dict: port -> exception of every gimbal the packet could not be sent to
+        """
+        errors = {}
+        for port in self.ports if ports is None else ports:
+            try:
+                self._devices[port].send(header, data)
+            except Exception as e:
+                errors[port] = e
+        return errors
+
+    def call_all(self, method: Text, *args, ports: Optional[List[Text]] = None) -> Dict[Text, Exception]:
+        """
+        Calls a Gimbal method, e.g. 'set_position', on many gimbals.
+
+        Returns:
+            dict: port -> exception of every gimbal the call failed on
+        """
+        errors = {}
+        for port in self.ports if ports is None else ports:
+            try:
+                getattr(self._devices[port], method)(*args)
+            except Exception as e:
+                errors[port] = e
+        return errors
+
+    def broadcast(self, header: Text, data: Union[int, float],
+                  ports: Optional[List[Text]] = None, timeout: float = 1.0,
+                  shows_change: Optional[Callable[[Optional[tuple], tuple], bool]] = None,
+                  wait: bool = True) -> BroadcastResult:
+        """
+        Sends one command to many gimbals as close together as possible.
+
+        Packets are encoded for every gimbal before the first write, then
+        written back-to-back from the calling thread. Write times are taken
+        when each write returns, i.e. when the OS has the bytes, not when
+        they have left the USB adapter. Each gimbal records the write like
+        ManagedGimbal.send() does.
+
+        If wait is true, waits up to timeout for every gimbal
+        to send a DATA sample for which shows_change(sample before, sample)
+        is true, and reports when those arrived. DATA packets come every
+        PRINT_EVERY control loops, so change skew includes up to one print
+        period of each gimbal.
+
+        Args:
+            header (str): the header value as a string
+            data (float/int): data as a float or an int
+            ports (list, optional): gimbals to send to. Defaults to all.
+            timeout (float, optional): seconds to wait for the changes. Defaults to 1.0.
+            shows_change (callable, optional): change test. Defaults to command_effect(header, data).
+            wait (bool, optional): wait for the changes. Defaults to True.
+
+        Returns:
+            BroadcastResult
+
+        Raises:
+            ValueError: If header or data is invalid.
+        """
+        devices = [self._devices[port] for port in (self.ports if ports is None else ports)]
+        frames = [device._encode(header, data) for device in devices]
+        if not wait:
+            shows_change = None
+        elif shows_change is None:
+            shows_change = command_effect(header, data)
+        starts = []
+        for device in devices:
+            last = device.telemetry.view(1) if device.telemetry is not None else []
+            before = tuple(last[gb.DATA_FIELDS][0].tolist()) if len(last) else None
+            starts.append((device.telemetry.total if device.telemetry is not None else 0, before))
+
+        write_times = {}
+        errors = {}
+        latencies = {}
+        for device, frame in zip(devices, frames):
+            device._forget_coalesced(header)
+            start = time.perf_counter()
+            try:
+                self._write(device, frame)
+            except Exception as e:
+                errors[device.port] = e
+                continue
+            write_times[device.port] = time.monotonic()
+            latencies[device.port] = time.perf_counter() - start
+        #Bookkeeping after the last write so it does not add to the skew
+        for device, frame in zip(devices, frames):
+            if device.port in write_times:
+                device.metrics.observe('write_latency', latencies[device.port])
+                device._wrote(len(frame))
+                if logs.keep('SENT:' + header):
+                    device.log.info('SENT:' + frame.decode('utf-8').strip(), extra=logs.KEPT)
+        write_skew = max(write_times.values()) - min(write_times.values()) if write_times else 0.0
+
+        change_times = {port: None for port in write_times}
+        waiting = [(device, start) for device, start in zip(devices, starts)
+                   if device.port in write_times and device.telemetry is not None]
+        deadline = time.monotonic() + timeout
+        while shows_change is not None and waiting and time.monotonic() < deadline:
+            time.sleep(0.001)
+            still_waiting = []
+            for device, (total, before) in waiting:
+                samples, new_total = device.telemetry.since(total)
+                for sample in samples:
+                    if (sample['host_time'] >= write_times[device.port] and
+                            shows_change(before, tuple(sample[gb.DATA_FIELDS].tolist()))):
+                        change_times[device.port] = float(sample['host_time'])
+                        break
+                else:
+                    still_waiting.append((device, (new_total, before)))
+            waiting = still_waiting
+        if write_times and shows_change is not None and None not in change_times.values():
+            change_skew = max(change_times.values()) - min(change_times.values())
+        else:
+            change_skew = None
+        return BroadcastResult(write_times, write_skew, change_times, change_skew, errors)
+
+    def close(self):
+        """
+        Closes all gimbals and stops the loop
+        """
+        for device in list(self._devices.values()):
+            try:
+                device.close()
+            except Exception:
+                pass
+        self._call(self._shutdown)
+        self._thread.join()
+        self._selector.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+    def _call(self, function: Callable, *args):
+        """
+        Runs function on the loop thread and returns its result
+        """
+        if threading.current_thread() is self._thread:
+            return function(*args)
+        future = Future()
+        with self._calls_lock:
+            self._calls.append((future, function, args))
+        self._wake()
+        return future.result()
+
+    def _wake(self):
+        """
+        Interrupts select() so the loop handles new calls
+        """
+        try:
+            os.write(self._wake_w, b'\0')
+        except BlockingIOError:
+            pass
+
+    def _add(self, device: ManagedGimbal):
+        self._devices[device.port] = device
+        self._selector.register(device._fd, selectors.EVENT_READ, device)
+
+    def _remove(self, device: ManagedGimbal):
+        if self._devices.get(device.port) is not device:
+            return
+        with device._tx_lock:
+            if device._tx_buf and device.error is None:
+                try:
+                    os.write(device._fd, device._tx_buf)
+                except OSError:
+                    pass
+                device._tx_buf.clear()
+        del self._devices[device.port]
+        self._selector.unregister(device._fd)
+
+    def _shutdown(self):
+        self._stop = True
+
+    def _write(self, device: ManagedGimbal, msg: bytes):
+        """
+        Writes msg now if the port takes it, otherwise leaves it to the loop
+        """
+        with device._tx_lock:
+            if device.error is not None:
+                raise ConnectionError(str(device.error))
+            if device._tx_buf:
+                if len(device._tx_buf) + len(msg) > TX_LIMIT:
+                    raise TimeoutError('SerialTimeout: ' + str(len(device._tx_buf)) + ' bytes unsent')
+                device._tx_buf += msg
+                return
+            try:
+                written = os.write(device._fd, msg)
+            except BlockingIOError:
+                written = 0
+            except OSError as e:
+                raise ConnectionError(str(e))
+            if written == len(msg):
+                return
+            device._tx_buf += msg[written:]
+        with self._calls_lock:
+            self._calls.append((None, self._watch_write, (device,)))
+        self._wake()
+
+    def _watch_write(self, device: ManagedGimbal):
+        if self._devices.get(device.port) is device:
+            self._selector.modify(device._fd, selectors.EVENT_READ | selectors.EVENT_WRITE, device)
+
+    def _flush(self, device: ManagedGimbal):
+        """
+        Writes what the port takes of the unsent commands
+        """
+        with device._tx_lock:
+            try:
+                written = os.write(device._fd, device._tx_buf)
+            except BlockingIOError:
+                return
+            except OSError as e:
+                self._fail(device, e)
+                return
+            del device._tx_buf[:written]
+            if not device._tx_buf:
+                self._selector.modify(device._fd, selectors.EVENT_READ, device)
+
+    def _read(self, device: ManagedGimbal):
+        """
+        Reads what the port holds and dispatches it like the Gimbal reader thread
+        """
+        try:
+            chunk = os.read(device._fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._fail(device, e)
+            return
+        if not chunk:
+            #Readable but empty: the device hung up
+            self._fail(device, ConnectionError('Port closed'))
+            return
+        device._dispatch(time.monotonic(), chunk)
+
+    def _fail(self, device: ManagedGimbal, error: Exception):
+        """
+        Stops serving a port that has failed, e.g. after the USB cable was pulled
+        """
+        device.log.error('Port failed: ' + str(error))
+        device.error = error
+        self._selector.unregister(device._fd)
+        del self._devices[device.port]
+        device._fail_requests(ConnectionError(str(error)))
+
+    def _run_calls(self):
+        try:
+            while os.read(self._wake_r, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self._calls_lock:
+            calls, self._calls = self._calls, []
+        for future, function, args in calls:
+            try:
+                result = function(*args)
+            except Exception as e:
+                if future is not None:
+                    future.set_exception(e)
+            else:
+                if future is not None:
+                    future.set_result(result)
+
+    def _run(self):
+        """
+        The loop: serves ports and calls from other threads until shutdown
+        """
+        while not self._stop:
+            for key, mask in self._selector.select(self.poll_interval):
+                device = key.data
+                if device is None:
+                    self._run_calls()
+                    continue
+                #Skip events of ports removed earlier in this round
+                if mask & selectors.EVENT_READ and self._devices.get(device.port) is device:
+                    self._read(device)
+                if mask & selectors.EVENT_WRITE and self._devices.get(device.port) is device:
+                    self._flush(device)
+            for device in list(self._devices.values()):
+                if any(device._pending.values()):
+                    device._expire_requests()
@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+'''
+GIMBAL METRICS
+ALWAYS-ON COUNTERS AND LOG-BUCKETED HISTOGRAMS
+
+Every Gimbal has a Metrics registry as its metrics attribute. Recording a
+value costs one dict lookup and a logarithm, so the registry stays on in
+flight; scripts read it with snapshot() and start over with reset().
+
+Histograms keep BUCKETS_PER_OCTAVE buckets per power of two, i.e. about
+19% relative resolution, from MIN_VALUE up. Percentiles are read from the
+bucket bounds, min and max are exact.
+
+Usage:
+    gimbal = gb.Gimbal('/dev/ttyUSB0')
+    ...
+    snap = gimbal.metrics.snapshot()
+    print(snap['histograms']['rtt.GETVE']['p99'], snap['counters']['warn'])
+    gimbal.metrics.reset()
+
+Organization: Davis Drone Club
+'''
+
+import math
+import threading
+from typing import Callable, Dict, Iterable, Optional, Text
+
+import numpy as np
+
+#Buckets per power of two
+BUCKETS_PER_OCTAVE = 4
+
+#Smallest value told apart from 0; histograms span MIN_VALUE * 2**OCTAVES
+MIN_VALUE = 1e-7
+OCTAVES = 64
+
+_BUCKETS = BUCKETS_PER_OCTAVE * OCTAVES + 1
+_SCALE = 1.0 / MIN_VALUE
+_log2 = math.log2
+
+
+class Histogram:
+    """Log-bucketed histogram of positive values.
+
+    Bucket 0 holds values below MIN_VALUE, bucket i > 0 values from
+    MIN_VALUE * 2**((i - 1) / BUCKETS_PER_OCTAVE) up.
+
+    Attributes:
+        count: number of values recorded
+        total: sum of the values
+        min, max: smallest and largest value, None while empty
+    """
+
+    def __init__(self):
+        self.buckets = [0] * _BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    @staticmethod
+    def bucket(value: float) -> int:
+        """
+        Returns the index of the bucket holding value
+        """
+        if value < MIN_VALUE:
+            return 0
+        return min(int(_log2(value * _SCALE) * BUCKETS_PER_OCTAVE) + 1, _BUCKETS - 1)
+
+    @staticmethod
+    def upper_bound(index: int) -> float:
+        """
+        Returns the upper bound of a bucket
+        """
+        return MIN_VALUE * 2 ** (index / BUCKETS_PER_OCTAVE)
+
+    def add(self, value: float):
+        #bucket() inlined, this runs for every DATA sample
+        if value < MIN_VALUE:
+            self.buckets[0] += 1
+        else:
+            self.buckets[min(int(_log2(value * _SCALE) * BUCKETS_PER_OCTAVE) + 1, _BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += value
+        if self.count == 1:
+            self.min = self.max = value
+        elif value < self.min:
+            self.min = value
+        elif value > self.max:
+            self.max = value
+
+    def add_many(self, values: np.ndarray):
+        """
+        Records an array of values with NumPy instead of one add() each
+        """
+        values = np.asarray(values, dtype=np.float64)
+        if not len(values):
+            return
+        scaled = np.log2(np.maximum(values, MIN_VALUE) / MIN_VALUE) * BUCKETS_PER_OCTAVE
+        indices = np.where(values < MIN_VALUE, 0, np.minimum(scaled.astype(np.int64) + 1, _BUCKETS - 1))
+        for index, count in zip(*np.unique(indices, return_counts=True)):
+            self.buckets[index] += int(count)
+        self.count += len(values)
+        self.total += float(values.sum())
+        low, high = float(values.min()), float(values.max())
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        """
+        Returns the upper bound of the bucket holding the pct-th percentile,
+        clamped to the recorded min and max; None while empty
+        """
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(self.count * pct / 100.0))
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(max(self.upper_bound(index), self.min), self.max)
+        return self.max
+
+    def summary(self) -> Dict[Text, Optional[float]]:
+        """
+        Returns count, mean, min, max and p50/p90/p99
+        """
+        return {'count': self.count,
+                'mean': self.total / self.count if self.count else None,
+                'min': self.min, 'max': self.max,
+                'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99)}
+
+
+class Metrics:
+    """Registry of named counters and histograms.
+
+    Names are created on first use. Counters kept elsewhere, e.g. by the
+    packet parser, are included in snapshot() through watch().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._sources = []
+
+    def count(self, name: Text, amount: int = 1):
+        """
+        Adds amount to a counter
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def observe(self, name: Text, value: float):
+        """
+        Records one value in a histogram
+        """
+        with self._lock:
+            try:
+                histogram = self._histograms[name]
+            except KeyError:
+                histogram = self._histograms[name] = Histogram()
+            histogram.add(value)
+
+    def observe_many(self, name: Text, values: Iterable[float]):
+        """
+        Records many values in a histogram at once
+        """
+        values = np.asarray(values, dtype=np.float64)
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.add_many(values)
+
+    def watch(self, source: Callable[[], Dict[Text, int]]):
+        """
+        Includes counters kept outside the registry in snapshot().
+
+        Args:
+            source (callable): returns {name: count}, counts never decreasing
+        """
+        with self._lock:
+            self._sources.append([source, {}])
+
+    def snapshot(self) -> Dict[Text, Dict]:
+        """
+        Returns all metrics recorded since creation or reset()
+
+        Returns:
+            dict: {'counters': {name: int}, 'histograms': {name: Histogram.summary()}}
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            for source, baseline in self._sources:
+                for name, value in source().items():
+                    counters[name] = counters.get(name, 0) + value - baseline.get(name, 0)
+            histograms = {name: histogram.summary() for name, histogram in self._histograms.items()}
+        return {'counters': counters, 'histograms': histograms}
+
+    def histogram(self, name: Text) -> Optional[Histogram]:
+        """
+        Returns a histogram by name, or None if nothing was recorded in it
+        """
+        with self._lock:
+            return self._histograms.get(name)
+
+    def reset(self):
+        """
+        Forgets all values; watched counters start again from 0
+        """
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            for entry in self._sources:
+                entry[1] = dict(entry[0]())
@@ -0,0 +1,180 @@
+#!/usr/bin/python3
+'''
+GIMBAL STREAM MONITOR
+DETECTS DROPPED, DUPLICATED AND BURSTY DATA PACKETS FROM THEIR DEVICE TIME
+
+printData() runs every PRINT_EVERY control loops of LOOP_PERIOD_US, so the
+millis() stamps of consecutive DATA packets are DATA_PERIOD apart. The
+monitor checks every step between stamps:
+
+    step == 0                  duplicate, the same packet seen twice
+    step > 1.5 periods         gap, round(step / period) - 1 packets dropped
+    0 < step < 0.5 periods     short, the stamp is corrupt
+    step negative              reset, the board restarted
+
+and counts bursts, DATA_BURST or more packets reaching the host within
+half a period, the sign of a backlog in the serial path. Every check is
+O(1) per packet; backlogs are checked with NumPy.
+
+Usage:
+    stream = StreamMonitor()
+    stream.add(curr_time, host_time)        #for every DATA sample
+    print(stream.report())
+
+Organization: Davis Drone Club
+'''
+
+from typing import Callable, Dict, Optional, Text
+
+import numpy as np
+
+#Firmware loop period and packets printed every that many loops, see code.ino
+LOOP_PERIOD_US = 5555
+PRINT_EVERY = 30
+
+#Device time between DATA packets in millis() counts
+DATA_PERIOD = LOOP_PERIOD_US * PRINT_EVERY / 1000.0
+
+#Packets arriving within half a period that count as a burst
+DATA_BURST = 3
+
+#Width of the millis() counter
+DEVICE_WRAP = 2**32
+
+
+class StreamMonitor:
+    """Streaming checks of the device times of DATA packets.
+
+    Attributes:
+        period: expected device time between packets, in device counts
+        samples, gaps, dropped, duplicates, short, resets, bursts: see counters()
+        longest_gap: longest step between two packets, in device counts
+        largest_burst: most packets received within half a period
+    """
+
+    def __init__(self, period: float = DATA_PERIOD, tick: float = 1e-3,
+                 rejected: Optional[Callable[[], int]] = None):
+        """
+        Args:
+            period (float, optional): see attributes. Defaults to DATA_PERIOD;
+                set it to 1000 / rate for a simulator or SETPT rate that differs.
+            tick (float, optional): seconds per device count. Defaults to 1e-3.
+            rejected (callable, optional): returns the number of lines the
+                parser rejected so far, included in report()
+        """
+        self.period = period
+        self.tick = tick
+        self._rejected = rejected
+        self.reset()
+
+    def reset(self):
+        """
+        Forgets all packets and counts, e.g. after changing period
+        """
+        self.samples = 0
+        self.gaps = 0
+        self.dropped = 0
+        self.duplicates = 0
+        self.short = 0
+        self.resets = 0
+        self.bursts = 0
+        self.longest_gap = 0
+        self.largest_burst = 0
+        self._last = None
+        self._run = 0
+        self._run_start = None
+        self._rejected_base = self._rejected() if self._rejected is not None else 0
+
+    def add(self, device_time: int, host_time: float):
+        """
+        Checks one packet
+
+        Args:
+            device_time (int): currTime field of the DATA sample
+            host_time (float): time.monotonic() when it was received
+        """
+        device_time = int(device_time)
+        self._arrived(host_time, 1)
+        self.samples += 1
+        last, self._last = self._last, device_time
+        if last is None:
+            return
+        step = (device_time - last) % DEVICE_WRAP
+        if step == 0:
+            self.duplicates += 1
+        elif step > DEVICE_WRAP // 2:
+            self.resets += 1
+        elif step < 0.5 * self.period:
+            self.short += 1
+        elif step > 1.5 * self.period:
+            self.gaps += 1
+            self.dropped += int(round(step / self.period)) - 1
+            self.longest_gap = max(self.longest_gap, step)
+
+    def add_many(self, device_times: np.ndarray, host_time: float):
+        """
+        Checks a backlog of packets received together
+
+        Args:
+            device_times (ndarray): currTime fields, oldest first
+            host_time (float): time.monotonic() when they were received
+        """
+        count = len(device_times)
+        if count == 0:
+            return
+        times = np.asarray(device_times, dtype=np.int64)
+        self._arrived(host_time, count)
+        self.samples += count
+        if self._last is not None:
+            times = np.concatenate(([self._last], times))
+        self._last = int(times[-1])
+        steps = np.diff(times) % DEVICE_WRAP
+        backwards = steps > DEVICE_WRAP // 2
+        forward = steps[~backwards]
+        self.duplicates += int(np.count_nonzero(forward == 0))
+        self.resets += int(np.count_nonzero(backwards))
+        self.short += int(np.count_nonzero((forward > 0) & (forward < 0.5 * self.period)))
+        gaps = forward[forward > 1.5 * self.period]
+        if len(gaps):
+            self.gaps += len(gaps)
+            self.dropped += int(np.rint(gaps / self.period).sum()) - len(gaps)
+            self.longest_gap = max(self.longest_gap, int(gaps.max()))
+
+    def _arrived(self, host_time: float, count: int):
+        """
+        Tracks packets arriving within half a period of the first of a run
+        """
+        if self._run_start is None or host_time - self._run_start >= 0.5 * self.period * self.tick:
+            self._run = 0
+            self._run_start = host_time
+        before = self._run
+        self._run += count
+        if before < DATA_BURST <= self._run:
+            self.bursts += 1
+        if self._run >= DATA_BURST:
+            self.largest_burst = max(self.largest_burst, self._run)
+
+    def counters(self) -> Dict[Text, int]:
+        """
+        Returns the counts, all of which only grow until reset()
+
+        samples: packets checked; gaps: steps of more than 1.5 periods;
+        dropped: packets missing in those gaps; duplicates: repeated stamps;
+        short: steps under half a period; resets: stamps going back;
+        bursts: runs of DATA_BURST or more packets within half a period
+        """
+        return {'samples': self.samples, 'gaps': self.gaps, 'dropped': self.dropped,
+                'duplicates': self.duplicates, 'short': self.short, 'resets': self.resets,
+                'bursts': self.bursts}
+
+    def report(self) -> Dict[Text, float]:
+        """
+        Returns counters() with longest_gap_ms, largest_burst and, if the
+        monitor was given a parser source, rejected lines
+        """
+        report = dict(self.counters())
+        report['longest_gap_ms'] = self.longest_gap * self.tick * 1000
+        report['largest_burst'] = self.largest_burst
+        if self._rejected is not None:
+            report['rejected'] = self._rejected() - self._rejected_base
+        return report
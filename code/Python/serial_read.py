@@ -1,22 +1,16 @@
 import serial
-import time
+from framing import PacketParser
 
 arduino=serial.Serial('COM3',9600)
-prevData = 0
+parser = PacketParser(['DATA', 'WARN'])
 
 def data_action(data):
-    parse_data = data.split(",")
-    angle = parse_data[0]
-    time  = float(parse_data[1])/1000
+    angle = data[0]
+    time  = float(data[3])/1000
     print('Time: {} \t Angle: {}'.format(str(time), str(angle)))
 
 while True:
-    inData = arduino.readline()
-    try:
-        inString = inData.decode('utf-8')
-    except:
-        continue
-    headers = inString.split(";")
-    if headers[0] == "DATA":
-        data_action(headers[1])
-
+    chunk = arduino.read(arduino.in_waiting or 1)
+    for header, packet in parser.feed(chunk):
+        if header == "DATA":
+            data_action(packet)
@@ -0,0 +1,467 @@
+#!/usr/bin/python3
+'''
+GIMBAL SIMULATOR
+EMULATES GIMBAL FIRMWARE V2.4 ON A PSEUDO-TERMINAL
+
+Implements the serial protocol of communication.ino so the host code can
+be run, tested and benchmarked without a Nano. Linux/macOS only.
+
+Usage:
+    python simulator.py --rate 50
+    python simulator.py --paced --baud 115200   #firmware input and wire limits
+    >>> sim = GimbalSimulator(data_rate=50)
+    >>> gimbal = Gimbal(sim.port)
+
+Organization: Davis Drone Club
+'''
+
+import argparse
+import heapq
+import os
+import pty
+import random
+import re
+import select
+import threading
+import time
+import tty
+from typing import Optional, Text, Tuple
+
+import framing
+
+#Firmware constants from code.ino
+LOOP_PERIOD_US = 5555
+PRINT_EVERY = 30
+HIGH_BOUND = 130
+LOW_BOUND = 50
+INPUT_BUF = 80
+
+#Size of the Nano's hardware serial receive buffer
+RX_BUF = 64
+
+#Bytes of output held back while the host is not reading
+TX_BACKLOG = 64 * 1024
+
+
+def _to_float(text: Text) -> float:
+    """
+    Parses a number the way Arduino String.toFloat() does: 0 if invalid
+    """
+    match = re.match(r'\s*[-+]?(\d+\.?\d*|\.\d+)', text)
+    return float(match.group(0)) if match else 0.0
+
+
+def _to_int(text: Text) -> int:
+    """
+    Parses a number the way Arduino String.toInt() does: 0 if invalid
+    """
+    match = re.match(r'\s*[-+]?\d+', text)
+    return int(match.group(0)) if match else 0
+
+
+class GimbalSimulator:
+    """Pure-Python stand-in for a gimbal running firmware v2.4.
+
+    Opens a pseudo-terminal and answers on its master side. Every header
+    of serialHandler() is handled, unknown headers get a WARN reply and
+    DATA packets are printed in the printData() format at data_rate, or
+    as binary frames after SETBN;1 if version is 2.4 or later.
+    Replies and DATA lines are delayed by latency plus a random jitter
+    drawn from a seeded generator, so runs are repeatable.
+
+    By default input is handled as fast as it arrives and output is
+    written as fast as the host reads it. With paced=True, input goes
+    through a RX_BUF byte buffer that drops what does not fit and one
+    character is taken per control loop, like checkSerial(). With baud
+    set, both directions are limited to baud / 10 bytes per second.
+
+    Attributes:
+        port: name of the slave device to open, e.g. '/dev/pts/3'
+        data_rate: DATA packets per second while printing is enabled
+        latency: seconds between a packet being produced and written
+        jitter: maximum extra random delay in seconds
+        boot_time: seconds after start or reset() during which input is ignored
+        version: firmware version reported by VERS
+        received: list of (header, data) commands handled so far
+        dropped: number of output lines lost because nobody read the port
+            or the baud rate could not carry them
+        paced: whether input is taken one character per control loop
+        baud: wire rate in bits per second, or None for no limit
+        rx_dropped: number of input bytes lost to a full receive buffer
+    """
+
+    def __init__(self, data_rate: float = 1e6 / (LOOP_PERIOD_US * PRINT_EVERY),
+                 latency: float = 0.0, jitter: float = 0.0, seed: Optional[int] = 0,
+                 boot_time: float = 0.0, version: Tuple[int, int] = (2, 4),
+                 overrun_rate: float = 0.0, paced: bool = False,
+                 baud: Optional[int] = None):
+        """
+        Opens the pseudo-terminal and starts the simulated firmware
+
+        Args:
+            data_rate (float, optional): DATA packets per second. Defaults to the
+                firmware rate, one packet every 30 loops of 5555us (6 Hz).
+            latency (float, optional): output delay in seconds. Defaults to 0.
+            jitter (float, optional): maximum extra output delay in seconds. Defaults to 0.
+            seed (int, optional): seed for jitter and sensor noise. Defaults to 0.
+            boot_time (float, optional): seconds before the firmware answers. Defaults to 0.
+            version (tuple, optional): firmware version. Defaults to (2, 4).
+            overrun_rate (float, optional): fraction of DATA packets preceded by a
+                LOOP overrun warning. Defaults to 0.
+            paced (bool, optional): take input one character per control loop
+                through a RX_BUF byte buffer. Defaults to False.
+            baud (int, optional): wire rate limit, e.g. 115200. Defaults to None.
+        """
+        self.data_rate = data_rate
+        self.latency = latency
+        self.jitter = jitter
+        self.boot_time = boot_time
+        self.version = version
+        self.overrun_rate = overrun_rate
+        self.paced = paced
+        self.baud = baud
+        self.received = []
+        self.dropped = 0
+        self.rx_dropped = 0
+        self._random = random.Random(seed)
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._slave)
+        os.set_blocking(self._master, False)
+        self.port = os.ttyname(self._slave)
+        self._outbox = []
+        self._out_seq = 0
+        self._last_due = 0.0
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._eeprom = {'kp': 0.1, 'ki': 3.0, 'kd': 0.0015, 'deadband': 2.0,
+                        'gyro_x_cal': -0.52, 'gyro_y_cal': 1.07, 'gyro_z_cal': 0.31}
+        self.reset()
+        self._threads = [threading.Thread(target=self._rx_loop, name='sim-rx', daemon=True),
+                         threading.Thread(target=self._tx_loop, name='sim-tx', daemon=True)]
+        for thread in self._threads:
+            thread.start()
+
+    def reset(self):
+        """
+        Simulates a reboot: RAM state is lost, EEPROM values are reloaded
+        """
+        with self._cond:
+            self._start = time.monotonic()
+            self._ready = self._start + self.boot_time
+            self._next_data = self._ready
+            self._outbox = []
+            self._tx_backlog = bytearray()
+            self._tx_wire = self._start
+            self._line = bytearray()
+            self._rx_buf = bytearray()
+            self.kp = self._eeprom['kp']
+            self.ki = self._eeprom['ki']
+            self.kd = self._eeprom['kd']
+            self.deadband = self._eeprom['deadband']
+            self.setpoint = 0.0
+            self.direction = 1
+            self.enabled = True
+            self.print_en = 1
+            self.binary_en = 0
+            self.output = 90.0
+            self.angle = 0.0
+            self.loop_duration = 4200
+
+    def close(self):
+        """
+        Stops the firmware threads and closes the pseudo-terminal
+        """
+        self._stop.set()
+        with self._cond:
+            self._cond.notify()
+        for thread in self._threads:
+            thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def stats(self) -> dict:
+        """
+        Returns the number of commands handled, output lines dropped and
+        input bytes dropped
+        """
+        with self._cond:
+            return {'received': len(self.received), 'dropped': self.dropped,
+                    'rx_dropped': self.rx_dropped}
+
+    def history(self, start: int = 0) -> list:
+        """
+        Returns the (header, data) commands handled from the start-th on
+        """
+        with self._cond:
+            return self.received[start:]
+
+    def state(self) -> dict:
+        """
+        Returns the RAM state set by SETEN, SETDR, SETSP, SETPO and SETPT
+        """
+        with self._cond:
+            return {'enabled': self.enabled, 'direction': self.direction,
+                    'setpoint': self.setpoint, 'output': self.output, 'print_en': self.print_en}
+
+    def millis(self) -> int:
+        """
+        Returns the simulated Arduino millis() counter
+        """
+        return int((time.monotonic() - self._start) * 1000) % 2**32
+
+    def format_data(self, angle: float, loop_duration: int, output: float, curr_time: int) -> Text:
+        """
+        Formats a DATA packet exactly like printData()
+        """
+        return 'DATA;{:.2f},{},{:.2f},{}'.format(angle, loop_duration, output, curr_time)
+
+    def _print(self, text: Text, produced: Optional[float] = None):
+        """
+        Queues a line for output after latency and jitter, like Serial.println()
+        """
+        self._print_raw((text + '\r\n').encode('utf-8'), produced)
+
+    def _print_raw(self, data: bytes, produced: Optional[float] = None):
+        """
+        Queues bytes for output after latency and jitter, like Serial.write()
+        """
+        if produced is None:
+            produced = time.monotonic()
+        with self._cond:
+            due = produced + self.latency + self._random.uniform(0, self.jitter)
+            #A UART never reorders bytes, so neither does the simulator
+            due = max(due, self._last_due)
+            self._last_due = due
+            self._out_seq += 1
+            heapq.heappush(self._outbox, (due, self._out_seq, data))
+            self._cond.notify()
+
+    def _write(self, data: bytes):
+        """
+        Writes to the master side. Whatever the pty does not accept is kept
+        and retried; past TX_BACKLOG bytes the oldest whole lines are dropped.
+        With baud set, no more is written than the wire carried since the last call.
+        """
+        self._tx_backlog += data
+        size = len(self._tx_backlog)
+        if self.baud:
+            now = time.monotonic()
+            #An idle wire saves up no more than one hardware buffer
+            self._tx_wire = max(self._tx_wire, now - RX_BUF * 10 / self.baud)
+            size = min(size, int((now - self._tx_wire) * self.baud / 10))
+        try:
+            written = os.write(self._master, self._tx_backlog[:size]) if size else 0
+        except (BlockingIOError, OSError):
+            written = 0
+        if self.baud:
+            self._tx_wire += written * 10 / self.baud
+        del self._tx_backlog[:written]
+        if len(self._tx_backlog) > TX_BACKLOG:
+            cut = self._tx_backlog.find(b'\n', len(self._tx_backlog) - TX_BACKLOG) + 1
+            self.dropped += self._tx_backlog.count(b'\n', 0, cut)
+            del self._tx_backlog[:cut]
+
+    def _rx_loop(self):
+        """
+        Reads characters and handles complete lines like checkSerial()
+        """
+        if self.paced or self.baud:
+            self._rx_paced()
+            return
+        while not self._stop.is_set():
+            ready, _, _ = select.select([self._master], [], [], 0.05)
+            if not ready:
+                continue
+            try:
+                chunk = os.read(self._master, 4096)
+            except (BlockingIOError, OSError):
+                continue
+            if time.monotonic() < self._ready:
+                continue
+            for char in chunk:
+                self._rx_char(char)
+
+    def _rx_paced(self):
+        """
+        Runs the input side once per control loop: the bytes the wire carried
+        since the last loop go into the receive buffer, then one character is
+        taken out of it if paced, or all of them if not
+        """
+        period = LOOP_PERIOD_US / 1e6
+        wire = next_loop = time.monotonic()
+        while not self._stop.wait(max(next_loop - time.monotonic(), 0)):
+            now = time.monotonic()
+            next_loop = max(next_loop + period, now)
+            size = 4096
+            if self.baud:
+                #Bytes sent while the port was idle still arrive at wire rate
+                wire = max(wire, now - period)
+                size = int((now - wire) * self.baud / 10)
+            try:
+                chunk = os.read(self._master, size) if size else b''
+            except (BlockingIOError, OSError):
+                chunk = b''
+            if self.baud:
+                wire += len(chunk) * 10 / self.baud
+            if now < self._ready:
+                continue
+            if not self.paced:
+                for char in chunk:
+                    self._rx_char(char)
+                continue
+            space = RX_BUF - len(self._rx_buf)
+            if len(chunk) > space:
+                with self._cond:
+                    self.rx_dropped += len(chunk) - space
+            self._rx_buf += chunk[:space]
+            if self._rx_buf:
+                char = self._rx_buf.pop(0)
+                self._rx_char(char)
+
+    def _rx_char(self, char: int):
+        """
+        Adds a received character to the line, handling it once complete
+        """
+        if char == ord('\r'):
+            return
+        elif char == ord('\n'):
+            line, self._line = bytes(self._line), bytearray()
+            if line:
+                self._check_serial(line.decode('utf-8', 'replace'))
+        elif len(self._line) < INPUT_BUF - 2:
+            self._line.append(char)
+
+    def _check_serial(self, in_string: Text):
+        """
+        Splits a command line into header and data like checkSerial()
+        """
+        head_index = in_string.find(';')
+        if head_index < 0:
+            head, data = in_string, in_string
+        else:
+            head, data = in_string[:head_index], in_string[head_index + 1:]
+        head, data = head.strip(), data.strip()
+        with self._cond:
+            self.received.append((head, data))
+        self._serial_handler(head, data)
+
+    def _serial_handler(self, head: Text, data: Text):
+        """
+        Performs actions based on header like serialHandler()
+        """
+        if head in ('TUNEP', 'TUNEI', 'TUNED'):
+            self._eeprom['k' + head[-1].lower()] = _to_float(data)
+            setattr(self, 'k' + head[-1].lower(), _to_float(data))
+            self._print('TUNING UPDATE RECEIVED')
+        elif head == 'SETSP':
+            self.setpoint = _to_float(data)
+        elif head == 'SETDB':
+            self.deadband = _to_float(data)
+        elif head == 'SETDR':
+            self.direction = _to_int(data)
+        elif head == 'SETEN':
+            enable = _to_int(data)
+            if enable == 1:
+                self.enabled = True
+            elif enable == 0:
+                self.enabled = False
+                self.output = 90.0
+        elif head == 'CALGY':
+            #cal_mpu() blocks the loop, so nothing is printed meanwhile
+            with self._cond:
+                self._next_data = max(self._next_data, time.monotonic() + 1.5)
+        elif head == 'SETPO':
+            self.output = float(min(max(_to_int(data), LOW_BOUND), HIGH_BOUND))
+        elif head == 'SETPT':
+            self.print_en = _to_int(data)
+        elif head == 'GETEP':
+            self._print('EEPR;{:.4f},{:.4f},{:.4f},{:.2f},{:.2f},{:.2f},{:.2f}'.format(
+                self.kp, self.ki, self.kd, self.deadband, self._eeprom['gyro_x_cal'],
+                self._eeprom['gyro_y_cal'], self._eeprom['gyro_z_cal']))
+        elif head == 'GETVE':
+            self._print('VERS;{},{}'.format(*self.version))
+        elif head == 'GETDN':
+            self._print('DEVN;ddc-gimbal')
+        elif head == 'SETBN' and tuple(self.version) >= framing.BINARY_VERSION:
+            self.binary_en = _to_int(data)
+        else:
+            self._print('WARN;' + head)
+
+    def _step(self, dt: float):
+        """
+        Advances the simulated plant by dt seconds
+        """
+        noise = self._random.gauss(0, 0.05)
+        if self.enabled:
+            error = self.setpoint - self.angle
+            self.angle += error * min(dt * 4.0, 1.0) + noise
+            if abs(error) >= self.deadband:
+                sign = 1 if self.direction else -1
+                self.output = min(max(90 + sign * error * 2.0, LOW_BOUND), HIGH_BOUND)
+        else:
+            self.angle += noise
+        self.loop_duration = 4200 + int(self._random.gauss(0, 150))
+
+    def _tx_loop(self):
+        """
+        Produces DATA packets and writes queued lines when they are due
+        """
+        while not self._stop.is_set():
+            now = time.monotonic()
+            if now >= self._ready and self.print_en and self.data_rate > 0:
+                period = 1.0 / self.data_rate
+                while self._next_data <= now:
+                    self._step(period)
+                    if self.overrun_rate and self._random.random() < self.overrun_rate:
+                        self._print('LOOP;' + str(LOOP_PERIOD_US + 100 +
+                                                  int(self._random.random() * 2000)),
+                                    self._next_data)
+                    curr_time = int((self._next_data - self._start) * 1000) % 2**32
+                    if self.binary_en:
+                        self._print_raw(framing.encode_data_frame(
+                            self.angle, self.loop_duration, self.output, curr_time),
+                            self._next_data)
+                    else:
+                        self._print(self.format_data(self.angle, self.loop_duration,
+                                                     self.output, curr_time), self._next_data)
+                    self._next_data += period
+            elif self.data_rate > 0:
+                self._next_data = max(self._next_data, now)
+            with self._cond:
+                pending = []
+                while self._outbox and self._outbox[0][0] <= now:
+                    pending.append(heapq.heappop(self._outbox)[2])
+                if not pending:
+                    wake = [self._outbox[0][0]] if self._outbox else []
+                    if self.print_en and self.data_rate > 0:
+                        wake.append(self._next_data)
+                    if self._tx_backlog:
+                        wake.append(now + 0.001)
+                    timeout = min(wake) - now if wake else 0.05
+                    self._cond.wait(min(max(timeout, 0), 0.05))
+                    if self._tx_backlog:
+                        self._write(b'')
+                    continue
+            self._write(b''.join(pending))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a simulated gimbal on a pseudo-terminal')
+    parser.add_argument('--rate', type=float, default=1e6 / (LOOP_PERIOD_US * PRINT_EVERY),
+                        help='DATA packets per second')
+    parser.add_argument('--latency', type=float, default=0.0, help='output delay in seconds')
+    parser.add_argument('--jitter', type=float, default=0.0, help='extra random delay in seconds')
+    parser.add_argument('--boot', type=float, default=0.0, help='boot time in seconds')
+    parser.add_argument('--paced', action='store_true',
+                        help='take input one character per control loop, like the firmware')
+    parser.add_argument('--baud', type=int, default=None, help='limit both directions to this rate')
+    args = parser.parse_args()
+
+    sim = GimbalSimulator(args.rate, args.latency, args.jitter, boot_time=args.boot,
+                          paced=args.paced, baud=args.baud)
+    print('Simulated gimbal on ' + sim.port)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sim.close()
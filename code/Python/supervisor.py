@@ -0,0 +1,228 @@
+#!/usr/bin/python3
+'''
+GIMBAL SUPERVISOR
+RECONNECTS TO A GIMBAL WHEN THE USB LINK DROPS AND RESTORES ITS STATE
+
+A SupervisedGimbal is a Gimbal whose reader thread, instead of dying when
+the port fails, closes it and tries to open it again with exponential
+backoff. The port is found again by its USB fingerprint (see
+discovery.device_id()), so a Nano that comes back as another COM port is
+still found. Ports without one, e.g. pseudo-terminals or udev symlinks,
+are reopened by name.
+
+Set commands that only live in RAM on the Nano (SETDR, SETSP, SETPO,
+SETPT, SETEN) are remembered and the latest of each is sent again once
+the gimbal answers, in the order they were last sent: SETEN;0 recenters
+the servo, so a SETPO only holds if it came after. Sent during an outage,
+they are only remembered. Gains and deadband are kept in EEPROM and are
+not replayed. All other commands and requests fail with ConnectionError
+while the link is down.
+
+Usage:
+    gimbal = SupervisedGimbal('/dev/ttyUSB0', on_state=print)
+    gimbal.set_setpoint(10)
+    ...                                 #cable pulled and plugged back in
+    print(gimbal.metrics.snapshot()['histograms']['outage'])
+
+Organization: Davis Drone Club
+'''
+
+import os
+import threading
+import time
+from typing import Callable, Optional, Text, Union
+
+import serial
+import serial.tools.list_ports as lp
+
+import discovery
+import gimbal as gb
+
+#States passed to on_state
+CONNECTED = 'connected'
+RECONNECTING = 'reconnecting'
+CLOSED = 'closed'
+
+#Headers replayed after a reconnect
+REPLAY_HEADERS = ("SETDR", "SETSP", "SETPO", "SETPT", "SETEN")
+
+
+def port_device_id(port: Text) -> Optional[Text]:
+    """
+    Returns the discovery.device_id() of a port name or symlink, or None
+    if it is not a USB device
+    """
+    device = os.path.realpath(port)
+    for info in lp.comports():
+        if info.device == port or os.path.realpath(info.device) == device:
+            return discovery.device_id(info)
+    return None
+
+
+class SupervisedGimbal(gb.Gimbal):
+    """Gimbal that reconnects by itself after the port fails.
+
+    Attributes:
+        key: USB fingerprint used to find the port again, or None to reopen port
+        state: CONNECTED, RECONNECTING or CLOSED
+        backoff: seconds before the first reconnect attempt, doubled after every failed one
+        max_backoff: longest wait between attempts
+        metrics: as Gimbal, plus the histogram outage (seconds from the
+            port failing to the state being replayed) and the counters
+            reconnects and reconnect_attempts
+    """
+
+    def __init__(self, port: Text, key: Optional[Text] = None, backoff: float = 0.1,
+                 max_backoff: float = 5.0, on_state: Optional[Callable[[Text], None]] = None,
+                 connect_timeout: float = 5.0, probe_interval: float = 0.25,
+                 binary: bool = True, **kwargs):
+        """
+        Connects to the gimbal like Gimbal()
+
+        Args:
+            port (str): COM port of gimbal.
+            key (str, optional): device_id() of the gimbal. Defaults to the
+                fingerprint of port, if it has one.
+            backoff (float, optional): see attributes. Defaults to 0.1.
+            max_backoff (float, optional): see attributes. Defaults to 5.0.
+            on_state (callable, optional): called with the new state whenever
+                it changes, from the reader thread. Defaults to None.
+            connect_timeout, probe_interval, binary: as Gimbal(), also used
+                for every reconnect
+            **kwargs: passed on to Gimbal()
+
+        Raises:
+            As Gimbal(); the first connect is not retried
+        """
+        self.key = key if key is not None else port_device_id(port)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.state = CLOSED
+        self._on_state = on_state
+        self._handshake_args = (connect_timeout, probe_interval, binary)
+        self._state_lock = threading.RLock()
+        self._replay = {}
+        self._closing = threading.Event()
+        self._recovery = None
+        gb.Gimbal.__init__(self, port, connect_timeout=connect_timeout,
+                           probe_interval=probe_interval, binary=binary, **kwargs)
+        self._set_state(CONNECTED)
+
+    def send(self, header: Text, data: Union[int, float]):
+        """
+        Formats and sends a data packet to the gimbal, remembering it if
+        it is one of REPLAY_HEADERS.
+
+        Raises:
+            ValueError: If header or data is invalid.
+            TimeoutError: If serial timeout exceeded.
+            ConnectionError: If the port failed, unless header is replayed.
+        """
+        if header in REPLAY_HEADERS:
+            self._encode(header, data)
+            with self._state_lock:
+                #Moved to the end, the replay keeps the order of the last sends
+                self._replay.pop(header, None)
+                self._replay[header] = data
+                connected = self.state == CONNECTED
+            if not connected:
+                self.log.info('DEFERRED:' + header + self.data_delim + str(data))
+                return
+        try:
+            gb.Gimbal.send(self, header, data)
+        except serial.SerialException as e:
+            if header in REPLAY_HEADERS:
+                #The reader notices the failure too and replays the value
+                return
+            raise ConnectionError('Gimbal disconnected: ' + str(e))
+
+    def close(self):
+        """
+        Stops reconnecting, then closes the gimbal like Gimbal.close()
+        """
+        with self._state_lock:
+            self._closing.set()
+            recovery = self._recovery
+        if recovery is not None and recovery is not threading.current_thread():
+            recovery.join()
+        gb.Gimbal.close(self)
+        self._set_state(CLOSED)
+
+    def _set_state(self, state: Text):
+        with self._state_lock:
+            self.state = state
+        self._notify(state)
+
+    def _notify(self, state: Text):
+        """
+        Logs a state change and passes it to on_state
+        """
+        self.log.info('State: ' + state)
+        if self._on_state is not None:
+            self._on_state(state)
+
+    def _reader_failed(self, error: Exception):
+        """
+        Fails pending requests and, unless a reconnect is already running,
+        reconnects on this thread
+        """
+        gb.Gimbal._reader_failed(self, error)
+        with self._state_lock:
+            if self.state != CONNECTED or self._closing.is_set():
+                return
+            self._recovery = threading.current_thread()
+            self.state = RECONNECTING
+        self._notify(RECONNECTING)
+        self._reconnect(time.monotonic())
+
+    def _reconnect(self, start: float):
+        """
+        Reopens the port with exponential backoff until the gimbal answers
+        and its state is replayed, or the gimbal is closed
+        """
+        self.binary = False
+        try:
+            self.arduino.close()
+        except Exception:
+            pass
+        delay = self.backoff
+        while not self._closing.wait(delay):
+            delay = min(delay * 2, self.max_backoff)
+            self.metrics.count('reconnect_attempts')
+            port = self.port if self.key is None else discovery.find_port(self.key)
+            if port is None:
+                continue
+            with self._state_lock:
+                if self._closing.is_set():
+                    return
+                #The old reader has stopped; half a line from the dead port must
+                #not be glued to the first bytes from the new one
+                self._parser.reset()
+                try:
+                    self._connect(port)
+                except Exception:
+                    continue
+            try:
+                self._handshake(*self._handshake_args)
+                self._invalidate_config()
+                if self.coalescer is not None:
+                    #The new board has none of the values the coalescer last wrote
+                    self.coalescer.reset()
+                #Replayed and marked connected at once, so no set command is lost in between
+                with self._state_lock:
+                    for header, data in self._replay.items():
+                        gb.Gimbal.send(self, header, data)
+                    self.state = CONNECTED
+            except Exception as e:
+                self.log.warning('Reconnect failed: ' + str(e))
+                self.binary = False
+                self._stop_reader()
+                self.arduino.close()
+                continue
+            self.port = port
+            outage = time.monotonic() - start
+            self.metrics.count('reconnects')
+            self.metrics.observe('outage', outage)
+            self.log.info('Reconnected on ' + port + ' after ' + str(round(outage, 3)) + 's')
+            self._notify(CONNECTED)
+            return
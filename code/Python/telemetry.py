@@ -0,0 +1,547 @@
+#!/usr/bin/python3
+'''
+GIMBAL TELEMETRY
+FIXED-SIZE NUMPY RING BUFFER OF DATA SAMPLES
+
+Samples are written in place into a preallocated structured array, so a
+soak test running for hours uses the same memory as one running for a
+minute. The array holds every sample twice (at i and i + capacity), which
+keeps the latest samples contiguous: view() always returns a slice of the
+array, never a copy.
+
+SharedTelemetryRing keeps the same layout in a multiprocessing.shared_memory
+block. The process owning the Gimbal publishes into it; a GUI, recorder or
+analysis process attaches by name and reads views of the shared array
+directly, without a copy, a lock or a syscall per sample. Readers and the
+writer are kept consistent by a sequence counter (a seqlock): the writer
+makes it odd while samples are written and even again afterwards. Readers
+retry reading the sample count while it is odd, and read() and
+read_since() check after copying that the writer did not overwrite the
+copied samples meanwhile, retrying if it did. Views are not checked: a
+view of n samples is only valid until capacity - n more are written.
+
+parse_block() and BatchParser decode many text DATA lines at once into
+arrays of the same layout, for draining a backlog or a capture file.
+
+Usage:
+    python telemetry.py capture.bin -o data.csv    convert a raw serial capture
+
+    #owner process
+    gimbal = gb.Gimbal('/dev/ttyUSB0', telemetry_name='gimbal0')
+    #any other process
+    ring = SharedTelemetryRing.attach('gimbal0')
+    angles = ring.view(500)['angle']
+
+Organization: Davis Drone Club
+'''
+
+import argparse
+from multiprocessing import resource_tracker, shared_memory
+import sys
+import threading
+import time
+from typing import Callable, List, NamedTuple, Optional, Text, Tuple
+
+import numpy as np
+
+import framing
+
+#One DATA sample: the four values of printData() and the host receive time
+SAMPLE_DTYPE = np.dtype([('angle', np.float64), ('loop_duration', np.int32),
+                         ('output', np.float64), ('time', np.uint32),
+                         ('host_time', np.float64)])
+
+#Fields of SAMPLE_DTYPE sent by the gimbal, in printData() order
+DATA_FIELDS = ['angle', 'loop_duration', 'output', 'time']
+
+#Header of a shared ring: uint64 magic, capacity, sequence counter, total
+SHARED_MAGIC = 0x474D424C54454C31
+_MAGIC, _CAPACITY, _SEQ, _TOTAL = range(4)
+_HEADER_BYTES = 64
+
+
+def parse_data_payloads(payloads: List[bytes]) -> Tuple[np.ndarray, int]:
+    """
+    Parses the payloads of many text DATA packets in one pass.
+
+    All payloads are joined and converted by NumPy at once. If the field
+    count is off or a value does not parse, the block is parsed again line
+    by line so that only the bad lines are lost.
+
+    Args:
+        payloads (list): e.g. [b'1.03,5555,0.00,8039', ...]
+
+    Returns:
+        (ndarray, int): samples of SAMPLE_DTYPE with host_time 0, and the
+            number of malformed payloads
+    """
+    samples = np.zeros(len(payloads), dtype=SAMPLE_DTYPE)
+    if not payloads:
+        return samples, 0
+    fields = b','.join(payloads).split(b',')
+    if len(fields) == 4 * len(payloads):
+        try:
+            values = np.array(fields, dtype=np.float64).reshape(-1, 4)
+        except ValueError:
+            values = None
+        if values is not None and np.all(values[:, 1::2] == np.floor(values[:, 1::2])):
+            for column, name in enumerate(DATA_FIELDS):
+                samples[name] = values[:, column]
+            return samples, 0
+    rows = []
+    for payload in payloads:
+        try:
+            rows.append(framing.parse_data_bytes(payload) + (0.0,))
+        except ValueError:
+            pass
+    return np.array(rows, dtype=SAMPLE_DTYPE), len(payloads) - len(rows)
+
+
+def frames_to_array(frames: List[Tuple[float, int, float, int]]) -> np.ndarray:
+    """
+    Converts decoded binary DATA samples to an array of SAMPLE_DTYPE with host_time 0
+    """
+    return np.array([frame + (0.0,) for frame in frames], dtype=SAMPLE_DTYPE)
+
+
+class DataBlock(NamedTuple):
+    """Result of parse_block().
+
+    Attributes:
+        samples: DATA samples, text and binary, as an array of SAMPLE_DTYPE
+        packets: (header, str) of every other packet, e.g. WARN, LOOP and EEPR
+        counters: lines and frames seen and rejected, see framing.PacketParser
+    """
+    samples: np.ndarray
+    packets: List[Tuple[Text, Text]]
+    counters: dict
+
+
+def parse_block(block: bytes, headers: Optional[List[Text]] = None) -> DataBlock:
+    """
+    Parses a block of raw serial bytes, e.g. a whole capture file.
+
+    Args:
+        block (bytes): raw bytes; an incomplete last line is ignored
+        headers (list, optional): headers to accept. Defaults to all
+            headers the gimbal sends.
+
+    Returns:
+        DataBlock
+    """
+    parser = BatchParser(headers or ['WARN', 'LOOP', 'DATA', 'EEPR', 'VERS', 'DEVN'])
+    samples, packets = parser.feed_batch(block)
+    return DataBlock(samples, packets, parser.stats())
+
+
+class BatchParser(framing.PacketParser):
+    """PacketParser that returns all DATA samples of a chunk as one array.
+
+    Text DATA lines are decoded together by parse_data_payloads(), so a
+    backlog of hundreds of lines costs one NumPy conversion instead of
+    hundreds of Python float() calls.
+    """
+
+    def feed_batch(self, chunk: bytes, host_time: float = 0.0) -> Tuple[np.ndarray, List[Tuple[Text, Text]]]:
+        """
+        Adds a chunk and returns everything completed by it.
+
+        Args:
+            chunk (bytes): bytes read from the port
+            host_time (float, optional): stored as host_time of every sample. Defaults to 0.0.
+
+        Returns:
+            (ndarray, list): DATA samples of SAMPLE_DTYPE in arrival order,
+                text before binary, and (header, str) of all other packets
+        """
+        return self.parse_batch(*self.split(chunk), host_time=host_time)
+
+    def parse_batch(self, lines: List[bytes], frames: List[bytes],
+                    host_time: float = 0.0) -> Tuple[np.ndarray, List[Tuple[Text, Text]]]:
+        """
+        Parses lines and frames returned by split(), see feed_batch()
+        """
+        payloads, packets = self.sort_lines(lines)
+        samples, malformed = parse_data_payloads(payloads)
+        self.counters['malformed'] += malformed
+        if frames:
+            samples = np.concatenate((samples, frames_to_array(self.decode_frames(frames))))
+        samples['host_time'] = host_time
+        return samples, packets
+
+
+class TelemetryRing:
+    """Ring buffer of the last capacity DATA samples.
+
+    Views returned by view() and since() share memory with the ring. A
+    view of n samples stays valid until capacity - n newer samples have
+    been appended, when its oldest sample is overwritten; use read() and
+    read_since() for copies that stay valid.
+
+    Attributes:
+        capacity: number of samples kept
+        total: number of samples appended since creation or clear()
+    """
+
+    def __init__(self, capacity: int = 4096):
+        """
+        Allocates the ring
+
+        Args:
+            capacity (int, optional): number of samples kept. Defaults to 4096.
+
+        Raises:
+            ValueError: If capacity is not positive
+        """
+        if capacity <= 0:
+            raise ValueError('Capacity must be positive')
+        self.capacity = capacity
+        self.total = 0
+        self._buf = np.zeros(2 * capacity, dtype=SAMPLE_DTYPE)
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return min(self.total, self.capacity)
+
+    def append(self, host_time: float, angle: float, loop_duration: int,
+               output: float, curr_time: int):
+        """
+        Writes one sample over the oldest one
+        """
+        row = (angle, loop_duration, output, curr_time, host_time)
+        with self._lock:
+            index = self.total % self.capacity
+            self._buf[index] = row
+            self._buf[index + self.capacity] = row
+            self.total += 1
+
+    def extend(self, samples: np.ndarray):
+        """
+        Writes many samples at once
+
+        Args:
+            samples (ndarray): array of SAMPLE_DTYPE, oldest first
+        """
+        samples = samples[-self.capacity:]
+        count = len(samples)
+        if count == 0:
+            return
+        with self._lock:
+            start = self.total % self.capacity
+            first = min(count, self.capacity - start)
+            for offset in (0, self.capacity):
+                self._buf[start + offset:start + offset + first] = samples[:first]
+                self._buf[offset:offset + count - first] = samples[first:]
+            self.total += count
+
+    def view(self, last_n: Optional[int] = None) -> np.ndarray:
+        """
+        Returns the latest samples without copying them.
+
+        Columns are accessed by name, e.g. view(500)['angle'].
+
+        Args:
+            last_n (int, optional): number of samples wanted. Defaults to all kept.
+
+        Returns:
+            ndarray: up to last_n samples of SAMPLE_DTYPE, oldest first
+        """
+        with self._lock:
+            total = self.total
+            return self._latest(min(total, self.capacity) if last_n is None else last_n, total)
+
+    def since(self, total: int) -> Tuple[np.ndarray, int]:
+        """
+        Returns the samples appended after the ring held total samples.
+
+        Poll with the returned count to receive every sample once; samples
+        overwritten between two polls are skipped.
+
+        Args:
+            total (int): value of the total attribute at the previous poll
+
+        Returns:
+            (ndarray, int): view of the new samples and the new total
+        """
+        with self._lock:
+            current = self.total
+            return self._latest(current - total, current), current
+
+    def read(self, last_n: Optional[int] = None) -> np.ndarray:
+        """
+        Same as view(), but returns a copy
+        """
+        with self._lock:
+            total = self.total
+            return self._latest(min(total, self.capacity) if last_n is None else last_n, total).copy()
+
+    def read_since(self, total: int) -> Tuple[np.ndarray, int]:
+        """
+        Same as since(), but returns a copy
+        """
+        with self._lock:
+            current = self.total
+            return self._latest(current - total, current).copy(), current
+
+    def _latest(self, count: int, total: int) -> np.ndarray:
+        """
+        Returns a view of the latest count samples when total samples had been appended
+        """
+        count = max(0, min(count, total, self.capacity))
+        end = total % self.capacity + self.capacity
+        return self._buf[end - count:end]
+
+    def clear(self):
+        """
+        Forgets all samples
+        """
+        with self._lock:
+            self.total = 0
+
+
+def _untrack(block: shared_memory.SharedMemory):
+    """
+    Takes a block off the resource tracker, which would otherwise remove
+    it when the process exits. Readers spawned by the writer share its
+    tracker, so tracking the block in one process would be undone by
+    another; the writer unlinks it in close() instead.
+    """
+    resource_tracker.unregister(block._name, 'shared_memory')
+
+
+class SharedTelemetryRing(TelemetryRing):
+    """TelemetryRing in shared memory, written by one process and read by many.
+
+    The creating process is the only writer. Processes that attach() get a
+    read-only ring whose view() and since() return views straight into the
+    shared block, with the same lifetime rules as TelemetryRing; the writer
+    does not wait for readers, so a reader must be done with a view of n
+    samples before capacity - n more arrive. read() and read_since() copy
+    and are checked against the writer.
+
+    The writer removes the block in close(). A block left behind by a
+    crashed writer is removed with attach(name).close(unlink=True).
+
+    Attributes:
+        name: name of the shared memory block, passed to attach()
+        capacity: number of samples kept
+        total: number of samples appended since creation or clear()
+    """
+
+    def __init__(self, capacity: int = 4096, name: Optional[Text] = None):
+        """
+        Creates the shared memory block and becomes its writer
+
+        Args:
+            capacity (int, optional): number of samples kept. Defaults to 4096.
+            name (str, optional): name of the block. Defaults to a random name.
+
+        Raises:
+            ValueError: If capacity is not positive
+            FileExistsError: If a block with this name already exists
+        """
+        if capacity <= 0:
+            raise ValueError('Capacity must be positive')
+        size = _HEADER_BYTES + 2 * capacity * SAMPLE_DTYPE.itemsize
+        block = shared_memory.SharedMemory(name, create=True, size=size)
+        _untrack(block)
+        self._setup(block, writer=True)
+        self._header[:] = 0
+        self._header[_CAPACITY] = capacity
+        self._header[_MAGIC] = SHARED_MAGIC
+        self.capacity = capacity
+
+    @classmethod
+    def attach(cls, name: Text) -> 'SharedTelemetryRing':
+        """
+        Opens a ring published by another process for reading
+
+        Args:
+            name (str): name of the ring
+
+        Returns:
+            SharedTelemetryRing: read-only ring
+
+        Raises:
+            FileNotFoundError: If no ring with this name exists
+            ValueError: If the block is not a telemetry ring
+        """
+        block = shared_memory.SharedMemory(name)
+        _untrack(block)
+        ring = cls.__new__(cls)
+        ring._setup(block, writer=False)
+        capacity = int(ring._header[_CAPACITY])
+        if (ring._header[_MAGIC] != SHARED_MAGIC or
+                block.size < _HEADER_BYTES + 2 * capacity * SAMPLE_DTYPE.itemsize):
+            ring.close()
+            raise ValueError('Not a telemetry ring: ' + name)
+        ring.capacity = capacity
+        return ring
+
+    def _setup(self, block: shared_memory.SharedMemory, writer: bool):
+        """
+        Maps the header and sample array onto block
+        """
+        self._block = block
+        self._writer = writer
+        self._lock = threading.Lock()
+        self.name = block.name
+        self._header = np.ndarray(4, dtype=np.uint64, buffer=block.buf)
+        count = (block.size - _HEADER_BYTES) // SAMPLE_DTYPE.itemsize
+        self._buf = np.ndarray(count, dtype=SAMPLE_DTYPE, buffer=block.buf, offset=_HEADER_BYTES)
+
+    @property
+    def total(self) -> int:
+        return self._snapshot()
+
+    @total.setter
+    def total(self, value: int):
+        self._header[_TOTAL] = value
+
+    def _snapshot(self) -> int:
+        """
+        Reads the sample count, retrying while the writer is mid-update
+        """
+        header = self._header
+        while True:
+            seq = header[_SEQ]
+            if not seq & 1:
+                total = int(header[_TOTAL])
+                if header[_SEQ] == seq:
+                    return total
+            time.sleep(0)
+
+    def _publish(self, write: Callable, *args):
+        """
+        Runs a write of the base class inside an odd sequence number
+        """
+        if not self._writer:
+            raise PermissionError('Ring attached read-only: ' + self.name)
+        with self._lock:
+            self._header[_SEQ] += 1
+            try:
+                write(*args)
+            finally:
+                self._header[_SEQ] += 1
+
+    def append(self, host_time: float, angle: float, loop_duration: int,
+               output: float, curr_time: int):
+        """
+        Writes one sample over the oldest one
+        """
+        row = (angle, loop_duration, output, curr_time, host_time)
+        self._publish(self._write_rows, [row], 1)
+
+    def extend(self, samples: np.ndarray):
+        """
+        Writes many samples at once
+
+        Args:
+            samples (ndarray): array of SAMPLE_DTYPE, oldest first
+        """
+        samples = samples[-self.capacity:]
+        if len(samples):
+            self._publish(self._write_rows, samples, len(samples))
+
+    def _write_rows(self, rows, count: int):
+        """
+        Copies count rows to both halves of the ring and advances total
+        """
+        total = int(self._header[_TOTAL])
+        start = total % self.capacity
+        first = min(count, self.capacity - start)
+        for offset in (0, self.capacity):
+            self._buf[start + offset:start + offset + first] = rows[:first]
+            self._buf[offset:offset + count - first] = rows[first:]
+        self._header[_TOTAL] = total + count
+
+    def view(self, last_n: Optional[int] = None) -> np.ndarray:
+        total = self._snapshot()
+        return self._latest(min(total, self.capacity) if last_n is None else last_n, total)
+
+    def since(self, total: int) -> Tuple[np.ndarray, int]:
+        current = self._snapshot()
+        return self._latest(current - total, current), current
+
+    def read(self, last_n: Optional[int] = None) -> np.ndarray:
+        """
+        Same as view(), but returns a copy, checked not to have been
+        overwritten by the writer while it was made
+        """
+        while True:
+            total = self._snapshot()
+            count = min(total, self.capacity) if last_n is None else last_n
+            samples = self._latest(count, total).copy()
+            if self._intact(total, len(samples)):
+                return samples
+
+    def read_since(self, total: int) -> Tuple[np.ndarray, int]:
+        """
+        Same as since(), but returns a checked copy, see read()
+        """
+        while True:
+            current = self._snapshot()
+            samples = self._latest(current - total, current).copy()
+            if self._intact(current, len(samples)):
+                return samples, current
+
+    def _intact(self, total: int, count: int) -> bool:
+        """
+        Returns True if the latest count samples at total are still unchanged.
+
+        Sample i overwrites the slots of sample i - capacity, so the copy
+        holds if the writer is not mid-write and has not gone past sample
+        total - count + capacity. The sequence counter is read first: a
+        write starting after it cannot have touched a copy made before.
+        """
+        header = self._header
+        if header[_SEQ] & 1:
+            return False
+        return int(header[_TOTAL]) <= total - count + self.capacity
+
+    view.__doc__ = TelemetryRing.view.__doc__
+    since.__doc__ = TelemetryRing.since.__doc__
+
+    def clear(self):
+        """
+        Forgets all samples
+        """
+        self._publish(self._header.__setitem__, _TOTAL, 0)
+
+    def close(self, unlink: Optional[bool] = None):
+        """
+        Unmaps the block. Views of the ring must not be used afterwards.
+
+        Args:
+            unlink (bool, optional): also remove the block so that no new
+                reader can attach. Defaults to True for the writer.
+        """
+        if self._block is None:
+            return
+        block, self._block = self._block, None
+        self._header = self._buf = None
+        try:
+            block.close()
+        except BufferError:
+            #Views handed out still use the mapping; it is released with them
+            pass
+        if self._writer if unlink is None else unlink:
+            #unlink() unregisters the block again
+            resource_tracker.register(block._name, 'shared_memory')
+            block.unlink()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a raw serial capture to CSV')
+    parser.add_argument('capture', help='raw bytes read from the gimbal port')
+    parser.add_argument('-o', '--output', default='data.csv', help='CSV file to write')
+    args = parser.parse_args()
+
+    with open(args.capture, 'rb') as capture_file:
+        result = parse_block(capture_file.read())
+    np.savetxt(args.output, result.samples[DATA_FIELDS].tolist(), delimiter=',',
+               fmt=['%.2f', '%d', '%.2f', '%d'], header=','.join(DATA_FIELDS), comments='')
+    for header, packet in result.packets:
+        if header == 'WARN':
+            print(packet, file=sys.stderr)
+    print('{} samples, counters {}'.format(len(result.samples), result.counters))
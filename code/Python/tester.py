@@ -1,20 +1,15 @@
-import gimbal as gb
-import serial.tools.list_ports as lp
+import discovery
 
 
-comports = lp.comports()
+found = discovery.discover_gimbals(cache=discovery.DeviceCache())
 
-for port in comports:
-    print("Port found: " + port.description)
-    try:
-        gimbal = gb.Gimbal(port.device)
-    except Exception as e:
-        print(str(e))
-        pass
-    else:
-        break
+for info in found:
+    print("Gimbal found: " + info.port + " (" + info.description + ")")
 
-major, minor = gimbal.get_version()
+if not found:
+    print("No gimbal found")
+else:
+    major, minor = found[0].version
 
-print("MAJOR: " + major)
-print("MINOR: " + minor)
+    print("MAJOR: " + major)
+    print("MINOR: " + minor)
@@ -1,8 +1,8 @@
 /*
  * ----------------------------------------------------------------------
- * Davis Drone Club Gimbal v2.3 firmware
+ * Davis Drone Club Gimbal v2.4 firmware
  * 
- * CHANGELOG (v2.0 -> v2.3)
+ * CHANGELOG (v2.0 -> v2.4)
  * - (2.1) Add watchdog timer
  * - (2.1) Add Enable response
  * - (2.1) Add Position response
@@ -11,6 +11,7 @@
  * - (2.3) Changed to quaternion IMU processing
  * - (2.3) Increased loop duration
  * - (2.3) Implemented adaptive gains
+ * - (2.4) Add binary DATA packets (SETBN)
  * PID_v1 library can be downloaded from here: https://github.com/br3ttb/Arduino-PID-Library
  * 
  * --------------------ADJUSTABLE SETTINGS--------------------
@@ -21,6 +22,9 @@ boolean gimbalDir = 1;
 //PRINT DATA TO SERIAL: true FOR ENABLED, false FOR DISABLE 
 boolean print_en = true;
 
+//BINARY DATA PACKETS: true FOR BINARY, false FOR TEXT (set by host with SETBN)
+boolean binary_en = false;
+
 //Quaternion Filter Variables
 double BASE_GAIN = 0.017;
 double THRESH_LOW = 0.05;
@@ -38,7 +42,7 @@ double EPSILON = 0.8;
 #include <avr/wdt.h>
 
 //Version here
-int VERSION[] = {2,3};
+int VERSION[] = {2,4};
 
 //Declare a union datatype to allow easy conversion between float and byte
 //More information on union: https://www.tutorialspoint.com/cprogramming/c_unions.htm
@@ -96,6 +100,7 @@ String cbStr = "CALGY";         //Header content for calibrate gyro packet
 String peStr = "GETEP";         //Header content to get EEPROM data
 String veStr = "GETVE";         //Header content to get version number
 String dnStr = "GETDN";         //Header content to get device name
+String bnStr = "SETBN";         //Header content for binary data packet
 String warnString = "WARN";     //Warning header
 String loopString = "LOOP";     //Loop warning header
 String dataString = "DATA";     //Data header
@@ -105,6 +110,16 @@ String devnString = "DEVN";     //Device name header
 String headDelim  = ";";        //Header delimiter
 String dataDelim  = ",";        //Data delimiter
 
+//Binary DATA packet, sent COBS encoded between two 0 bytes with a CRC-16
+#define DATA_FRAME  0x01        //Frame type of binary DATA packet
+struct __attribute__((packed)) DataFrame {
+  byte          type;           //DATA_FRAME
+  float         angle;          //Angle in degrees
+  int           duration;       //Loop duration in us
+  float         output;         //PID output
+  unsigned long curr_time;      //Current time
+};
+
 //Declaring servo object
 Servo servo;
 
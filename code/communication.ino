@@ -97,6 +97,10 @@ void serialHandler(String parse_head, String parse_data){
     {
       Serial.println(devnString + headDelim + "ddc-gimbal");
     }
+    else if(parse_head == bnStr)
+    {
+      binary_en = parse_data.toInt();
+    }
     else
     {
       Serial.println(warnString + headDelim + parse_head);
@@ -108,11 +112,76 @@ void serialHandler(String parse_head, String parse_data){
  * Pass angle and current time
  */
 void printData(float angle, unsigned long currTime){
+  if(binary_en)
+  {
+    printDataBinary(angle, currTime);
+    return;
+  }
   //Combine data into string
   String printStr = dataString + headDelim + angle + dataDelim + loop_duration + dataDelim + output + dataDelim + currTime;
   Serial.println(printStr);
 }
 
+/*
+ * Print data as a binary frame: 0, COBS(DataFrame + CRC-16), 0
+ * Pass angle and current time
+ */
+void printDataBinary(float angle, unsigned long currTime){
+  byte payload[sizeof(DataFrame) + 2];
+  byte frame[sizeof(payload) + 1];
+  DataFrame data = {DATA_FRAME, angle, loop_duration, (float)output, currTime};
+  memcpy(payload, &data, sizeof(data));
+  unsigned int crc = crc16(payload, sizeof(data));
+  payload[sizeof(data)] = crc & 0xFF;           //CRC is sent little-endian
+  payload[sizeof(data) + 1] = crc >> 8;
+  int len = cobsEncode(payload, sizeof(payload), frame);
+  Serial.write((byte)0);
+  Serial.write(frame, len);
+  Serial.write((byte)0);
+}
+
+/*
+ * CRC-16/XMODEM (polynomial 0x1021, initial value 0) of len bytes
+ */
+unsigned int crc16(const byte *data, int len){
+  unsigned int crc = 0;
+  for(int i = 0; i < len; i++) {
+    crc ^= (unsigned int)data[i] << 8;
+    for(int j = 0; j < 8; j++) {
+      crc = (crc & 0x8000) ? (crc << 1) ^ 0x1021 : (crc << 1);
+    }
+  }
+  return crc;
+}
+
+/*
+ * COBS encode len bytes of input so that output contains no 0 bytes
+ * output must hold len + 1 bytes, returns the encoded length
+ */
+int cobsEncode(const byte *input, int len, byte *output){
+  int code_index = 0;
+  int write_index = 1;
+  byte code = 1;
+  for(int read_index = 0; read_index < len; read_index++) {
+    if(input[read_index] == 0) {
+      output[code_index] = code;           //Close block at the 0 byte
+      code = 1;
+      code_index = write_index++;
+    }
+    else {
+      output[write_index++] = input[read_index];
+      code++;
+      if(code == 0xFF) {                   //Block full, start a new one
+        output[code_index] = code;
+        code = 1;
+        code_index = write_index++;
+      }
+    }
+  }
+  output[code_index] = code;
+  return write_index;
+}
+
 /*
  * Non-blocking implementation of reading lines from serial
  */
@@ -9,23 +9,29 @@
 
 COMPORT = 'COM3'
 NUMPOINTS = 3000                                #Number of datapoints to collect
+PLOTPOINTS = 3000                               #Number of latest datapoints to plot
 STARTPOINT = 0
 TESTPOINT  = 30
 
 #--------------INITIALIZATION-------------
 #Importing libraries
-import serial
+import os
 import time
 import csv
 import sys
+import numpy as np
 import matplotlib.pyplot as plt
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code', 'Python'))
+import gimbal as gb
+
 #Initialize Variables
 SP = 0                                          #Initialize setpoint
 switch = 0
+changes = [(0, STARTPOINT)]                     #(device time, setpoint) of every setpoint change
 #Try to Open Serial
 try:
-    arduino=serial.Serial(COMPORT,115200)        #Initialize serial
+    arduino = gb.Gimbal(COMPORT, telemetry_size=PLOTPOINTS)    #Connect, waits for Arduino to restart
 except Exception as e:                          #If an error occurs, run this
     print("Check COM port number: " + str(e))
     sys.exit()
@@ -37,65 +43,55 @@ try:
     dataFile = open('data.csv', 'w')            #Initialize data file
 except Exception as e:                          #If an error occurs, run this
     print("File may be open elsewhere: " + str(e))
+    arduino.close()
     sys.exit()
-    
-time.sleep(5)                                   #Wait for Arduino to restart
-
-def changeSetpoint(setpoint):
-    printstr = "SETSP;"+str(setpoint)
-    arduino.write(printstr.encode('utf-8'))
-
-#Initialize Empty Lists
-lines      = []
-angle      = []
-graphtime  = []
-sp         = []
 
-changeSetpoint(STARTPOINT)                      #Reset setpoint
-arduino.write("SETDB;1.5".encode('utf-8'))      #Set deadband
-time.sleep(0.01)                                #Pause between messages
-arduino.write("TUNEI;5".encode('utf-8'))        #Set I parameter
+arduino.set_setpoint(STARTPOINT)                #Reset setpoint
+arduino.apply_config({'deadband': 1.5, 'ki': 5}) #Set deadband and I parameter, if not set yet
 print("Starting run")
 
 #-----------------TEST--------------------
+#Samples are collected by the Gimbal reader thread into a fixed-size ring,
+#rows are written to the CSV as they arrive, so memory use does not grow
+#with NUMPOINTS.
 
-for i in range(NUMPOINTS):                      #Iterate from 0 to number of datapoints
-    inData = arduino.readline()                 #Read data from Arduino
-    try:                                        #Try to decode bytes to string
-        inString = inData.decode('utf-8')
-    except:                                     #If an error occurs,
-        print('Read Error')                     #print a warning
-        continue                                #and then skip this iteration.
-    else:                                       #Otherwise,
-        headers = inString.split(";")           #split the data by delimiter
-        
-    if headers[0] == "DATA":                    #If a data packet is received
-        data = headers[1].split(",")            #Split data by delimiter
-        data.append(str(SP))                    #Append current setpoint
-    elif headers[0] == "WARN":                  #If a warning packet is received
-        print("Warn received: " + headers[1])   #Print the warning message
+count = 0                                       #Number of datapoints collected
+seen = arduino.telemetry.total                  #Ring position of the last datapoint handled
+with dataFile:
+    writer = csv.writer(dataFile, lineterminator='\r')  #Instantiate the writer
+    while count < NUMPOINTS:
+        time.sleep(0.05)                        #Let datapoints accumulate
+        while True:                             #Print any warning packets
+            try:
+                print("Warn received: " + arduino.read('WARN', timeout=0).split(';', 1)[1])
+            except TimeoutError:
+                break
+        samples, seen = arduino.telemetry.since(seen)   #View of new datapoints, not a copy
+        samples = samples[:NUMPOINTS - count]
+        for sample in samples:                  #Write data to CSV
+            writer.writerow([int(sample['time']), round(float(sample['angle']), 2), SP])
+        count += len(samples)
 
-    if (i > (NUMPOINTS/3))&(switch == 0):       #A third of the way through
-        changeSetpoint(TESTPOINT)               #Change the setpoint
-        SP = TESTPOINT
-        switch = 1
-    elif (i > (2*NUMPOINTS/3))&(switch == 1):   #Two thirds of the way through
-        changeSetpoint(STARTPOINT)              #Reset the setpoint
-        SP = STARTPOINT
-        switch = 2
-    try:
-        lines.append(data)                      #Append data collected this iteration to list
-    except:                                     #If something goes wrong, skip this iteration
-        continue
+        if not len(samples):                    #Nothing new to time a change by
+            continue
+        if (count > (NUMPOINTS/3))&(switch == 0):       #A third of the way through
+            arduino.set_setpoint(TESTPOINT)             #Change the setpoint
+            SP = TESTPOINT
+            changes.append((int(samples[-1]['time']), SP))
+            switch = 1
+        elif (count > (2*NUMPOINTS/3))&(switch == 1):   #Two thirds of the way through
+            arduino.set_setpoint(STARTPOINT)            #Reset the setpoint
+            SP = STARTPOINT
+            changes.append((int(samples[-1]['time']), SP))
+            switch = 2
 
 #--------------POST PROCESSING------------
-with dataFile:                                  #Open the datafile
-    writer = csv.writer(dataFile, lineterminator='\r')  #Instantiate the writer
-    for i in lines:                             #Iterate through each line
-        angle.append(float(i[0]))               #Split the data into respective list
-        graphtime.append(int(i[1]))
-        sp.append(float(i[2]))
-        writer.writerow([int(i[1]),float(i[0]),float(i[2])])    #Write data to CSV
+print('Stream:', arduino.stream.report())        #Dropped, repeated and corrupt packets
+data = arduino.telemetry.read(PLOTPOINTS)       #Copy of the latest datapoints, the reader keeps appending
+graphtime = data['time']
+angle = data['angle']
+change_times = np.array([change[0] for change in changes])
+sp = np.array([change[1] for change in changes])[np.searchsorted(change_times, graphtime, side='right') - 1]
 
 plt.figure(1)                                   #Start a new figure
 plt.plot(graphtime, angle, label='Measured angle') #Plot measured angle
@@ -103,4 +99,5 @@ plt.plot(graphtime, sp, label='Setpoint')       #Plot desired setpoint
 plt.legend()                                    #Generate legend
 plt.xlabel('Time (microseconds)')               #Label x axis
 plt.ylabel('Angle (degrees)')                   #Label y axis
+arduino.close()
 plt.show()                                      #Display plot